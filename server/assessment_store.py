@@ -0,0 +1,115 @@
+################################### Import Libraries ###################################
+import hashlib
+import json
+import threading
+
+from llm_cache import LRUCacheTier
+
+ASSESSMENT_CACHE_MAX_ENTRIES = 10000  # max number of assessments in the in-process LRU tier
+# only the readability check depends on the reading level
+READING_LEVEL_CHECKS = ["readability"]
+
+
+def normalize_question(question):
+    """
+    Normalize a question (JSON string or dictionary) so that equivalent questions are identical:
+    the description is dropped, whitespace in strings is collapsed and keys are sorted
+    """
+    if isinstance(question, str):
+        question = json.loads(question)
+
+    def normalize(value):
+        if isinstance(value, dict):
+            return {key: normalize(item) for key, item in value.items() if key != "description"}
+        if isinstance(value, list):
+            return [normalize(item) for item in value]
+        if isinstance(value, str):
+            return " ".join(value.split())
+        return value
+
+    return json.dumps(normalize(question), sort_keys=True, separators=(",", ":"))
+
+
+def make_assessment_key(question, check_name, reading_level, version):
+    """
+    Create the key for an assessment: the sha256 of the normalized question,
+    the check name, the reading level (for checks that use it) and the prompts version
+    """
+    payload = {
+        "question": normalize_question(question),
+        "check_name": check_name,
+        "reading_level": reading_level if check_name in READING_LEVEL_CHECKS else None,
+        "version": version
+    }
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class AssessmentStore:
+    """
+    Persistent store for the outputs of the assess modules (readability, bias and specificity).
+    Lookups go to the in-process LRU tier first and then to the assessments collection in MongoDB (if db is set),
+    so repeat checks of the same question are shared across users, sessions and workers.
+    """
+
+    def __init__(self, version, db=None, local_tier=None):
+        self.version = version
+        self.db = db
+        self.local_tier = local_tier if local_tier is not None else LRUCacheTier(
+            max_entries=ASSESSMENT_CACHE_MAX_ENTRIES)
+        self.lock = threading.Lock()
+        self.counters = {"local_hits": 0, "db_hits": 0,
+                         "misses": 0, "sets": 0, "errors": 0}
+
+    def increment(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def get(self, question, check_name, reading_level):
+        """
+        Returns the stored output of the assess module or None if the question wasn't assessed yet
+        """
+        key = make_assessment_key(question, check_name, reading_level, self.version)
+        output = self.local_tier.get(key)
+        if output is not None:
+            self.increment("local_hits")
+            return dict(output)
+
+        if self.db is not None:
+            # a database error should never fail the check
+            try:
+                output = self.db.get_assessment(key)
+            except Exception:
+                self.increment("errors")
+                output = None
+            if output is not None:
+                self.increment("db_hits")
+                self.local_tier.set(key, output)
+                return dict(output)
+
+        self.increment("misses")
+        return None
+
+    def set(self, question, check_name, reading_level, output):
+        """
+        Stores the output of the assess module
+        """
+        key = make_assessment_key(question, check_name, reading_level, self.version)
+        self.increment("sets")
+        self.local_tier.set(key, dict(output))
+        if self.db is not None:
+            try:
+                self.db.add_assessment(key, check_name, self.version, output)
+            except Exception:
+                self.increment("errors")
+
+    def get_stats(self):
+        """
+        Returns the hit/miss counters and the hit rate
+        """
+        with self.lock:
+            stats = dict(self.counters)
+        hits = stats["local_hits"] + stats["db_hits"]
+        lookups = hits + stats["misses"]
+        stats["hit_rate"] = hits / lookups if lookups > 0 else 0
+        return stats
@@ -0,0 +1,72 @@
+################################### Import Libraries ###################################
+import random
+import uuid
+from datetime import datetime, timedelta
+
+# topic names for the synthetic projects (the first num_topics are used)
+TOPIC_NAMES = [
+    "Parks and green spaces", "Public transportation", "School safety", "After-school programs", "Housing costs",
+    "Local businesses", "Community events", "Public health", "Library services", "Road maintenance",
+    "Bike lanes", "Youth sports", "Senior services", "Air quality", "Public art",
+    "Noise", "Parking", "Internet access", "Emergency services", "Recycling"
+]
+QUESTION_TEMPLATES = [
+    "How often do you use {topic_lower}?",
+    "What would you change about {topic_lower} in your neighborhood?",
+    "How satisfied are you with {topic_lower}?",
+    "What worries you the most about {topic_lower}?",
+    "Who in your household is affected by {topic_lower}?"
+]
+CELLS_PER_SECTION = 10
+
+
+def make_cell_details(rng, topic):
+    """
+    Synthetic question about a topic (same fields as the cells the UI sends)
+    """
+    response_format = rng.choice(["open", "closed"])
+    return {
+        "cell_type": "question",
+        "response_format": response_format,
+        "description": "",
+        "main_text": rng.choice(QUESTION_TEMPLATES).format(topic_lower=topic.lower()),
+        "response_categories": [] if response_format == "open" else
+        [{"id": i, "text": text} for i, text in enumerate(["Never", "Sometimes", "Often"])]
+    }
+
+
+def make_project(num_cells, num_topics, seed=0):
+    """
+    Synthetic project with num_cells questions about num_topics topics
+    Returns {"sections", "cells", "topics"} in the format of update_all_questions and analyze_topics
+    """
+    rng = random.Random(f"{seed}:{num_cells}:{num_topics}")
+    topics = TOPIC_NAMES[:num_topics]
+    sections = []
+    cells = {}
+    for i in range(num_cells):
+        section_index = i // CELLS_PER_SECTION
+        if section_index == len(sections):
+            sections.append({"id": section_index, "title": f"Section {section_index + 1}", "cells": []})
+        # from rng, so the same seed gives the same cell ids
+        cell_id = uuid.UUID(int=rng.getrandbits(128)).hex
+        sections[section_index]["cells"].append(cell_id)
+        cells[cell_id] = {
+            "cell_details": make_cell_details(rng, topics[i % len(topics)]),
+            "section_index": section_index,
+            "last_updated": "",
+            "human_ai_status": "human",
+            "time_estimate": rng.randint(1, 3)
+        }
+    return {"sections": sections, "cells": cells, "topics": topics}
+
+
+def make_events(num_events, start_index=0):
+    """
+    Synthetic user events with increasing timeStamps, starting after the events of the previous start indexes
+    (add_events drops events older than the last stored ones, so batches have to be sent in start_index order)
+    """
+    start = datetime(2024, 1, 1)
+    return [{"timeStamp": (start + timedelta(milliseconds=start_index + i)).isoformat(timespec="milliseconds") + "Z",
+             "type": "benchmark", "index": start_index + i}
+            for i in range(num_events)]
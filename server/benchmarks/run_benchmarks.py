@@ -0,0 +1,339 @@
+################################### Import Libraries ###################################
+import argparse
+import copy
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from pymongo import monitoring
+
+from benchmarks.project_factory import make_events, make_project
+
+# Default settings for the benchmarks
+PROJECT_SIZES = [(10, 5), (50, 10), (200, 20)]  # (number of cells, number of topics)
+REQUESTS_PER_ENDPOINT = 20
+# the endpoints that run many LLM calls per request get fewer requests
+ENDPOINT_REQUEST_FRACTION = {"analyze_topics": 0.25, "generate_draft": 0.25}
+CONCURRENCY = 4  # number of clients sending requests at the same time
+LLM_LATENCY = 0.2  # mean seconds per offline LLM call
+EDITED_CELL_FRACTION = 0.1  # fraction of the cells edited in each update_all_questions
+EVENTS_PER_REQUEST = 20  # number of events in each track_user_action
+EXISTING_QUESTIONS_PER_TOPIC = 5  # number of existing questions sent to get_add_suggestions
+CONTEXT_FILE = "data/example_project_launch_responses/step1_questions_ccc.json"
+ENDPOINTS = ["load_project", "update_all_questions", "generate_draft", "track_user_action",
+             "check_question", "analyze_topics", "get_add_suggestions"]
+
+
+class CommandCounter(monitoring.CommandListener):
+    """
+    Counts the MongoDB commands sent by every client in the process
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def started(self, event):
+        with self.lock:
+            self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def percentile(values, p):
+    """
+    Percentile (0-100) of a list of values with linear interpolation
+    """
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+class EndpointBenchmarks:
+    """
+    Drives the /api endpoints of the Flask app with the Flask test client for one synthetic project.
+    Each endpoint runs on its own (so the LLM calls and MongoDB commands can be attributed to it),
+    with requests sent by `concurrency` logged-in clients at the same time.
+    """
+
+    def __init__(self, server, command_counter, num_cells, num_topics, concurrency=CONCURRENCY,
+                 requests_per_endpoint=REQUESTS_PER_ENDPOINT, seed=0):
+        self.server = server
+        self.command_counter = command_counter
+        self.num_cells = num_cells
+        self.num_topics = num_topics
+        self.concurrency = concurrency
+        self.requests_per_endpoint = requests_per_endpoint
+        self.rng = random.Random(seed)
+        self.project = make_project(num_cells, num_topics, seed)
+        with open(CONTEXT_FILE, "r") as f:
+            self.context = json.load(f)["questions"]
+        self.user_id = f"benchmark-{num_cells}-{num_topics}-{int(time.time() * 1000)}"
+        self.project_id = None
+        self.clients = []
+        self.task_ids = []
+        self.event_index = 0  # index of the next synthetic event (shared by all the clients)
+        self.lock = threading.Lock()
+
+    def post(self, client, path, payload):
+        response = client.post(path, json=payload)
+        if response.status_code != 200:
+            raise RuntimeError(f"{path} returned {response.status_code}")
+        data = response.get_json()
+        # keep the task ids to delete their progress events
+        if isinstance(data, dict) and "task_id" in data:
+            with self.lock:
+                self.task_ids.append(data["task_id"])
+        return data
+
+    def set_up(self):
+        """
+        Create the user, log in the clients and create the project with its context, cells and topics
+        """
+        db = self.server.db
+        db.add_user(self.user_id)
+        for _ in range(self.concurrency):
+            client = self.server.app.test_client()
+            self.post(client, "/api/log_in", {"user_code": self.user_id})
+            self.clients.append(client)
+
+        self.project_id = self.post(self.clients[0], "/api/create_project", {})["project_id"]
+        self.post(self.clients[0], "/api/update_context", {"project_id": self.project_id, "context": self.context})
+        self.post(self.clients[0], "/api/update_all_questions", {
+            "project_id": self.project_id,
+            "project_title": "Benchmark project",
+            "sections": self.project["sections"],
+            "cells": self.project["cells"],
+            "deleted_cells": [],
+            "edited_cells": [],
+            "added_cells": list(self.project["cells"].keys())
+        })
+        # the topics are normally saved by generate_draft
+        db.edit_project_fields(self.project_id, {"analyze_topics_info": {
+            "topics": {topic: {"cells": [], "suggestion_rationale": ""}
+                       for topic in self.project["topics"] + ["Unclassified"]},
+            "summary": "",
+            "last_analyzed": "",
+            "suggestions": {}
+        }})
+        self.server.prompt_log.flush()
+
+    def tear_down(self):
+        """
+        Delete everything the benchmark wrote (also after a failed set_up)
+        """
+        self.server.prompt_log.flush()
+        db = self.server.db
+        if db.verify_user(self.user_id):
+            db.delete_user(self.user_id)
+        db.db.user_events.delete_many({"user_id": self.user_id})
+        db.db.events.delete_many({"meta.user_id": self.user_id})
+        if self.project_id is not None:
+            # the prompt blobs are shared by content with other prompts, so they are left in place
+            db.delete_prompts({"project_id": self.project_id})
+            # after delete_user, since deleting the project bumps its context version
+            self.server.project_contexts.forget(self.project_id)
+        for task_id in self.task_ids:
+            self.server.task_progress.delete(task_id)
+
+    def next_events(self, num_events):
+        """
+        Returns the next num_events synthetic events, with timeStamps after the ones of all the events returned before
+        """
+        with self.lock:
+            start_index = self.event_index
+            self.event_index += num_events
+        return make_events(num_events, start_index)
+
+    def make_request(self, endpoint, index):
+        """
+        Returns the path and the payload of one request to an endpoint
+        The payload can be a function that builds it when the request is sent
+        """
+        cells = self.project["cells"]
+        cell_ids = list(cells.keys())
+        if endpoint == "load_project":
+            return "/api/load_project", {"project_id": self.project_id}
+        if endpoint == "update_all_questions":
+            edited_cells = self.rng.sample(cell_ids, max(1, int(len(cell_ids) * EDITED_CELL_FRACTION)))
+            new_cells = copy.deepcopy(cells)
+            for cell_id in edited_cells:
+                new_cells[cell_id]["cell_details"]["main_text"] += f" (edit {index})"
+            return "/api/update_all_questions", {
+                "project_id": self.project_id, "project_title": "Benchmark project",
+                "sections": self.project["sections"], "cells": new_cells,
+                "deleted_cells": [], "edited_cells": edited_cells, "added_cells": []}
+        if endpoint == "generate_draft":
+            # submit_context runs the generate_draft task (in the request, since the tasks run eagerly)
+            return "/api/submit_context", {"project_id": self.project_id, "context": copy.deepcopy(self.context)}
+        if endpoint == "track_user_action":
+            # the events are made when the request is sent, since add_events drops events older than
+            # the last ones it stored and the clients don't send their requests in index order
+            return "/api/track_user_action", lambda: {
+                "user_code": self.user_id,
+                "events": {self.project_id: self.next_events(EVENTS_PER_REQUEST)}}
+        if endpoint == "check_question":
+            cell_id = cell_ids[index % len(cell_ids)]
+            return "/api/check_question", {"project_id": self.project_id, "cell_id": cell_id,
+                                           "cell_details": cells[cell_id]["cell_details"], "checks_to_ignore": []}
+        if endpoint == "analyze_topics":
+            # every topic is new, so every question is classified (the first analysis of a project)
+            return "/api/analyze_topics", {
+                "project_id": self.project_id,
+                "topics": {topic: {"cells": [], "suggestion_rationale": ""} for topic in self.project["topics"]},
+                "added_topics": list(self.project["topics"]), "edited_cells": [], "human_topics": {},
+                "last_analyzed": datetime.now().isoformat()}
+        if endpoint == "get_add_suggestions":
+            topic = self.project["topics"][index % len(self.project["topics"])]
+            existing_cell_ids = self.rng.sample(cell_ids, min(len(cell_ids), EXISTING_QUESTIONS_PER_TOPIC))
+            return "/api/get_add_suggestions", {
+                "project_id": self.project_id, "topic": topic, "sections": self.project["sections"],
+                "existing_questions": {cell_id: copy.deepcopy(cells[cell_id]["cell_details"])
+                                       for cell_id in existing_cell_ids}}
+        raise ValueError(f"Unknown endpoint {endpoint}")
+
+    def get_llm_calls(self):
+        backend = self.server.offline_backend
+        return backend.get_stats()["calls"] if backend is not None else 0
+
+    def run_endpoint(self, endpoint):
+        """
+        Send the requests to one endpoint and return its latency percentiles, throughput,
+        LLM calls per request and MongoDB commands per request
+        """
+        num_requests = max(1, int(self.requests_per_endpoint * ENDPOINT_REQUEST_FRACTION.get(endpoint, 1)))
+        requests = [self.make_request(endpoint, index) for index in range(num_requests)]
+        latencies = []
+        errors = []
+
+        def send_requests(client, client_requests):
+            for path, payload in client_requests:
+                if callable(payload):
+                    payload = payload()
+                start_time = time.perf_counter()
+                try:
+                    self.post(client, path, payload)
+                except Exception as e:
+                    with self.lock:
+                        errors.append(str(e))
+                    continue
+                with self.lock:
+                    latencies.append(time.perf_counter() - start_time)
+
+        llm_calls_before = self.get_llm_calls()
+        commands_before = self.command_counter.count
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=len(self.clients)) as executor:
+            futures = [executor.submit(send_requests, client, requests[i::len(self.clients)])
+                       for i, client in enumerate(self.clients)]
+            for future in futures:
+                future.result()
+        elapsed = time.perf_counter() - start_time
+        # the prompts are written in the background, so count their writes towards this endpoint
+        self.server.prompt_log.flush()
+
+        return {
+            "endpoint": endpoint,
+            "cells": self.num_cells,
+            "topics": self.num_topics,
+            "concurrency": len(self.clients),
+            "requests": num_requests,
+            "errors": len(errors),
+            "error_samples": errors[:3],
+            "p50_ms": percentile(latencies, 50) * 1000 if latencies else None,
+            "p95_ms": percentile(latencies, 95) * 1000 if latencies else None,
+            "p99_ms": percentile(latencies, 99) * 1000 if latencies else None,
+            "mean_ms": sum(latencies) / len(latencies) * 1000 if latencies else None,
+            "throughput_rps": len(latencies) / elapsed if elapsed > 0 else None,
+            "llm_calls_per_request": (self.get_llm_calls() - llm_calls_before) / num_requests,
+            "mongo_ops_per_request": (self.command_counter.count - commands_before) / num_requests
+        }
+
+    def run(self, endpoints=None):
+        endpoints = endpoints if endpoints is not None else ENDPOINTS
+        try:
+            self.set_up()
+            return [self.run_endpoint(endpoint) for endpoint in endpoints]
+        finally:
+            self.tear_down()
+
+
+def parse_size(size):
+    num_cells, num_topics = size.split(":")
+    return int(num_cells), int(num_topics)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the /api endpoints with the offline LLMs (run from the server folder: "
+                    "python -m benchmarks.run_benchmarks)")
+    parser.add_argument("--sizes", nargs="+", type=parse_size, default=PROJECT_SIZES,
+                        help="project sizes as cells:topics (default 10:5 50:10 200:20)")
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=ENDPOINTS)
+    parser.add_argument("--requests", type=int, default=REQUESTS_PER_ENDPOINT, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--llm-latency", type=float, default=LLM_LATENCY, help="mean seconds per LLM call")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--use-llm-cache", action="store_true",
+                        help="keep the LLM cache on (by default every request calls the offline LLMs)")
+    parser.add_argument("--mongodb-uri", default="mongodb://localhost:27017",
+                        help="MongoDB to run against (use a local one, the benchmark writes to it)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file for the JSON report (default: stdout)")
+    args = parser.parse_args()
+
+    # the server reads these when it's imported
+    os.environ["OFFLINE_LM"] = "1"
+    os.environ["MONGODB_URI"] = args.mongodb_uri
+    command_counter = CommandCounter()
+    monitoring.register(command_counter)
+
+    import dspy_accessor
+    import server
+
+    # run the Celery tasks in the request instead of sending them to a worker
+    server.celery.conf.task_always_eager = True
+    dspy_accessor.USE_LLM_CACHE = args.use_llm_cache
+    server.offline_backend.latency_mean = args.llm_latency
+    server.offline_backend.error_rate = args.llm_error_rate
+    server.offline_backend.seed = args.seed
+
+    results = []
+    for num_cells, num_topics in args.sizes:
+        print(f"Benchmarking a project with {num_cells} cells and {num_topics} topics", file=sys.stderr)
+        benchmarks = EndpointBenchmarks(server, command_counter, num_cells, num_topics,
+                                        concurrency=args.concurrency, requests_per_endpoint=args.requests,
+                                        seed=args.seed)
+        results.extend(benchmarks.run(args.endpoints))
+
+    report = {
+        "time": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "settings": {"requests_per_endpoint": args.requests, "concurrency": args.concurrency,
+                     "llm_latency": args.llm_latency, "llm_error_rate": args.llm_error_rate,
+                     "use_llm_cache": args.use_llm_cache, "seed": args.seed},
+        "results": results
+    }
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+
+if __name__ == '__main__':
+    main()
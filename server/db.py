@@ -1,15 +1,119 @@
 
 # Create a class called MongoDB that will be used to interact with the database
 
+import argparse
+import hashlib
 import json
-from datetime import datetime
+import zlib
+from datetime import datetime, timezone
+from bson.binary import Binary
 from bson.objectid import ObjectId
+from pymongo import ASCENDING, DeleteOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
 # from passwords import passphrase
 
+# options for collections that have to be created explicitly (created by ensure_indexes if they don't exist)
+COLLECTION_OPTIONS = {
+    # one document per user event, as a time series so the events are stored in time buckets
+    "events": {"timeseries": {"timeField": "received_at", "metaField": "meta", "granularity": "seconds"}}
+}
+
+# prompt inputs and outputs at least this large (in bytes) are stored in the prompt_blobs collection
+BLOB_MIN_SIZE = 2048
+BLOB_COMPRESSION_LEVEL = 6
+BLOB_KEY = "__blob__"  # key of a reference to a blob in a prompt document
+EXPORT_BATCH_SIZE = 500  # number of prompts rehydrated at a time when reading prompts
+ASSESSMENT_TTL = 30 * 24 * 60 * 60  # seconds an assessment is kept before MongoDB expires it
+
+# indexes for each collection (created by ensure_indexes, which is safe to run more than once)
+INDEXES = {
+    "users": [
+        {"keys": [("user_id", ASCENDING)], "unique": True}
+    ],
+    "cells": [
+        {"keys": [("cell_id", ASCENDING)], "unique": True},
+        {"keys": [("project_id", ASCENDING)]}
+    ],
+    "prompts": [
+        {"keys": [("project_id", ASCENDING), ("module_name", ASCENDING), ("time_created", ASCENDING)]}
+    ],
+    "user_events": [
+        {"keys": [("user_id", ASCENDING), ("project_id", ASCENDING)], "unique": True}
+    ],
+    "assessments": [
+        {"keys": [("key", ASCENDING)], "unique": True},
+        # TTL index, so the collection doesn't grow with every question ever checked
+        {"keys": [("created_at", ASCENDING)], "expireAfterSeconds": ASSESSMENT_TTL}
+    ],
+    "events": [
+        {"keys": [("meta.user_id", ASCENDING), ("meta.project_id", ASCENDING), ("received_at", ASCENDING)]}
+    ]
+}
+
+# queries that run on every request and must use an index (collection, filter, sort)
+HOT_QUERIES = [
+    ("users", {"user_id": ""}, None),
+    ("cells", {"cell_id": ""}, None),
+    ("cells", {"project_id": ""}, None),
+    ("prompts", {"project_id": "", "module_name": ""}, [("time_created", ASCENDING)]),
+    ("user_events", {"user_id": "", "project_id": ""}, None),
+    ("assessments", {"key": ""}, None),
+    ("events", {"meta.user_id": "", "meta.project_id": ""}, None)
+]
+
+def make_projection(fields):
+    """
+    Returns the projection for a list of fields (None returns the whole document)
+    Fields can be dotted paths to nested fields, e.g. "analyze_topics_info.suggestions"
+    """
+    if fields is None:
+        return None
+    projection = {field: 1 for field in fields}
+    if "_id" not in projection:
+        projection["_id"] = 0
+    return projection
+
+
+def get_nested_field(doc, field):
+    """
+    Returns a (possibly dotted) field from a document
+    """
+    for key in field.split("."):
+        doc = doc[key]
+    return doc
+
+
 class MongoDB:
-    def __init__(self, client):
-        self.client = client
-        self.db = client.flask_db
+    def __init__(self, client=None, client_factory=None):
+        """
+        Pass either a MongoClient or a client_factory (see mongo_client.py) that returns
+        the client of the current process (so each forked worker uses its own client)
+        """
+        self.static_client = client
+        self.client_factory = client_factory
+        # functions called with (project_id, fields) after the fields of a project change (see add_project_listener)
+        self.project_listeners = []
+
+    @property
+    def client(self):
+        if self.client_factory is not None:
+            return self.client_factory.get_client()
+        return self.static_client
+
+    @property
+    def db(self):
+        return self.client.flask_db
+
+    def add_project_listener(self, listener):
+        """
+        Registers a function that is called with (project_id, fields) after fields of a project change,
+        e.g. to invalidate caches. fields is the list of changed fields or None if the project was deleted
+        """
+        self.project_listeners.append(listener)
+
+    def notify_project_change(self, project_id, fields):
+        for listener in self.project_listeners:
+            listener(project_id, fields)
 
     # Functions for setting up the database
 
@@ -43,7 +147,11 @@ class MongoDB:
         - "cells"
         - "topic_suggestions"
         - "prompts"
-        - "user_events"
+        - "user_events" (one document per user and project with the last event timestamp,
+                         older documents also have the list of events)
+        - "events" (time series with one document per event)
+        - "prompt_blobs" (compressed large prompt inputs and outputs, referenced by hash)
+        - "assessments"
         """
 
         self.db.create_collection("users")
@@ -56,10 +164,81 @@ class MongoDB:
 
         self.db.create_collection("prompts")
 
+        self.db.create_collection("prompt_blobs")
+
         self.db.create_collection("user_events")
-        # set the user_id and project_id as the key for the user_events collection
-        self.db.user_events.create_index(
-            [("user_id", 1), ("project_id", 1)], unique=True)
+
+        self.db.create_collection("assessments")
+
+        # create the events collection and the indexes for all the collections
+        self.ensure_indexes()
+
+    def ensure_indexes(self):
+        """
+        Creates the collections in COLLECTION_OPTIONS and the indexes in INDEXES
+        (collections and indexes that already exist are left as they are)
+        Each index is created on its own, so one that fails (e.g. a unique index on a collection
+        with duplicates) doesn't stop the others
+        Returns the names of the created indexes and a list of (collection, keys, error) for the failed ones
+        """
+        existing_collections = self.db.list_collection_names()
+        for collection, options in COLLECTION_OPTIONS.items():
+            if collection not in existing_collections:
+                self.db.create_collection(collection, **options)
+
+        index_names = []
+        failures = []
+        for collection, indexes in INDEXES.items():
+            for index in indexes:
+                try:
+                    options = {"expireAfterSeconds": index["expireAfterSeconds"]} \
+                        if "expireAfterSeconds" in index else {}
+                    index_names.append(self.db[collection].create_index(
+                        index["keys"], unique=index.get("unique", False), **options))
+                except PyMongoError as e:
+                    failures.append((collection, index["keys"], e))
+        return index_names, failures
+
+    def get_query_plan_stages(self, collection, query, sort=None):
+        """
+        Returns the stages of the winning plan for a query (e.g. ["FETCH", "IXSCAN"])
+        """
+        cursor = self.db[collection].find(query)
+        if sort is not None:
+            cursor = cursor.sort(sort)
+        explain = cursor.explain()
+        if "queryPlanner" not in explain:
+            # before MongoDB 7.0, finds on time series collections are explained as an aggregation
+            # over the buckets collection, with the query planner in the first ($cursor) stage
+            explain = explain["stages"][0]["$cursor"]
+        plan = explain["queryPlanner"]["winningPlan"]
+
+        stages = []
+        plans = [plan]
+        while len(plans) > 0:
+            plan = plans.pop()
+            # sharded clusters wrap the plans of each shard
+            if "queryPlan" in plan:
+                plan = plan["queryPlan"]
+            stages.append(plan["stage"])
+            if "inputStage" in plan:
+                plans.append(plan["inputStage"])
+            plans.extend(plan.get("inputStages", []))
+            plans.extend(plan.get("shards", []))
+            if "winningPlan" in plan:
+                plans.append(plan["winningPlan"])
+        return stages
+
+    def check_query_plans(self):
+        """
+        Checks that none of the HOT_QUERIES use a collection scan
+        Returns a list of (collection, query) for the queries that do
+        """
+        collection_scans = []
+        for collection, query, sort in HOT_QUERIES:
+            if "COLLSCAN" in self.get_query_plan_stages(collection, query, sort):
+                collection_scans.append((collection, query))
+        return collection_scans
         
     def add_multiple_users(self, user_ids):
         """
@@ -181,49 +360,66 @@ class MongoDB:
     def add_user_project(self, user_id, project_id, project_title):
         """
         Appends a project id and title to the list of projects for the user
+        Returns False if the user doesn't exist or already has the project
         """
-        # get the user from the users collection
-        user = self.db.users.find_one({"user_id": user_id})
-        if user is None:
-            return None
-        # append the project id and title to the projects list
-        user["projects"].append(
-            {"project_id": project_id, "project_title": project_title})
-        # update the user in the users collection
-        self.db.users.update_one({"user_id": user_id}, {
-                                 "$set": {"projects": user["projects"]}})
+        return self.push_to_array("users", {"user_id": user_id}, "projects",
+                                  [{"project_id": project_id, "project_title": project_title}],
+                                  unique_field="project_id")
 
     def delete_user_project(self, user_id, project_id):
         """
         Deletes a project id and title from the list of projects for the user
+        Returns False if the user doesn't exist or doesn't have the project
         """
-        # get the user from the users collection
-        user = self.db.users.find_one({"user_id": user_id})
-        if user is None:
-            return None
-        # remove the project from the projects list
-        user["projects"] = [
-            project for project in user["projects"] if project["project_id"] != project_id]
-        # update the user in the users collection
-        self.db.users.update_one({"user_id": user_id}, {
-                                 "$set": {"projects": user["projects"]}})
+        return self.pull_from_array("users", {"user_id": user_id}, "projects",
+                                    {"project_id": project_id})
 
     def edit_project_title(self, user_id, project_id, new_title):
         """
         Replaces the project title for the user
+        Returns False if the user doesn't exist or doesn't have the project
         """
-        # get the user from the users collection
-        user = self.db.users.find_one({"user_id": user_id})
-        if user is None:
-            return None
-        # find the project in the projects list
-        for project in user["projects"]:
-            if project["project_id"] == project_id:
-                project["project_title"] = new_title
-                break
-        # update the user in the users collection
-        self.db.users.update_one({"user_id": user_id}, {
-            "$set": {"projects": user["projects"]}})
+        return self.set_in_array("users", {"user_id": user_id}, "projects",
+                                 {"project_id": project_id}, {"project_title": new_title})
+
+    # Functions for atomically changing arrays embedded in documents
+    # (one update per call, so concurrent changes to the same array don't overwrite each other)
+
+    def push_to_array(self, collection, query, array_field, items, unique_field=None):
+        """
+        Appends items to an array in the document matching query
+        If unique_field is set, nothing is appended when the array already has an item with the same
+        value for that field (only supported for one item at a time)
+        Returns True if the document was updated
+        """
+        if unique_field is not None:
+            if len(items) != 1:
+                raise ValueError("unique_field is only supported when pushing one item")
+            query = {**query, f"{array_field}.{unique_field}": {"$ne": items[0][unique_field]}}
+        result = self.db[collection].update_one(
+            query, {"$push": {array_field: {"$each": items}}})
+        return result.modified_count > 0
+
+    def pull_from_array(self, collection, query, array_field, condition):
+        """
+        Removes every item matching condition from an array in the document matching query
+        Returns True if the document was updated
+        """
+        result = self.db[collection].update_one(
+            query, {"$pull": {array_field: condition}})
+        return result.modified_count > 0
+
+    def set_in_array(self, collection, query, array_field, item_query, new_fields):
+        """
+        Replaces fields of the first item matching item_query in an array in the document matching query
+        item_query is a dictionary mapping from item field to value
+        Returns True if an item matched (even if its fields already had the new values)
+        """
+        # $elemMatch so all the fields have to match the same item (the one the positional $ updates)
+        query = {**query, array_field: {"$elemMatch": item_query}}
+        result = self.db[collection].update_one(
+            query, {"$set": {f"{array_field}.$.{field}": value for field, value in new_fields.items()}})
+        return result.matched_count > 0
 
     # Functions for interacting with the projects collection
 
@@ -249,12 +445,13 @@ class MongoDB:
         # print(str(result.inserted_id))
         return str(result.inserted_id)
 
-    def get_project(self, project_id):
+    def get_project(self, project_id, fields=None):
         """
         Returns a project from the projects collection
+        If fields is set, only those fields are returned (see make_projection)
         """
         # get the project from the projects collection
-        project = self.db.projects.find_one({"_id": ObjectId(project_id)})
+        project = self.db.projects.find_one({"_id": ObjectId(project_id)}, make_projection(fields))
         if project is None:
             return None
         # return the project
@@ -263,13 +460,24 @@ class MongoDB:
     def get_field_in_project(self, project_id, field):
         """
         Returns a field from a project in the projects collection
+        Only that field is fetched from MongoDB (field can be a dotted path)
         """
         # get the project from the projects collection
-        project = self.db.projects.find_one({"_id": ObjectId(project_id)})
+        project = self.get_project(project_id, [field])
         if project is None:
             return None
         # return the field
-        return project[field]
+        return get_nested_field(project, field)
+
+    def get_fields_in_project(self, project_id, fields):
+        """
+        Returns a dictionary mapping from field to value for a list of fields in a project
+        Only those fields are fetched from MongoDB (fields can be dotted paths)
+        """
+        project = self.get_project(project_id, fields)
+        if project is None:
+            return None
+        return {field: get_nested_field(project, field) for field in fields}
 
     def edit_project_fields(self, project_id, new_fields):
         """
@@ -283,6 +491,7 @@ class MongoDB:
             {"_id": ObjectId(project_id)},
             {"$set": new_fields}
         )
+        self.notify_project_change(project_id, list(new_fields.keys()))
 
     def delete_project(self, project_id):
         """
@@ -290,6 +499,7 @@ class MongoDB:
         """
         # delete the project from the projects collection
         self.db.projects.delete_one({"_id": ObjectId(project_id)})
+        self.notify_project_change(project_id, None)
 
     # NOTE: not needed for now
     # def duplicate_project(self, project_id, user_id):
@@ -300,6 +510,30 @@ class MongoDB:
 
     # Functions for interacting with the cells collection
 
+    def make_cell_doc(self, project_id, cell_id, cell_details, section_index,
+                      last_updated="", human_ai_status="human", ai_rationale="", time_estimate=0):
+        """
+        Returns the document for a new cell (see add_cell for the fields)
+        """
+        if last_updated == "":
+            last_updated = datetime.now().isoformat()
+            # print(last_updated)
+
+        return {
+            "project_id": project_id,
+            "cell_id": cell_id,
+            "cell_details": cell_details,
+            "section_index": section_index,
+            "last_updated": last_updated,
+            # "checks": [],
+            # "last_checked": "",
+            # "question_type": question_type,
+            # "is_ai_generated": is_ai_generated,
+            "human_ai_status": human_ai_status,
+            "ai_rationale": ai_rationale,
+            "time_estimate": time_estimate
+        }
+
     def add_cell(self, project_id, cell_id, cell_details, section_index,
                  last_updated="", human_ai_status="human", ai_rationale="", time_estimate=0):
         """
@@ -332,25 +566,10 @@ class MongoDB:
         if self.db.cells.find_one({"cell_id": cell_id}) is not None:
             return cell_id
 
-        if last_updated == "":
-            last_updated = datetime.now().isoformat()
-            # print(last_updated)
-
         # insert the cell into the cells collection
-        cell_doc = {
-            "project_id": project_id,
-            "cell_id": cell_id,
-            "cell_details": cell_details,
-            "section_index": section_index,
-            "last_updated": last_updated,
-            # "checks": [],
-            # "last_checked": "",
-            # "question_type": question_type,
-            # "is_ai_generated": is_ai_generated,
-            "human_ai_status": human_ai_status,
-            "ai_rationale": ai_rationale,
-            "time_estimate": time_estimate
-        }
+        cell_doc = self.make_cell_doc(project_id, cell_id, cell_details, section_index,
+                                      last_updated=last_updated, human_ai_status=human_ai_status,
+                                      ai_rationale=ai_rationale, time_estimate=time_estimate)
         result = self.db.cells.insert_one(cell_doc)
         # return the string representation of the ObjectId
         # return str(result.inserted_id)
@@ -381,12 +600,13 @@ class MongoDB:
         # delete all the cells for the project from the cells collection
         self.db.cells.delete_many({"project_id": project_id})
 
-    def get_cells(self, project_id):
+    def get_cells(self, project_id, fields=None):
         """
         Returns all cells from the cells collection for a project
+        If fields is set, only those fields are returned for each cell (see make_projection)
         """
         # get the cells from the cells collection
-        cells = self.db.cells.find({"project_id": project_id})
+        cells = self.db.cells.find({"project_id": project_id}, make_projection(fields))
         if cells is None:
             return None
         # return the cells
@@ -395,13 +615,88 @@ class MongoDB:
     def get_field_in_cell(self, cell_id, field):
         """
         Returns a field from a cell in the cells collection
+        Only that field is fetched from MongoDB (field can be a dotted path)
         """
         # get the cell from the cells collection
-        cell = self.db.cells.find_one({"cell_id": cell_id})
+        cell = self.db.cells.find_one({"cell_id": cell_id}, make_projection([field]))
         if cell is None:
             return None
         # return the field
-        return cell[field]
+        return get_nested_field(cell, field)
+
+    def get_fields_in_cell(self, cell_id, fields):
+        """
+        Returns a dictionary mapping from field to value for a list of fields in a cell
+        Only those fields are fetched from MongoDB (fields can be dotted paths)
+        """
+        cell = self.db.cells.find_one({"cell_id": cell_id}, make_projection(fields))
+        if cell is None:
+            return None
+        return {field: get_nested_field(cell, field) for field in fields}
+
+    # Functions for applying a batch of changes to a project
+
+    def apply_project_delta(self, project_id, project_fields, added_cells=None, edited_cells=None,
+                            deleted_cells=None, user_id=None, use_transaction=False):
+        """
+        Applies all the changes from one save of a project:
+
+        - project_fields: dictionary with the fields of the project to be replaced
+        - added_cells: dictionary mapping from cell_id to the arguments of add_cell (except project_id and cell_id)
+        - edited_cells: dictionary mapping from cell_id to the fields to be replaced
+        - deleted_cells: list of cell_ids
+        - user_id: if set and project_fields has the project title, the title is also set in the user's projects
+
+        The cells are changed with one ordered bulk_write and the project with one update
+        (plus one update of the user if the title is saved), optionally inside a transaction
+        (transactions need a replica set).
+        Added cells that already exist are left as they are (same as add_cell).
+
+        Returns the number of cells added, edited and deleted
+        """
+        added_cells = added_cells if added_cells is not None else {}
+        edited_cells = edited_cells if edited_cells is not None else {}
+        deleted_cells = deleted_cells if deleted_cells is not None else []
+
+        # build the cell operations in the same order as the one-by-one path: add, edit, delete
+        operations = []
+        for cell_id, cell in added_cells.items():
+            cell_doc = self.make_cell_doc(project_id, cell_id, **cell)
+            operations.append(UpdateOne({"cell_id": cell_id},
+                                        {"$setOnInsert": cell_doc}, upsert=True))
+        for cell_id, new_fields in edited_cells.items():
+            operations.append(UpdateOne({"cell_id": cell_id}, {"$set": new_fields}))
+        for cell_id in deleted_cells:
+            operations.append(DeleteOne({"cell_id": cell_id}))
+
+        def apply_changes(session=None):
+            result = None
+            if len(operations) > 0:
+                result = self.db.cells.bulk_write(operations, ordered=True, session=session)
+
+            project_result = self.db.projects.update_one(
+                {"_id": ObjectId(project_id)}, {"$set": project_fields}, session=session)
+            # always sync the title in the user's projects, so a copy that got out of sync is repaired on save
+            if user_id is not None and project_result.matched_count > 0 and "project_title" in project_fields:
+                self.db.users.update_one(
+                    {"user_id": user_id, "projects.project_id": project_id},
+                    {"$set": {"projects.$.project_title": project_fields["project_title"]}},
+                    session=session
+                )
+
+            return {
+                "added": result.upserted_count if result is not None else 0,
+                "edited": result.modified_count if result is not None else 0,
+                "deleted": result.deleted_count if result is not None else 0
+            }
+
+        if not use_transaction:
+            counts = apply_changes()
+        else:
+            with self.client.start_session() as session:
+                counts = session.with_transaction(apply_changes)
+        self.notify_project_change(project_id, list(project_fields.keys()))
+        return counts
 
     # Functions for interacting with the prompts collection
 
@@ -414,10 +709,18 @@ class MongoDB:
         - "prompt_inputs": dictionary
         - "prompt_outputs": dictionary
         - "time_created": timestamp
+        - "offline": True for outputs of the offline LLMs (only set on those, see offline_lm.py)
 
         NOTE: the prompts collection will only be used for analysis
         """
         # insert the prompt into the prompts collection
+        prompt_doc = self.make_prompt_doc(project_id, module_name, prompt_inputs, prompt_outputs)
+        self.add_prompts([prompt_doc])
+
+    def make_prompt_doc(self, project_id, module_name, prompt_inputs, prompt_outputs, offline=False):
+        """
+        Returns the document for a prompt (see add_prompt for the fields)
+        """
         prompt_doc = {
             "project_id": project_id,
             "module_name": module_name,
@@ -425,35 +728,268 @@ class MongoDB:
             "prompt_outputs": prompt_outputs,
             "time_created": datetime.now().isoformat()
         }
-        self.db.prompts.insert_one(prompt_doc)
+        if offline:
+            prompt_doc["offline"] = True
+        return prompt_doc
+
+    def add_prompts(self, prompt_docs):
+        """
+        Inserts a list of prompt documents (from make_prompt_doc) into the prompts collection
+        Large inputs and outputs are moved to the prompt_blobs collection (see compact_prompt_value)
+        """
+        blobs = {}
+        compacted_docs = []
+        for prompt_doc in prompt_docs:
+            compacted_doc = dict(prompt_doc)
+            compacted_doc["prompt_inputs"] = self.compact_prompt_value(prompt_doc["prompt_inputs"], blobs)
+            compacted_doc["prompt_outputs"] = self.compact_prompt_value(prompt_doc["prompt_outputs"], blobs)
+            compacted_docs.append(compacted_doc)
+
+        # the blobs are content-addressed, so a blob that already exists is left as it is
+        if len(blobs) > 0:
+            self.db.prompt_blobs.bulk_write([
+                UpdateOne({"_id": blob_hash}, {"$setOnInsert": blob}, upsert=True)
+                for blob_hash, blob in blobs.items()
+            ], ordered=False)
+        self.db.prompts.insert_many(compacted_docs, ordered=False)
+
+    def compact_prompt_value(self, value, blobs):
+        """
+        Replaces large values with a reference to a blob: {"__blob__": sha256 of the value}
+        If value is a dictionary, each of its values is compacted on its own (so e.g. the context
+        is shared by every prompt that uses it), otherwise the whole value is compacted.
+        New blobs are added to blobs (dictionary mapping from hash to blob document)
+        """
+        if isinstance(value, dict):
+            return {key: self.compact_prompt_value(item, blobs) if isinstance(item, (str, list, dict)) else item
+                    for key, item in value.items()}
+
+        if isinstance(value, str):
+            value_format = "text"
+            data = value.encode("utf-8")
+        else:
+            value_format = "json"
+            data = json.dumps(value, sort_keys=True).encode("utf-8")
+        if len(data) < BLOB_MIN_SIZE:
+            return value
+
+        blob_hash = hashlib.sha256(data).hexdigest()
+        if blob_hash not in blobs:
+            blobs[blob_hash] = {
+                "format": value_format,
+                "encoding": "zlib",
+                "size": len(data),
+                "data": Binary(zlib.compress(data, BLOB_COMPRESSION_LEVEL)),
+                "time_created": datetime.now().isoformat()
+            }
+        return {BLOB_KEY: blob_hash}
+
+    def rehydrate_prompt_value(self, value, blob_values):
+        """
+        Replaces the blob references in a value with the original values
+        blob_values is a dictionary mapping from hash to value (see get_blob_values)
+        Raises KeyError if a referenced blob is missing, instead of silently returning None for it
+        """
+        if isinstance(value, dict):
+            if BLOB_KEY in value:
+                if value[BLOB_KEY] not in blob_values:
+                    raise KeyError(f"Prompt blob {value[BLOB_KEY]} is missing from the prompt_blobs collection")
+                return blob_values[value[BLOB_KEY]]
+            return {key: self.rehydrate_prompt_value(item, blob_values) for key, item in value.items()}
+        return value
+
+    def get_blob_hashes(self, value):
+        """
+        Returns the hashes of the blobs referenced in a value
+        """
+        if isinstance(value, dict):
+            if BLOB_KEY in value:
+                return [value[BLOB_KEY]]
+            return [blob_hash for item in value.values() for blob_hash in self.get_blob_hashes(item)]
+        return []
+
+    def get_blob_values(self, blob_hashes):
+        """
+        Returns a dictionary mapping from hash to the decompressed value for a list of blob hashes
+        """
+        blob_values = {}
+        for blob in self.db.prompt_blobs.find({"_id": {"$in": list(set(blob_hashes))}}):
+            data = zlib.decompress(blob["data"]).decode("utf-8")
+            blob_values[blob["_id"]] = data if blob["format"] == "text" else json.loads(data)
+        return blob_values
+
+    def delete_prompts(self, query):
+        """
+        Deletes the prompts matching query
+        Their blobs are left in the prompt_blobs collection: blobs are shared by content with other prompts
+        (including ones being written concurrently), so unreferenced blobs are left to an offline maintenance job
+        Returns the number of deleted prompts
+        """
+        return self.db.prompts.delete_many(query).deleted_count
+
+    def get_prompts(self, query=None, batch_size=EXPORT_BATCH_SIZE, include_offline=False):
+        """
+        Generator with the prompts matching query with the original (rehydrated) inputs and outputs
+        The blobs for each batch of prompts are fetched with one query
+        Prompts with outputs of the offline LLMs are skipped unless include_offline is set
+        """
+        query = dict(query) if query is not None else {}
+        if not include_offline:
+            query["offline"] = {"$ne": True}
+        cursor = self.db.prompts.find(query, {"_id": 0}).batch_size(batch_size)
+        batch = []
+        for prompt in cursor:
+            batch.append(prompt)
+            if len(batch) == batch_size:
+                yield from self.rehydrate_prompts(batch)
+                batch = []
+        if len(batch) > 0:
+            yield from self.rehydrate_prompts(batch)
+
+    def rehydrate_prompts(self, prompts):
+        """
+        Rehydrates the inputs and outputs of a list of prompts
+        """
+        blob_hashes = [blob_hash for prompt in prompts
+                       for field in ["prompt_inputs", "prompt_outputs"]
+                       for blob_hash in self.get_blob_hashes(prompt.get(field))]
+        blob_values = self.get_blob_values(blob_hashes) if len(blob_hashes) > 0 else {}
+        for prompt in prompts:
+            prompt["prompt_inputs"] = self.rehydrate_prompt_value(prompt.get("prompt_inputs"), blob_values)
+            prompt["prompt_outputs"] = self.rehydrate_prompt_value(prompt.get("prompt_outputs"), blob_values)
+        return prompts
+
+    # Functions for interacting with the assessments collection
+
+    def get_assessment(self, key):
+        """
+        Returns the stored output of an assess module or None if there is no assessment for the key
+        """
+        assessment = self.db.assessments.find_one({"key": key}, {"_id": 0, "output": 1})
+        if assessment is None:
+            return None
+        return assessment["output"]
+
+    def add_assessment(self, key, check_name, version, output):
+        """
+        Inserts an assessment into the assessments collection, with the following fields:
+
+        - "key": string (hash of the normalized question, check name, reading level and prompts version)
+        - "check_name": string
+        - "version": string
+        - "output": dictionary
+        - "time_created": timestamp
+        - "created_at": date (expired by the TTL index after ASSESSMENT_TTL seconds)
+        """
+        # upsert so concurrent checks of the same question don't fail on the unique index
+        self.db.assessments.update_one(
+            {"key": key},
+            {"$setOnInsert": {"key": key,
+                              "check_name": check_name,
+                              "version": version,
+                              "output": output,
+                              "time_created": datetime.now().isoformat(),
+                              "created_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
 
     # Functions for interacting with the user_events collection
 
     def add_events(self, user_id, project_id, new_events):
         """
         Appends a list of events to the user events for a project
+
+        Each event is inserted as its own document in the events collection, so the cost doesn't
+        depend on the number of events that were already saved. The user_events document keeps the
+        timeStamp of the last event, and only events newer than it are inserted (so retries don't
+        add duplicates). The timestamp is updated atomically with $max before the insert, and moved back
+        to the last inserted event if the insert fails, so the client's retry isn't dropped.
         """
-        # get the user events from the user_events collection
-        user_events = self.db.user_events.find_one(
-            {"user_id": user_id, "project_id": project_id})
-        if user_events is None:
-            # if the user events don't exist, create them
-            user_events = {"user_id": user_id,
-                           "project_id": project_id, "events": new_events}
-            self.db.user_events.insert_one(user_events)
+        if len(new_events) == 0:
             return
+
+        # move the last timeStamp forward and get the previous one
+        new_last_timeStamp = max(event["timeStamp"] for event in new_events)
+        previous = self.db.user_events.find_one_and_update(
+            {"user_id": user_id, "project_id": project_id},
+            {"$max": {"last_timeStamp": new_last_timeStamp}},
+            projection={"last_timeStamp": 1, "events": {"$slice": -1}},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+
+        if previous is None:
+            # if the user events don't exist, add all the events
+            events_to_add = new_events
         else:
-            # go through new_events and append them if their timeStamp is greater than the last event in the list
+            # older documents keep the events in a list and don't have a last_timeStamp
+            last_timeStamp = previous.get("last_timeStamp")
+            if last_timeStamp is None and len(previous.get("events", [])) > 0:
+                last_timeStamp = previous["events"][-1]["timeStamp"]
+            # go through new_events and add them if their timeStamp is greater than the last event
+            events_to_add = []
             for event in new_events:
-                if len(user_events["events"]) == 0 or event["timeStamp"] > user_events["events"][-1]["timeStamp"]:
-                    user_events["events"].append(event)
-            # # append the events to the events list
-            # user_events["events"] += new_events
-            # update the user events in the user_events collection
-            self.db.user_events.update_one(
-                {"user_id": user_id, "project_id": project_id},
-                {"$set": {"events": user_events["events"]}}
-            )
+                if last_timeStamp is None or event["timeStamp"] > last_timeStamp:
+                    events_to_add.append(event)
+                    last_timeStamp = event["timeStamp"]
+
+        if len(events_to_add) == 0:
+            return
+
+        received_at = datetime.now()
+        try:
+            # ordered, so the events before a failed one are the ones that were inserted
+            self.db.events.insert_many([{
+                "received_at": received_at,
+                "meta": {"user_id": user_id, "project_id": project_id},
+                "event": event
+            } for event in events_to_add], ordered=True)
+        except PyMongoError as e:
+            num_inserted = e.details.get("nInserted", 0) if isinstance(e, BulkWriteError) else 0
+            self.reset_last_timeStamp(user_id, project_id, new_last_timeStamp,
+                                      events_to_add[num_inserted - 1]["timeStamp"] if num_inserted > 0
+                                      else (previous or {}).get("last_timeStamp"))
+            raise
+
+    def reset_last_timeStamp(self, user_id, project_id, claimed_timeStamp, last_timeStamp):
+        """
+        Moves the last timeStamp of the user events back to last_timeStamp (None removes it)
+        if no later add_events moved it past claimed_timeStamp
+        """
+        update = {"$set": {"last_timeStamp": last_timeStamp}} if last_timeStamp is not None \
+            else {"$unset": {"last_timeStamp": ""}}
+        self.db.user_events.update_one(
+            {"user_id": user_id, "project_id": project_id, "last_timeStamp": claimed_timeStamp}, update)
+
+    def get_user_events(self, query=None):
+        """
+        Returns a list of {"user_id", "project_id", "events"} with all the events for each user and project
+        Combines the events in the events collection with the lists of events in older user_events documents
+        query is an optional filter on user_id and project_id
+        """
+        query = query if query is not None else {}
+        user_events = {}
+
+        # events from the older documents
+        for user_event in self.db.user_events.find(query, {"_id": 0, "user_id": 1, "project_id": 1, "events": 1}):
+            key = (user_event["user_id"], user_event["project_id"])
+            user_events[key] = {"user_id": user_event["user_id"],
+                                "project_id": user_event["project_id"],
+                                "events": user_event.get("events", [])}
+
+        # events from the events collection
+        events_query = {f"meta.{field}": value for field, value in query.items()}
+        for event_doc in self.db.events.find(events_query).sort("received_at", ASCENDING):
+            key = (event_doc["meta"]["user_id"], event_doc["meta"]["project_id"])
+            if key not in user_events:
+                user_events[key] = {"user_id": key[0], "project_id": key[1], "events": []}
+            user_events[key]["events"].append(event_doc["event"])
+
+        # sort the events in each list by timeStamp
+        for user_event in user_events.values():
+            user_event["events"].sort(key=lambda event: event["timeStamp"])
+
+        return list(user_events.values())
 
     # Functions for saving data from the database to a file
 
@@ -461,17 +997,8 @@ class MongoDB:
         """
         Saves all prompts to a file in JSON format
         """
-        # get all prompts from the prompts collection
-        prompts = self.db.prompts.find({})
-        if prompts is None:
-            return
-        
-        cleaned_prompts = []
-        
-        # remove all the ObjectIds
-        for prompt in prompts:
-            prompt.pop("_id")
-            cleaned_prompts.append(prompt)
+        # get all prompts from the prompts collection (without the ObjectIds and with the blobs rehydrated)
+        cleaned_prompts = list(self.get_prompts())
         
         # get date for the file name
         timestamp = datetime.today().strftime('%Y-%m-%d')
@@ -484,17 +1011,8 @@ class MongoDB:
         """
         Saves all user events to a file in JSON format
         """
-        # get all user events from the user_events collection
-        user_events = self.db.user_events.find({})
-        if user_events is None:
-            return
-        
-        cleaned_user_events = []
-        
-        # remove all the ObjectIds
-        for user_event in list(user_events):
-            user_event.pop("_id")
-            cleaned_user_events.append(user_event)
+        # get all user events from the user_events and events collections
+        cleaned_user_events = self.get_user_events()
 
         # get timestamp for the file
         timestamp = datetime.today().strftime('%Y-%m-%d')
@@ -515,16 +1033,17 @@ class MongoDB:
         # drop the _id field
         project.pop("_id")
 
+        # get all the cells of the project with one query
+        cell_ids = [cell_id for section in project["sections"] for cell_id in section["cells"]]
+        cells = {cell["cell_id"]: cell for cell in self.db.cells.find({"cell_id": {"$in": cell_ids}}, {"_id": 0})}
+
         # add cells to the project
         processed_sections = []
         for section in project["sections"]:
             section_doc = {"id": section["id"], "title": section["title"], "cells": []}
             for cell_id in section["cells"]:
-                cell = self.db.cells.find_one({"cell_id": cell_id})
-                if cell is not None:
-                    # drop the _id field
-                    cell.pop("_id")
-                    section_doc["cells"].append(cell)
+                if cell_id in cells:
+                    section_doc["cells"].append(cells[cell_id])
             processed_sections.append(section_doc)
 
         project["sections_with_cells"] = processed_sections
@@ -553,3 +1072,30 @@ class MongoDB:
         # save the project to the file
         with open(f"{file_path}/{timestamp}_projects_{user_id}.json", "w") as f:
             json.dump(cleaned_projects, f, indent=4)
+
+
+if __name__ == '__main__':
+    # create the indexes and check the query plans from the command line
+    from pymongo.mongo_client import MongoClient
+    from pymongo.server_api import ServerApi
+    from passwords import mongodb_uri
+
+    parser = argparse.ArgumentParser(description="Manage the MongoDB indexes")
+    parser.add_argument("command", choices=["ensure_indexes", "check_query_plans"])
+    args = parser.parse_args()
+
+    db = MongoDB(MongoClient(mongodb_uri, server_api=ServerApi('1')))
+
+    failures = []
+    if args.command == "ensure_indexes":
+        index_names, failures = db.ensure_indexes()
+        print("Indexes: %s" % index_names)
+        for collection, keys, error in failures:
+            print("Failed to create index %s on %s: %s" % (keys, collection, error))
+
+    collection_scans = db.check_query_plans()
+    for collection, query in collection_scans:
+        print("Collection scan in %s for %s" % (collection, list(query.keys())))
+    if len(failures) > 0 or len(collection_scans) > 0:
+        raise SystemExit(1)
+    print("All hot queries use an index")
@@ -1,3 +1,5 @@
+import asyncio
+import copy
 import json
 import time
 from enum import Enum
@@ -5,13 +7,39 @@ import re
 import threading
 
 import dspy
+import openai
+from assessment_store import AssessmentStore
 from dspy_modules import *
+from llm_cache import LLMCache, make_cache_key
+from llm_executor import LLMExecutor, ModelExecutor
+from llm_metrics import LLMMetrics, record_rate_limit_retry, record_usage
 from passwords import open_ai_api_key
+from rate_limiter import RateLimiter, call_with_backoff, estimate_tokens
 
 GPT3_MODEL = 'gpt-3.5-turbo'
 # GPT4_MODEL = 'gpt-4-0125-preview'
 GPT4_MODEL = 'gpt-4o-2024-05-13'
 MAX_TRIES = 5
+# errors of an OpenAI request that are retried with backoff (rate limits and transient server/network errors)
+RETRY_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError,
+                openai.InternalServerError)
+USE_LLM_CACHE = True
+USE_N_COMPLETIONS = True # get the outputs for invoke_module_multiple_times from one request with n completions
+MAX_CONCURRENT_CALLS = 32 # max number of in-flight LLM calls for one gather_with_limit
+# max number of concurrent calls to each model across the whole worker process
+MODEL_CONCURRENCY = {
+    GPT3_MODEL: 16,
+    GPT4_MODEL: 8
+}
+# requests per minute and tokens per minute budgets for each model
+# NOTE: keep these a bit below the organization's OpenAI limits
+RATE_LIMITS = {
+    GPT3_MODEL: {"rpm": 3000, "tpm": 150000},
+    GPT4_MODEL: {"rpm": 450, "tpm": 270000}
+}
+# batched topic classification: max estimated tokens of questions and max number of questions per call
+MAX_BATCH_TOKENS = 3000
+MAX_BATCH_SIZE = 25
 
 
 class DSPyModule(Enum):
@@ -30,30 +58,92 @@ class DSPyModule(Enum):
     CREATE_DRAFT = "CreateDraftModule"
     DETECT_TOPICS = "DetectTopicsModule"
     CLASSIFY_TOPICS = "ClassifyTopicsModule"
+    CLASSIFY_TOPICS_BATCH = "ClassifyTopicsBatchModule"
     ADD_QUESTIONS_TO_TOPIC = "AddQuestionsToTopicModule"
     REMOVE_QUESTIONS_FROM_TOPIC = "RemoveQuestionsInTopicModule"
 
 
-MODULES = {
-    DSPyModule.REWORD_QUESTION_FROM_REQUEST: RewordQuestionFromRequestModule(),
-    DSPyModule.REWORD_QUESTION: RewordQuestionModule(),
-    DSPyModule.SWITCH_RESPONSE_FORMAT: SwitchResponseFormatModule(),
-    DSPyModule.ASSESS_READABILITY: AssessReadabilityModule(),
-    DSPyModule.ASSESS_BIAS: AssessBiasModule(),
-    DSPyModule.ASSESS_SPECIFICITY: AssessSpecificityModule(),
-    DSPyModule.CLEAN_RATIONALE: CleanRationaleModule(),
-    DSPyModule.REWRITE_QUESTION: RewriteQuestionModule(),
-    DSPyModule.CHECK_QUESTION: CheckQuestionModule(),
-    DSPyModule.ASSESS_QUESTIONS: AssessQuestionsModule(),
-    DSPyModule.CLASSIFY_QUESTION: ClassifyQuestionTypeModule(),
-    DSPyModule.CHECK_PROMPT: CheckPromptModule(),
-    DSPyModule.CREATE_DRAFT: CreateDraftModule(),
-    DSPyModule.DETECT_TOPICS: DetectTopicsModule(),
-    DSPyModule.CLASSIFY_TOPICS: ClassifyTopicsModule(),
-    DSPyModule.ADD_QUESTIONS_TO_TOPIC: AddQuestionsToTopicModule(),
-    DSPyModule.REMOVE_QUESTIONS_FROM_TOPIC: RemoveQuestionsInTopicModule()
+# class of each module (the modules are created on first use, see ModuleRegistry)
+MODULE_CLASSES = {
+    DSPyModule.REWORD_QUESTION_FROM_REQUEST: RewordQuestionFromRequestModule,
+    DSPyModule.REWORD_QUESTION: RewordQuestionModule,
+    DSPyModule.SWITCH_RESPONSE_FORMAT: SwitchResponseFormatModule,
+    DSPyModule.ASSESS_READABILITY: AssessReadabilityModule,
+    DSPyModule.ASSESS_BIAS: AssessBiasModule,
+    DSPyModule.ASSESS_SPECIFICITY: AssessSpecificityModule,
+    DSPyModule.CLEAN_RATIONALE: CleanRationaleModule,
+    DSPyModule.REWRITE_QUESTION: RewriteQuestionModule,
+    DSPyModule.CHECK_QUESTION: CheckQuestionModule,
+    DSPyModule.ASSESS_QUESTIONS: AssessQuestionsModule,
+    DSPyModule.CLASSIFY_QUESTION: ClassifyQuestionTypeModule,
+    DSPyModule.CHECK_PROMPT: CheckPromptModule,
+    DSPyModule.CREATE_DRAFT: CreateDraftModule,
+    DSPyModule.DETECT_TOPICS: DetectTopicsModule,
+    DSPyModule.CLASSIFY_TOPICS: ClassifyTopicsModule,
+    DSPyModule.CLASSIFY_TOPICS_BATCH: ClassifyTopicsBatchModule,
+    DSPyModule.ADD_QUESTIONS_TO_TOPIC: AddQuestionsToTopicModule,
+    DSPyModule.REMOVE_QUESTIONS_FROM_TOPIC: RemoveQuestionsInTopicModule
 }
 
+# modules that are built from other modules: keyword argument of the constructor -> module that is passed in
+# (so the composite modules share one instance of each assess module with the rest of the registry)
+SHARED_SUBMODULES = {
+    DSPyModule.CHECK_QUESTION: {
+        "assess_readability": DSPyModule.ASSESS_READABILITY,
+        "assess_bias": DSPyModule.ASSESS_BIAS,
+        "assess_specificity": DSPyModule.ASSESS_SPECIFICITY,
+        "clean_rationale": DSPyModule.CLEAN_RATIONALE,
+        "rewrite": DSPyModule.REWRITE_QUESTION
+    },
+    DSPyModule.ASSESS_QUESTIONS: {
+        "assess_readability": DSPyModule.ASSESS_READABILITY,
+        "assess_bias": DSPyModule.ASSESS_BIAS,
+        "assess_specificity": DSPyModule.ASSESS_SPECIFICITY
+    }
+}
+
+
+class ModuleRegistry:
+    """
+    Creates each DSPy module on first use (some modules load a compiled module from disk when they are created)
+    and keeps one instance of it for the whole process.
+    warm_up() creates modules ahead of time, e.g. in the Celery parent process so the forked workers share them.
+    """
+
+    def __init__(self, module_classes, shared_submodules=None):
+        self.module_classes = module_classes
+        self.shared_submodules = shared_submodules if shared_submodules is not None else {}
+        self.modules = {}
+        # reentrant since creating a composite module creates its submodules
+        self.lock = threading.RLock()
+
+    def __getitem__(self, module_name):
+        module = self.modules.get(module_name)
+        if module is not None:
+            return module
+        with self.lock:
+            if module_name not in self.modules:
+                submodules = {argument: self[submodule_name] for argument, submodule_name
+                              in self.shared_submodules.get(module_name, {}).items()}
+                self.modules[module_name] = self.module_classes[module_name](**submodules)
+            return self.modules[module_name]
+
+    def is_loaded(self, module_name):
+        return module_name in self.modules
+
+    def warm_up(self, module_names=None):
+        """
+        Create the modules in module_names (all of them if None) and return the names of the modules created
+        """
+        module_names = module_names if module_names is not None else list(self.module_classes.keys())
+        created = [module_name for module_name in module_names if not self.is_loaded(module_name)]
+        for module_name in module_names:
+            self[module_name]
+        return created
+
+
+MODULES = ModuleRegistry(MODULE_CLASSES, SHARED_SUBMODULES)
+
 OUTPUT_FORMATS = {
     DSPyModule.REWORD_QUESTION_FROM_REQUEST: "list",
     DSPyModule.REWORD_QUESTION: "list",
@@ -70,27 +160,125 @@ OUTPUT_FORMATS = {
     DSPyModule.CHECK_PROMPT: "string",
     DSPyModule.DETECT_TOPICS: "string",
     DSPyModule.CLASSIFY_TOPICS: "string",
+    DSPyModule.CLASSIFY_TOPICS_BATCH: "json",
     DSPyModule.ADD_QUESTIONS_TO_TOPIC: "list",
     DSPyModule.REMOVE_QUESTIONS_FROM_TOPIC: "list"
 }
 
+# modules that only orchestrate other modules (they don't hold a model slot themselves)
+COMPOSITE_MODULES = [DSPyModule.CHECK_QUESTION, DSPyModule.ASSESS_QUESTIONS]
+
+# modules whose forward() takes n and returns a list of n outputs when n > 1
+N_COMPLETIONS_MODULES = [DSPyModule.CLASSIFY_TOPICS]
+
+
+class RateLimitedOpenAI(dspy.OpenAI):
+    """
+    dspy.OpenAI that waits for the rate limiter before each request
+    and retries rate limit and transient errors (RETRY_ERRORS) with exponential backoff (honoring Retry-After)
+
+    Chat requests skip dspy's own request cache (the module outputs are cached by LLMCache), so every
+    request that reaches the rate limiter and the LLM metrics is a real (billed) request to OpenAI.
+    """
+
+    def __init__(self, rate_limiter, **kwargs):
+        super().__init__(**kwargs)
+        self.rate_limiter = rate_limiter
+
+    def basic_request(self, prompt, **kwargs):
+        if self.model_type != "chat":
+            return super().basic_request(prompt, **kwargs)
+
+        # same request and history as dspy.OpenAI.basic_request, without the cached request functions
+        raw_kwargs = kwargs
+        kwargs = {**self.kwargs, **kwargs}
+        kwargs["messages"] = [{"role": "user", "content": prompt}]
+        response = openai.chat.completions.create(**kwargs).model_dump()
+        self.history.append({
+            "prompt": prompt,
+            "response": response,
+            "kwargs": kwargs,
+            "raw_kwargs": raw_kwargs,
+        })
+        return response
+
+    def request(self, prompt, **kwargs):
+        if "model_type" in kwargs:
+            del kwargs["model_type"]
+
+        # OpenAI counts the prompt plus max_tokens for every completion towards the TPM limit
+        model = self.kwargs["model"]
+        num_completions = kwargs.get("n", self.kwargs.get("n", 1))
+        completion_budget = kwargs.get(
+            "max_tokens", self.kwargs["max_tokens"]) * num_completions
+        rate_limit_wait = self.rate_limiter.acquire(
+            model, estimate_tokens(prompt) + completion_budget)
+
+        response = call_with_backoff(lambda: self.basic_request(prompt, **kwargs),
+                                     RETRY_ERRORS,
+                                     on_retry=lambda error, delay: record_rate_limit_retry()
+                                     if isinstance(error, openai.RateLimitError) else None)
+
+        # give back the part of the completion budget that wasn't used
+        usage = response.get("usage") if isinstance(response, dict) else None
+        if usage is not None and usage.get("completion_tokens") is not None:
+            self.rate_limiter.refund(
+                model, completion_budget - usage["completion_tokens"])
+
+        # count the tokens towards the module invocation that sent the request
+        if usage is not None:
+            record_usage(model, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), rate_limit_wait)
+        else:
+            record_usage(model, estimate_tokens(prompt), 0, rate_limit_wait)
+
+        return response
+
 
 class DSPyAccessor:
 
-    def __init__(self, flask_app):
+    def __init__(self, flask_app, shared_cache=None, model_concurrency=None, rate_limiter=None, db=None,
+                 offline_backend=None, metrics=None):
         self.flask_app = flask_app
+        # wall time, queue wait, tokens, retries and cost of every module invocation (see llm_metrics.py)
+        self.metrics = metrics if metrics is not None else LLMMetrics(
+            logger=flask_app.logger if flask_app is not None else None)
+        # optional OfflineBackend (see offline_lm.py) that replaces the LLMs for load testing
+        self.offline_backend = offline_backend
+        self.modules = offline_backend.make_registry() if offline_backend is not None else MODULES
+        # cache for module outputs (shared_cache is an optional RedisCacheTier or DiskCacheTier)
+        self.llm_cache = LLMCache(shared_tier=shared_cache)
+        # store for the assess module outputs used by the composite modules (persisted in MongoDB if db is set)
+        # (offline outputs are stored under another version so they never mix with the real ones)
+        self.assessment_store = AssessmentStore(
+            PROMPTS_VERSION if offline_backend is None else f"{PROMPTS_VERSION}:offline", db=db)
+        # shared executor that caps the number of concurrent calls to each model
+        self.executor = LLMExecutor(
+            model_concurrency if model_concurrency is not None else MODEL_CONCURRENCY)
         # if self.flask_app is not None:
         #     self.flask_app.logger.info("Initializing DSPyAccessor")
-        self.gpt3_turbo = dspy.OpenAI(
-            model=GPT3_MODEL, max_tokens=4096, api_key=open_ai_api_key)
-        self.gpt4 = dspy.OpenAI(
+        # rate limiter for the RPM and TPM budgets (pass a RedisRateLimiter to share it across workers)
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter(RATE_LIMITS)
+        self.gpt3_turbo = RateLimitedOpenAI(
+            self.rate_limiter, model=GPT3_MODEL, max_tokens=4096, api_key=open_ai_api_key)
+        self.gpt4 = RateLimitedOpenAI(
             # NOTE: could increase max_tokens to 128K for GPT-4
-            model=GPT4_MODEL, max_tokens=4096, api_key=open_ai_api_key)
+            self.rate_limiter, model=GPT4_MODEL, max_tokens=4096, api_key=open_ai_api_key)
         # set the default model to GPT-3.5-turbo
         dspy.configure(lm=self.gpt3_turbo)
 
     def get_module(self, module_name):
-        return MODULES[module_name]
+        return self.modules[module_name]
+
+    def warm_up(self, module_names=None):
+        """
+        Create the modules in module_names (all of them if None) before they are first used
+        """
+        start_time = time.time()
+        created = self.modules.warm_up(module_names)
+        if self.flask_app is not None:
+            self.flask_app.logger.info("Created %s DSPy modules in %.2f seconds",
+                                       len(created), time.time() - start_time)
+        return created
 
     def get_model_history(self, is_gpt4=False, n=1):
         if is_gpt4:
@@ -98,15 +286,75 @@ class DSPyAccessor:
         else:
             return self.gpt3_turbo.inspect_history(n)
 
+    def get_model_name(self, module_name, is_gpt4=False):
+        """
+        Get the name of the model(s) used by a module invocation
+        """
+        if is_gpt4:
+            return GPT4_MODEL
+        # CHECK_QUESTION uses GPT-3.5 for the checks and GPT-4 for the rewrite
+        if module_name == DSPyModule.CHECK_QUESTION:
+            return f"{GPT3_MODEL}+{GPT4_MODEL}"
+        return GPT3_MODEL
+
+    def get_cache_key(self, module_name, is_gpt4=False, **kwargs):
+        """
+        Get the cache key for a module invocation
+        """
+        model_name = self.get_model_name(module_name, is_gpt4)
+        # keep the offline outputs out of the cache entries of the real models
+        if self.offline_backend is not None:
+            model_name = f"offline:{model_name}"
+        return make_cache_key(module_name.value, PROMPTS_VERSION, model_name, kwargs)
+
     def invoke_module(self, module_name, is_gpt4=False, **kwargs):
+        """
+        Invoke a module, returning the cached output if the same inputs were seen before
+        Every invocation is measured by self.metrics
+        """
+        with self.metrics.track_call(module_name.value, self.get_model_name(module_name, is_gpt4)) as call:
+            if not USE_LLM_CACHE:
+                return self.run_module(module_name, is_gpt4, **kwargs)
+
+            cache_key = self.get_cache_key(module_name, is_gpt4, **kwargs)
+            output = self.llm_cache.get(cache_key)
+            if output is not None:
+                call.cache_hit = True
+                # return a copy so callers can't modify the cached output
+                return copy.deepcopy(output)
+
+            output = self.run_module(module_name, is_gpt4, **kwargs)
+            self.llm_cache.set(cache_key, copy.deepcopy(output))
+            return output
+
+    def run_module(self, module_name, is_gpt4=False, **kwargs):
+        """
+        Run a module with the right model (without the cache)
+        Calls go through the shared executor so they count towards the model's concurrency cap
+        """
+        # composite modules run in the calling thread and submit their own calls to the executor
+        if module_name in COMPOSITE_MODULES:
+            return self.call_module(module_name, is_gpt4, **kwargs)
+        return self.executor.run(self.get_model_name(module_name, is_gpt4),
+                                 self.call_module, module_name, is_gpt4, **kwargs)
+
+    def call_module(self, module_name, is_gpt4=False, **kwargs):
+        """
+        Call a module with the right model in the current thread
+        """
         if is_gpt4:
             with dspy.context(lm=self.gpt4):
                 module = self.get_module(module_name)
                 return module(**kwargs)
         else:
             module = self.get_module(module_name)
+            # the composite modules run their assess modules on GPT-3.5 (and CHECK_QUESTION its rewrite on GPT-4)
+            executor = ModelExecutor(self.executor, GPT3_MODEL)
             if module_name == DSPyModule.CHECK_QUESTION:
-                return module(self.gpt4, **kwargs)
+                return module(self.gpt4, executor=executor, assessment_store=self.assessment_store,
+                              gpt4_executor=ModelExecutor(self.executor, GPT4_MODEL), **kwargs)
+            elif module_name == DSPyModule.ASSESS_QUESTIONS:
+                return module(executor=executor, assessment_store=self.assessment_store, **kwargs)
             else:
                 return module(**kwargs)
 
@@ -144,101 +392,167 @@ class DSPyAccessor:
         # combine the outputs into a list as a string
         return "[" + ", ".join(outputs) + "]" if len(outputs) > 0 else "[]"
 
-    def invoke_module_json_output(self, output_name, module_name, is_gpt4=False, **kwargs):
+    def validate_json_output(self, output, output_name, module_name):
         """
-        Keep invoking a module until it returns a json output
+        Check that output[output_name] is a non-empty JSON output
+        Returns the output with the cleaned JSON string, or None if the output is invalid
         """
-
-        num_tries = 0
-
-        in_correct_format = False
-
-        while not in_correct_format and num_tries < MAX_TRIES:
-            output = self.invoke_module(module_name, is_gpt4, **kwargs)
-            output_field = self.post_process(
-                output[output_name], OUTPUT_FORMATS[module_name])
-            try:
-                output_field_json = json.loads(output_field)
-                # if the output is empty, then try again
-                if len(output_field_json) == 0:
-                    if self.flask_app is not None:
-                        self.flask_app.logger.info("Empty output for %s in %s",
-                                                output_name, module_name)
-                        self.flask_app.logger.info(
-                            "Output: %s", output[output_name])
-                    else:
-                        print("Empty output for %s in %s" %
-                              (output_name, module_name))
-                        print("Output: %s" % output[output_name])
-                    num_tries += 1
-                    kwargs["temp"] = kwargs["temp"]+0.0001*num_tries
-                    continue
-                in_correct_format = True
-                # return the output as a dictionary output_field as the value of output_name
-                output[output_name] = output_field
-                return output
-            except json.JSONDecodeError:
-                # see if it's the special case where the output is enumerated JSON objects
-                if OUTPUT_FORMATS[module_name] == "list":
-                    output_field = self.process_enumerated_output(
-                        output[output_name])
-                    if len(json.loads(output_field)) > 0:
-                        if self.flask_app is not None:
-                            self.flask_app.logger.info(
-                                "Processed enumerated output")
-                        else:
-                            print("Processed enumerated output")
-                        new_output = output.copy()
-                        new_output[output_name] = output_field
-                        return new_output
+        output_field = self.post_process(
+            output[output_name], OUTPUT_FORMATS[module_name])
+        try:
+            output_field_json = json.loads(output_field)
+            # if the output is empty, then try again
+            if len(output_field_json) == 0:
                 if self.flask_app is not None:
-                    self.flask_app.logger.info("Invalid output format for %s in %s",
+                    self.flask_app.logger.info("Empty output for %s in %s",
                                             output_name, module_name)
-                    self.flask_app.logger.info("Output: %s", output[output_name])
+                    self.flask_app.logger.info(
+                        "Output: %s", output[output_name])
                 else:
-                    print("Invalid output format for %s in %s" %
+                    print("Empty output for %s in %s" %
                           (output_name, module_name))
                     print("Output: %s" % output[output_name])
-                num_tries += 1
-                kwargs["temp"] = kwargs["temp"]+0.0001*num_tries
+                return None
+            # return the output as a dictionary output_field as the value of output_name
+            output[output_name] = output_field
+            return output
+        except json.JSONDecodeError:
+            # see if it's the special case where the output is enumerated JSON objects
+            if OUTPUT_FORMATS[module_name] == "list":
+                output_field = self.process_enumerated_output(
+                    output[output_name])
+                if len(json.loads(output_field)) > 0:
+                    if self.flask_app is not None:
+                        self.flask_app.logger.info(
+                            "Processed enumerated output")
+                    else:
+                        print("Processed enumerated output")
+                    new_output = output.copy()
+                    new_output[output_name] = output_field
+                    return new_output
+            if self.flask_app is not None:
+                self.flask_app.logger.info("Invalid output format for %s in %s",
+                                        output_name, module_name)
+                self.flask_app.logger.info("Output: %s", output[output_name])
+            else:
+                print("Invalid output format for %s in %s" %
+                      (output_name, module_name))
+                print("Output: %s" % output[output_name])
+            return None
 
+    def invoke_module_json_output(self, output_name, module_name, is_gpt4=False, **kwargs):
+        """
+        Keep invoking a module until it returns a json output
+        """
+
+        num_tries = 0
+
+        while num_tries < MAX_TRIES:
+            output = self.invoke_module(module_name, is_gpt4, **kwargs)
+            valid_output = self.validate_json_output(
+                output, output_name, module_name)
+            if valid_output is not None:
+                self.metrics.record_json_output(module_name.value, self.get_model_name(module_name, is_gpt4),
+                                                num_tries + 1, True)
+                return valid_output
+            # don't keep the invalid output in the cache
+            self.llm_cache.delete(self.get_cache_key(module_name, is_gpt4, **kwargs))
+            num_tries += 1
+            kwargs["temp"] = kwargs["temp"]+0.0001*num_tries
+
+        self.metrics.record_json_output(module_name.value, self.get_model_name(module_name, is_gpt4),
+                                        num_tries, False)
         return None
 
     def invoke_module_multiple_times(self, output_name, module_name, num_times, is_gpt4=False, **kwargs):
         """
         Invoke a module multiple times, return all outputs
-        Use threading to speed up the process
+        Modules in N_COMPLETIONS_MODULES get all the outputs from one request with n completions,
+        other modules are invoked concurrently in the shared executor (with slightly different temperatures)
         """
-        # Original code without threading
-        outputs = []
+        if USE_N_COMPLETIONS and module_name in N_COMPLETIONS_MODULES and num_times > 1:
+            output = self.invoke_module(module_name, is_gpt4, n=num_times, **kwargs)
+            return list(output[output_name])
 
-        for i in range(num_times):
-            output = self.invoke_module(module_name, is_gpt4, **kwargs)
-            kwargs["temp"] = kwargs["temp"]+0.0001*i
-            outputs.append(output[output_name])
+        model = self.get_model_name(module_name, is_gpt4)
+        # run serially if a worker would end up waiting on its own pool
+        if module_name in COMPOSITE_MODULES or self.executor.in_worker_thread(model):
+            return [self.invoke_module(module_name, is_gpt4, **kwargs_i)[output_name]
+                    for kwargs_i in self.get_kwargs_for_each_time(num_times, kwargs)]
 
-        return outputs
+        futures = [self.executor.submit(model, self.invoke_module, module_name, is_gpt4, **kwargs_i)
+                   for kwargs_i in self.get_kwargs_for_each_time(num_times, kwargs)]
+        return [future.result()[output_name] for future in futures]
 
-        # # Code using threading
-        # # NOTE: not using this because it actually increased the time slightly
-        # outputs = []
+    def get_kwargs_for_each_time(self, num_times, kwargs):
+        """
+        Get the kwargs for each invocation in invoke_module_multiple_times
+        Each invocation gets a slightly different temperature so it doesn't hit the cached output of another one
+        """
+        return [{**kwargs, "temp": kwargs["temp"]+0.0001*i} for i in range(num_times)]
+
+    async def ainvoke_module(self, module_name, is_gpt4=False, **kwargs):
+        """
+        Async version of invoke_module
+        Cache hits are returned right away. DSPy's LMs are synchronous, so a cache miss
+        runs the module in the shared executor and the event loop stays free for other calls.
+        """
+        if USE_LLM_CACHE:
+            output = self.llm_cache.get(
+                self.get_cache_key(module_name, is_gpt4, **kwargs))
+            if output is not None:
+                with self.metrics.track_call(module_name.value, self.get_model_name(module_name, is_gpt4)) as call:
+                    call.cache_hit = True
+                return copy.deepcopy(output)
+        # composite modules don't hold a model slot while they wait for their own calls
+        if module_name in COMPOSITE_MODULES:
+            return await asyncio.to_thread(self.invoke_module, module_name, is_gpt4, **kwargs)
+        future = self.executor.submit(self.get_model_name(module_name, is_gpt4),
+                                      self.invoke_module, module_name, is_gpt4, **kwargs)
+        return await asyncio.wrap_future(future)
+
+    async def ainvoke_module_json_output(self, output_name, module_name, is_gpt4=False, **kwargs):
+        """
+        Async version of invoke_module_json_output
+        """
 
-        # def invoke_module_and_append_output(i):
-        #     output = self.invoke_module(module_name, is_gpt4, **kwargs)
-        #     kwargs["temp"] = kwargs["temp"]+0.0001*i
-        #     outputs.append(output[output_name])
+        num_tries = 0
 
-        # threads = []
+        while num_tries < MAX_TRIES:
+            output = await self.ainvoke_module(module_name, is_gpt4, **kwargs)
+            valid_output = self.validate_json_output(
+                output, output_name, module_name)
+            if valid_output is not None:
+                self.metrics.record_json_output(module_name.value, self.get_model_name(module_name, is_gpt4),
+                                                num_tries + 1, True)
+                return valid_output
+            # don't keep the invalid output in the cache
+            self.llm_cache.delete(self.get_cache_key(module_name, is_gpt4, **kwargs))
+            num_tries += 1
+            kwargs["temp"] = kwargs["temp"]+0.0001*num_tries
+
+        self.metrics.record_json_output(module_name.value, self.get_model_name(module_name, is_gpt4),
+                                        num_tries, False)
+        return None
 
-        # for i in range(num_times):
-        #     t = threading.Thread(target=invoke_module_and_append_output, args=(i,))
-        #     threads.append(t)
-        #     t.start()
+    async def ainvoke_module_multiple_times(self, output_name, module_name, num_times, is_gpt4=False, **kwargs):
+        """
+        Async version of invoke_module_multiple_times
+        """
+        if USE_N_COMPLETIONS and module_name in N_COMPLETIONS_MODULES and num_times > 1:
+            output = await self.ainvoke_module(module_name, is_gpt4, n=num_times, **kwargs)
+            return list(output[output_name])
 
-        # for t in threads:
-        #     t.join()
+        outputs = await asyncio.gather(*[self.ainvoke_module(module_name, is_gpt4, **kwargs_i)
+                                         for kwargs_i in self.get_kwargs_for_each_time(num_times, kwargs)])
+        return [output[output_name] for output in outputs]
 
-        # return outputs
+    async def gather_with_limit(self, coroutines, limit=MAX_CONCURRENT_CALLS):
+        """
+        Run coroutines concurrently with at most limit of them in flight at a time
+        Returns the results in the same order as the coroutines
+        """
+        return await gather_with_limit(coroutines, limit)
 
     def format_cells(self, cells, external_fields=None, modality="survey"):
         """
@@ -546,6 +860,55 @@ class DSPyAccessor:
         # concatenate the two lists and return
         return final_verified_topics + final_new_topics
 
+    def chunk_by_token_budget(self, items, max_tokens=MAX_BATCH_TOKENS, max_items=MAX_BATCH_SIZE,
+                              to_payload=None, shared_tokens=0):
+        """
+        Split a list of items into batches so that the estimated number of tokens in each batch
+        stays under max_tokens and each batch has at most max_items items.
+        to_payload maps an item to the JSON-serializable part that is sent for it (the whole item if None),
+        and shared_tokens are the tokens sent once per batch (e.g. the topics), counted once in each batch.
+        An item that is over the budget on its own gets its own batch.
+        """
+        batches = []
+        batch = []
+        batch_tokens = shared_tokens
+        for item in items:
+            item_tokens = estimate_tokens(json.dumps(to_payload(item) if to_payload is not None else item))
+            if len(batch) > 0 and (batch_tokens + item_tokens > max_tokens or len(batch) >= max_items):
+                batches.append(batch)
+                batch = []
+                batch_tokens = shared_tokens
+            batch.append(item)
+            batch_tokens += item_tokens
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    def get_outputs_from_batch_topic_classification(self, outputs, cell_id):
+        """
+        Get the outputs for one cell from the outputs of the batched topic classification module.
+        Each output is a JSON string mapping cell_ids to lists of topics, and the topics are returned
+        as strings separated by semicolons (the same format as the per-question module)
+        so they can be passed to clean_outputs_from_topic_classification.
+        Returns None if any of the outputs is missing the cell.
+        """
+        cell_outputs = []
+        for output in outputs:
+            if output is None:
+                return None
+            classified_topics = json.loads(output)
+            if not isinstance(classified_topics, dict) or str(cell_id) not in classified_topics:
+                return None
+            cell_topics = classified_topics[str(cell_id)]
+            if isinstance(cell_topics, str):
+                cell_outputs.append(cell_topics)
+            elif isinstance(cell_topics, list):
+                cell_outputs.append(self.format_list_to_string(
+                    [str(topic) for topic in cell_topics]))
+            else:
+                return None
+        return cell_outputs
+
 
 # Test out DSPyAccessor
 if __name__ == '__main__':
@@ -1,9 +1,9 @@
 ################################### Import Libraries ###################################
+import asyncio
 import json
-import threading
 
 import dspy
-from get_prompt_info import get_prompt_info, load_prompts
+from get_prompt_info import get_prompt_info, load_prompt_spec
 
 OPTIMIZED_MODULES_PATH = "prompts/compiled_modules/" # Path to compiled_modules folder
 
@@ -43,15 +43,22 @@ CHECKS = {
 }
 
 PROMPTS_PATH = "prompts/prompts.csv"
+# prompts.csv and the constants compiled by `python get_prompt_info.py build`
+PROMPT_SPEC_PATH = "prompts/prompt_spec.json"
 
-df_prompts = load_prompts(PROMPTS_PATH)
+MAX_CONCURRENT_ASSESSMENTS = 16 # max number of assess module calls in flight for one request
+
+prompt_spec = load_prompt_spec(PROMPT_SPEC_PATH, PROMPTS_PATH, OPTIMIZED_MODULES_PATH)
+
+# version of the prompts and compiled modules (used in cache keys)
+PROMPTS_VERSION = prompt_spec["prompts_version"]
 
 ######################################### DSPy for Step 2 #########################################
 
 # CreateConversationGuideDraft Signature: create a draft of a conversation guide based on context
 
 prompt_info_CreateConversationGuideDraft = get_prompt_info(
-    "CreateConversationGuideDraft", df_prompts)
+    "CreateConversationGuideDraft", prompt_spec)
 # print(prompt_info_CreateConversationGuideDraft)
 
 
@@ -74,7 +81,7 @@ CreateConversationGuideDraft.__doc__ = prompt_info_CreateConversationGuideDraft[
 
 # CreateInterviewDraft Signature: create a draft of an interview based on context
 
-prompt_info_CreateInterviewDraft = get_prompt_info("CreateInterviewDraft", df_prompts)
+prompt_info_CreateInterviewDraft = get_prompt_info("CreateInterviewDraft", prompt_spec)
 # print(prompt_info_CreateInterviewDraft)
 
 
@@ -96,7 +103,7 @@ CreateInterviewDraft.__doc__ = prompt_info_CreateInterviewDraft["signature_descr
 
 # CreateSurveyDraft Signature: create a draft of a survey based on context
 
-prompt_info_CreateSurveyDraft = get_prompt_info("CreateSurveyDraft", df_prompts)
+prompt_info_CreateSurveyDraft = get_prompt_info("CreateSurveyDraft", prompt_spec)
 # print(prompt_info_CreateSurveyDraft)
 
 
@@ -154,7 +161,7 @@ class CreateDraftModule(dspy.Module):
 # DetectTopics Signature: detect topics from context
 
 
-prompt_info_DetectTopics = get_prompt_info("DetectTopics", df_prompts)
+prompt_info_DetectTopics = get_prompt_info("DetectTopics", prompt_spec)
 # print(prompt_info_DetectTopics)
 
 
@@ -197,7 +204,7 @@ class DetectTopicsModule(dspy.Module):
 # ClassifyTopics Signature: classify topics for a question
 
 
-prompt_info_ClassifyTopics = get_prompt_info("ClassifyTopics", df_prompts)
+prompt_info_ClassifyTopics = get_prompt_info("ClassifyTopics", prompt_spec)
 # print(prompt_info_ClassifyTopics)
 
 
@@ -227,7 +234,14 @@ class ClassifyTopicsModule(dspy.Module):
 
         self.classified_topics = dspy.Predict(ClassifyTopics)
 
-    def forward(self, question, all_topics, pre_selected_topics, return_rationale=False, temp=0.7):
+    def forward(self, question, all_topics, pre_selected_topics, return_rationale=False, temp=0.7, n=1):
+
+        # with n > 1, the model samples n completions in one request (used for voting)
+        if n > 1:
+            output = self.classified_topics(question=question, all_topics=all_topics,
+                                            pre_selected_topics=pre_selected_topics,
+                                            config=dict(temperature=temp, n=n))
+            return {"classified_topics": list(output.completions.classified_topics)}
 
         output = self.classified_topics(question=question, all_topics=all_topics,
                                         pre_selected_topics=pre_selected_topics,
@@ -235,12 +249,50 @@ class ClassifyTopicsModule(dspy.Module):
 
         return {"classified_topics": output.classified_topics}
 
+# ClassifyTopicsBatch Signature: classify topics for a batch of questions in one call
+
+
+prompt_info_ClassifyTopicsBatch = get_prompt_info("ClassifyTopicsBatch", prompt_spec)
+# print(prompt_info_ClassifyTopicsBatch)
+
+
+class ClassifyTopicsBatch(dspy.Signature):
+
+    questions = dspy.InputField(
+        desc=prompt_info_ClassifyTopicsBatch["input_descriptions"]["questions"])
+    all_topics = dspy.InputField(
+        desc=prompt_info_ClassifyTopicsBatch["input_descriptions"]["all_topics"])
+    classified_topics = dspy.OutputField(
+        desc=prompt_info_ClassifyTopicsBatch["output_descriptions"]["classified_topics"])
+
+
+# set the signature description
+ClassifyTopicsBatch.__doc__ = prompt_info_ClassifyTopicsBatch["signature_description"]
+# print(ClassifyTopicsBatch.__doc__)
+
+# ClassifyTopicsBatchModule
+
+
+class ClassifyTopicsBatchModule(dspy.Module):
+    def __init__(self):
+
+        super().__init__()
+
+        self.classified_topics = dspy.Predict(ClassifyTopicsBatch)
+
+    def forward(self, questions, all_topics, temp=0.7):
+
+        output = self.classified_topics(questions=questions, all_topics=all_topics,
+                                        config=dict(temperature=temp))
+
+        return {"classified_topics": output.classified_topics}
+
 #############################################################################################
 
 # ClassifyQuestionType Signature: classify the question type
 
 
-prompt_info_ClassifyQuestionType = get_prompt_info("ClassifyQuestionType", df_prompts)
+prompt_info_ClassifyQuestionType = get_prompt_info("ClassifyQuestionType", prompt_spec)
 # print(prompt_info_ClassifyQuestionType)
 
 
@@ -283,7 +335,7 @@ class ClassifyQuestionTypeModule(dspy.Module):
 # AddQuestionsToTopic Signature: suggest new questions for a topic
 
 
-prompt_info_AddQuestionsToTopic = get_prompt_info("AddQuestionsToTopic", df_prompts)
+prompt_info_AddQuestionsToTopic = get_prompt_info("AddQuestionsToTopic", prompt_spec)
 # print(prompt_info_AddQuestionsToTopic)
 
 
@@ -330,7 +382,7 @@ class AddQuestionsToTopicModule(dspy.Module):
 # RemoveQuestionsInTopic Signature: suggest questions to remove from a topic
 
 
-prompt_info_RemoveQuestionsInTopic = get_prompt_info("RemoveQuestionsInTopic", df_prompts)
+prompt_info_RemoveQuestionsInTopic = get_prompt_info("RemoveQuestionsInTopic", prompt_spec)
 # print(prompt_info_RemoveQuestionsInTopic)
 
 
@@ -379,7 +431,7 @@ class RemoveQuestionsInTopicModule(dspy.Module):
 # CheckPrompt Signature: check that the prompt is sufficient
 
 
-prompt_info_CheckPrompt = get_prompt_info("CheckPrompt", df_prompts)
+prompt_info_CheckPrompt = get_prompt_info("CheckPrompt", prompt_spec)
 
 
 class CheckPrompt(dspy.Signature):
@@ -439,7 +491,7 @@ class CheckPromptModule(dspy.Module):
 
 
 prompt_info_RewordQuestionFromRequest = get_prompt_info(
-    "RewordQuestionFromRequest", df_prompts)
+    "RewordQuestionFromRequest", prompt_spec)
 # print(prompt_info_RewordQuestionFromRequest)
 
 
@@ -490,7 +542,7 @@ class RewordQuestionFromRequestModule(dspy.Module):
 # RewordQuestion Signature: generate an alternative wording for a question
 
 
-prompt_info_RewordQuestion = get_prompt_info("RewordQuestion", df_prompts)
+prompt_info_RewordQuestion = get_prompt_info("RewordQuestion", prompt_spec)
 # print(prompt_info_RewordQuestion)
 
 
@@ -538,7 +590,7 @@ class RewordQuestionModule(dspy.Module):
 # RewordQuestion Signature: generate an alternative wording for a question
 
 
-prompt_info_SwitchResponseFormat = get_prompt_info("SwitchResponseFormat", df_prompts)
+prompt_info_SwitchResponseFormat = get_prompt_info("SwitchResponseFormat", prompt_spec)
 # print(prompt_info_SwitchResponseFormat)
 
 
@@ -583,7 +635,7 @@ class SwitchResponseFormatModule(dspy.Module):
 # AssessReadability Signature: assess readability of a question
 
 
-prompt_info_AssessReadability = get_prompt_info("AssessReadability", df_prompts)
+prompt_info_AssessReadability = get_prompt_info("AssessReadability", prompt_spec)
 # print(prompt_info_AssessReadability)
 
 
@@ -630,7 +682,7 @@ class AssessReadabilityModule(dspy.Module):
 # AssessBias Signature: assess bias of a question
 
 
-prompt_info_AssessBias = get_prompt_info("AssessBias", df_prompts)
+prompt_info_AssessBias = get_prompt_info("AssessBias", prompt_spec)
 # print(prompt_info_AssessBias)
 
 
@@ -675,7 +727,7 @@ class AssessBiasModule(dspy.Module):
 # AssessSpecificity Signature: assess specificity of a question
 
 
-prompt_info_AssessSpecificity = get_prompt_info("AssessSpecificity", df_prompts)
+prompt_info_AssessSpecificity = get_prompt_info("AssessSpecificity", prompt_spec)
 # print(prompt_info_AssessSpecificity)
 
 
@@ -720,7 +772,7 @@ class AssessSpecificityModule(dspy.Module):
 # CleanRationale Signature: clean rationale
 
 
-prompt_info_CleanRationale = get_prompt_info("CleanRationale", df_prompts)
+prompt_info_CleanRationale = get_prompt_info("CleanRationale", prompt_spec)
 # print(prompt_info_CleanRationale)
 
 
@@ -769,7 +821,7 @@ class CleanRationaleModule(dspy.Module):
 # RewriteQuestion Signature: re-write question based on rationale
 
 
-prompt_info_RewriteQuestion = get_prompt_info("RewriteQuestion", df_prompts)
+prompt_info_RewriteQuestion = get_prompt_info("RewriteQuestion", prompt_spec)
 # print(prompt_info_RewriteQuestion)
 
 
@@ -812,6 +864,37 @@ class RewriteQuestionModule(dspy.Module):
 
 #############################################################################################
 
+# functions to run LLM calls concurrently
+
+
+async def run_in_executor(executor, fn, *args):
+    """
+    executor : executor shared by all LLM calls (or None to use the event loop's default executor)
+    fn : function to run in a worker thread
+
+    return result : return value of fn(*args)
+    """
+    if executor is None:
+        return await asyncio.to_thread(fn, *args)
+    return await asyncio.wrap_future(executor.submit(fn, *args))
+
+
+
+async def gather_with_limit(coroutines, limit):
+    """
+    coroutines : list of coroutines to run
+    limit : max number of coroutines running at the same time
+
+    return results : list of results in the same order as coroutines
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run_with_semaphore(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*[run_with_semaphore(coroutine) for coroutine in coroutines])
+
 # function to clean scores from asess modules
 
 
@@ -832,6 +915,16 @@ def is_flagged(score, check_name):
         return False
 
 
+def is_valid_score(score, check_name):
+    """
+    score : score from the asess module
+    check_name : name of the asess module
+
+    return is_valid : boolean indicating if the score is one of the scores of the check
+    """
+    return isinstance(score, str) and score.strip().lower() in CHECKS[check_name]["all_scores"]
+
+
 def clean_scores(scores):
     """
     scores : dictionary mapping from check name to output of the asess module
@@ -888,29 +981,38 @@ def format_cleaned_scores(cleaned_scores):
 
 
 class CheckQuestionModule(dspy.Module):
-    def __init__(self):
+    def __init__(self, assess_readability=None, assess_bias=None, assess_specificity=None,
+                 clean_rationale=None, rewrite=None):
 
         super().__init__()
 
-        # create objects for all the asess modules
-        self.assess_readability = AssessReadabilityModule()
-        self.assess_bias = AssessBiasModule()
-        self.assess_specificity = AssessSpecificityModule()
+        # create objects for all the asess modules (or use the ones passed in so they are shared)
+        self.assess_readability = assess_readability if assess_readability is not None else AssessReadabilityModule()
+        self.assess_bias = assess_bias if assess_bias is not None else AssessBiasModule()
+        self.assess_specificity = assess_specificity if assess_specificity is not None else AssessSpecificityModule()
 
         # create object for the clean rationale module
-        self.clean_rationale = CleanRationaleModule()
+        self.clean_rationale = clean_rationale if clean_rationale is not None else CleanRationaleModule()
 
         # create object for the rewrite question module
-        self.rewrite = RewriteQuestionModule()
+        self.rewrite = rewrite if rewrite is not None else RewriteQuestionModule()
 
-    def run_assess_module(self, check_name, question_no_desc_str, reading_level, temp, outputs):
+    def run_assess_module(self, check_name, question_no_desc_str, reading_level, temp, assessment_store=None):
         """
         check_name : name of the check
         question_no_desc_str : question without the description field
         reading_level : reading level for the assess module
         temp : temperature for the asess module
-        outputs : dictionary to store the output of the asess module
+        assessment_store : store with the outputs of previous assessments (or None)
+
+        return output : output of the asess module
         """
+        # reuse the output if the same question was already assessed
+        if assessment_store is not None:
+            output = assessment_store.get(question_no_desc_str, check_name, reading_level)
+            if output is not None:
+                return output
+
         if check_name == "readability":
             output = self.assess_readability(question=question_no_desc_str,
                                              reading_level=reading_level,
@@ -925,26 +1027,73 @@ class CheckQuestionModule(dspy.Module):
                                              return_rationale=True,
                                              temp=temp)
 
-        outputs[check_name] = output
+        # only store well-formed outputs, so a malformed answer isn't reused for every later check
+        if assessment_store is not None and is_valid_score(output["score"], check_name):
+            assessment_store.set(question_no_desc_str, check_name, reading_level, output)
+
+        return output
 
-    def run_clean_rationale(self, flagged_check, question_no_desc_str, rationale, problem, temp, cleaned_scores):
+    def run_clean_rationale(self, question_no_desc_str, rationale, problem, temp):
         """
-        flagged_check : name of the flagged check
         question_no_desc_str : question without the description field
         rationale : rationale to clean
         problem : problem for the clean rationale module
         temp : temperature for the clean rationale module
-        cleaned_scores : dictionary mapping from flagged check name to rationales
+
+        return new_rationale : cleaned rationale
         """
-        new_rationale = self.clean_rationale(question=question_no_desc_str,
-                                             input_rationale=rationale,
-                                             problem=problem,
-                                             return_rationale=False,
-                                             temp=temp)["new_rationale"]
+        return self.clean_rationale(question=question_no_desc_str,
+                                    input_rationale=rationale,
+                                    problem=problem,
+                                    return_rationale=False,
+                                    temp=temp)["new_rationale"]
 
-        cleaned_scores[flagged_check] = new_rationale
+    def run_rewrite(self, gpt4, context, question_str, complete_rationale, temp):
+        """
+        gpt4 : GPT-4 LM for the rewrite question module
+        context : context of the project
+        question_str : question to rewrite
+        complete_rationale : cleaned rationales of all the flagged checks
+        temp : temperature for the rewrite question module
+
+        return rewritten_questions : output of the rewrite question module
+        """
+        # dspy's context is per thread, so set the LM in the thread that runs the module
+        with dspy.context(lm=gpt4):
+            return self.rewrite(context=context,
+                                question=question_str,
+                                input_rationale=complete_rationale,
+                                return_rationale=False,
+                                temp=temp)["rewritten_questions"]
+
+    async def run_assess_modules(self, executor, check_names, question_no_desc_str, reading_level, temp,
+                                 assessment_store=None):
+        """
+        Run the asess modules for check_names concurrently
+        return outputs : dictionary mapping from check name to output of the asess module
+        """
+        outputs = await gather_with_limit(
+            [run_in_executor(executor, self.run_assess_module, check_name, question_no_desc_str, reading_level, temp,
+                             assessment_store)
+             for check_name in check_names],
+            MAX_CONCURRENT_ASSESSMENTS)
+        return dict(zip(check_names, outputs))
+
+    async def run_clean_rationales(self, executor, cleaned_scores, question_no_desc_str, temp):
+        """
+        Run the clean rationale module for each flagged check concurrently
+        return cleaned_scores : dictionary mapping from flagged check name to cleaned rationales
+        """
+        flagged_checks = list(cleaned_scores.keys())
+        new_rationales = await gather_with_limit(
+            [run_in_executor(executor, self.run_clean_rationale, question_no_desc_str, cleaned_scores[flagged_check],
+                               CHECKS[flagged_check]["problem"], temp)
+             for flagged_check in flagged_checks],
+            MAX_CONCURRENT_ASSESSMENTS)
+        return dict(zip(flagged_checks, new_rationales))
 
-    def forward(self, gpt4, checks_to_ignore, context, question, reading_level="third grade", temp=0.7):
+    def forward(self, gpt4, checks_to_ignore, context, question, reading_level="third grade", temp=0.7,
+                executor=None, assessment_store=None, gpt4_executor=None):
 
         # question is now a JSON
         # clear the description field
@@ -955,21 +1104,12 @@ class CheckQuestionModule(dspy.Module):
         question_str = json.dumps(question)
         question_no_desc_str = json.dumps(question_no_desc)
 
-        # run the assess modules using multiple threads
-        threads = list()
-        outputs = dict()
-        for check_name in CHECKS:
-            if check_name in checks_to_ignore:
-                continue
-            thread = threading.Thread(target=self.run_assess_module,
-                                      args=(check_name, question_no_desc_str, reading_level, temp, outputs))
-            threads.append(thread)
-            thread.start()
+        # run the assess modules concurrently
+        check_names = [check_name for check_name in CHECKS if check_name not in checks_to_ignore]
+        outputs = asyncio.run(self.run_assess_modules(
+            executor, check_names, question_no_desc_str, reading_level, temp, assessment_store))
 
-        for thread in threads:
-            thread.join()
-
-        # print(f"Outputs from threads: {outputs}")
+        # print(f"Outputs from assess modules: {outputs}")
 
         # clean the scores
         cleaned_scores = clean_scores(outputs)
@@ -980,20 +1120,10 @@ class CheckQuestionModule(dspy.Module):
 
         # print(f"Cleaned scores: {cleaned_scores}")
 
-        # clean the rationales for each flagged check
-        # run the clean rationale module in multiple threads
-        threads = list()
+        # clean the rationales for each flagged check concurrently
         complete_rationale = ""
-        for flagged_check, rationale in cleaned_scores.items():
-            problem = CHECKS[flagged_check]["problem"]
-            thread = threading.Thread(target=self.run_clean_rationale,
-                                      args=(flagged_check, question_no_desc_str, rationale,
-                                            problem, temp, cleaned_scores))
-            threads.append(thread)
-            thread.start()
-
-        for thread in threads:
-            thread.join()
+        cleaned_scores = asyncio.run(self.run_clean_rationales(
+            executor, cleaned_scores, question_no_desc_str, temp))
 
         # create the complete rationale
         for rationale in cleaned_scores.values():
@@ -1008,35 +1138,43 @@ class CheckQuestionModule(dspy.Module):
         # print(f"Formatted cleaned scores: {formatted_cleaned_scores}")
 
         # rewrite the question with the complete rationale
-        with dspy.context(lm=gpt4):
-            rewritten_questions = self.rewrite(context=context,
-                                               question=question_str,
-                                               input_rationale=complete_rationale,
-                                               return_rationale=False,
-                                               temp=temp)["rewritten_questions"]
+        # (through the GPT-4 executor if there is one, so the call counts towards GPT-4's concurrency cap)
+        if gpt4_executor is not None:
+            rewritten_questions = gpt4_executor.run(self.run_rewrite, gpt4, context, question_str,
+                                                    complete_rationale, temp)
+        else:
+            rewritten_questions = self.run_rewrite(gpt4, context, question_str, complete_rationale, temp)
 
         return {"rewritten_questions": rewritten_questions, "cleaned_scores": formatted_cleaned_scores}
 
 # AssessQuestionsModule
 
 class AssessQuestionsModule(dspy.Module):
-    def __init__(self):
+    def __init__(self, assess_readability=None, assess_bias=None, assess_specificity=None):
 
         super().__init__()
 
-        # create objects for all the asess modules
-        self.assess_readability = AssessReadabilityModule()
-        self.assess_bias = AssessBiasModule()
-        self.assess_specificity = AssessSpecificityModule()
+        # create objects for all the asess modules (or use the ones passed in so they are shared)
+        self.assess_readability = assess_readability if assess_readability is not None else AssessReadabilityModule()
+        self.assess_bias = assess_bias if assess_bias is not None else AssessBiasModule()
+        self.assess_specificity = assess_specificity if assess_specificity is not None else AssessSpecificityModule()
 
-    def run_assess_module(self, check_name, question_index, question_no_desc_str, reading_level, temp, outputs):
+    def run_assess_module(self, check_name, question_no_desc_str, reading_level, temp, assessment_store=None):
         """
         check_name : name of the check
         question_no_desc_str : question without the description field
         reading_level : reading level for the assess module
         temp : temperature for the asess module
-        outputs : dictionary to store the output of the asess module
+        assessment_store : store with the outputs of previous assessments (or None)
+
+        return output : output of the asess module
         """
+        # reuse the output if the same question was already assessed
+        if assessment_store is not None:
+            output = assessment_store.get(question_no_desc_str, check_name, reading_level)
+            if output is not None:
+                return output
+
         if check_name == "readability":
             output = self.assess_readability(question=question_no_desc_str,
                                              reading_level=reading_level,
@@ -1050,20 +1188,19 @@ class AssessQuestionsModule(dspy.Module):
             output = self.assess_specificity(question=question_no_desc_str,
                                              return_rationale=True,
                                              temp=temp)
-        if question_index not in outputs:
-            outputs[question_index] = {}
-
-        outputs[question_index][check_name] = output
 
-    def forward(self, questions, initial_flags, reading_level="third grade", temp=0.7):
-
-        # create a list to store the scores
-        scores = []
+        # only store well-formed outputs, so a malformed answer isn't reused for every later check
+        if assessment_store is not None and is_valid_score(output["score"], check_name):
+            assessment_store.set(question_no_desc_str, check_name, reading_level, output)
 
-        # use multithreading to run each check on each question
-        threads = list()
-        outputs = dict()
+        return output
 
+    async def run_all_assess_modules(self, executor, questions, reading_level, temp, assessment_store=None):
+        """
+        Run each check on each question concurrently
+        return outputs : list (one item per question) of dictionaries mapping from check name to output
+        """
+        jobs = []
         for index, question in enumerate(questions):
             # question is now a JSON
             # clear the description field
@@ -1074,16 +1211,32 @@ class AssessQuestionsModule(dspy.Module):
             question_no_desc_str = json.dumps(question_no_desc)
 
             for check_name in CHECKS:
-                thread = threading.Thread(target=self.run_assess_module,
-                                          args=(check_name, index, question_no_desc_str, reading_level, temp, outputs))
-                threads.append(thread)
-                thread.start()
+                jobs.append((index, check_name, question_no_desc_str))
+
+        results = await gather_with_limit(
+            [run_in_executor(executor, self.run_assess_module, check_name, question_no_desc_str, reading_level, temp,
+                             assessment_store)
+             for _index, check_name, question_no_desc_str in jobs],
+            MAX_CONCURRENT_ASSESSMENTS)
+
+        outputs = [{} for _question in questions]
+        for (index, check_name, _question_no_desc_str), output in zip(jobs, results):
+            outputs[index][check_name] = output
+
+        return outputs
+
+    def forward(self, questions, initial_flags, reading_level="third grade", temp=0.7, executor=None,
+                assessment_store=None):
+
+        # create a list to store the scores
+        scores = []
 
-        for thread in threads:
-            thread.join()
+        # run each check on each question concurrently
+        outputs = asyncio.run(self.run_all_assess_modules(
+            executor, questions, reading_level, temp, assessment_store))
 
         # go through the outputs and clean the scores
-        for _index, score in outputs.items():
+        for score in outputs:
             cleaned_scores = get_flagged_checks(score, initial_flags)
             scores.append(cleaned_scores)
         
@@ -0,0 +1,251 @@
+################################### Import Libraries ###################################
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pymongo import ASCENDING
+
+# Default settings for the research data exports
+EXPORT_BATCH_SIZE = 500  # number of documents fetched from MongoDB at a time
+PARQUET_ROW_GROUP_SIZE = 1000  # number of records buffered before a Parquet row group is written
+EXPORT_WORKERS = 4  # number of users whose projects are exported in parallel
+EXPORT_FORMATS = ["jsonl", "parquet"]
+
+# columns of each dataset in Parquet files (nested values are stored as JSON strings)
+PROMPT_COLUMNS = ["project_id", "module_name", "time_created", "prompt_inputs", "prompt_outputs"]
+EVENT_COLUMNS = ["user_id", "project_id", "timeStamp", "event"]
+PROJECT_COLUMNS = ["project_id", "user_id", "project_title", "context_response", "analyze_topics_info",
+                   "human_topics", "sections_with_cells"]
+
+
+class JSONLWriter:
+    """
+    Writes one JSON record per line
+    """
+
+    def __init__(self, path, columns=None):
+        self.file = open(path, "w")
+        self.count = 0
+
+    def write(self, record):
+        self.file.write(json.dumps(record, default=str) + "\n")
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    """
+    Writes records to a Parquet file, one row group every PARQUET_ROW_GROUP_SIZE records.
+    Every column is a string (nested values are stored as JSON) so the schema is the same for every row group.
+    """
+
+    def __init__(self, path, columns, row_group_size=PARQUET_ROW_GROUP_SIZE):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.columns = columns
+        self.row_group_size = row_group_size
+        self.schema = pa.schema([(column, pa.string()) for column in columns])
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.rows = []
+        self.count = 0
+
+    def write(self, record):
+        row = {}
+        for column in self.columns:
+            value = record.get(column)
+            row[column] = value if isinstance(value, str) or value is None else json.dumps(value, default=str)
+        self.rows.append(row)
+        self.count += 1
+        if len(self.rows) >= self.row_group_size:
+            self.write_row_group()
+
+    def write_row_group(self):
+        if len(self.rows) == 0:
+            return
+        self.writer.write_table(self.pa.Table.from_pylist(self.rows, schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        self.write_row_group()
+        self.writer.close()
+
+
+class DataExporter:
+    """
+    Streams the prompts, user events and projects from MongoDB to JSONL or Parquet files in bounded memory.
+
+    Documents are read with batched cursors and written one record at a time, so memory only depends on
+    the batch size (and on the size of one project). Prompts and events can be filtered by a date range
+    (start_date inclusive, end_date exclusive, both "YYYY-MM-DD"; events by their timeStamp, prompts by
+    time_created) and events and projects by a list of users.
+    The projects of each user go to their own file, and several users are exported in parallel.
+    """
+
+    def __init__(self, db, output_dir, export_format="jsonl", start_date=None, end_date=None, user_ids=None,
+                 batch_size=EXPORT_BATCH_SIZE, workers=EXPORT_WORKERS):
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format {export_format}, expected one of {EXPORT_FORMATS}")
+        self.db = db
+        self.output_dir = output_dir
+        self.export_format = export_format
+        self.start_date = datetime.fromisoformat(start_date) if start_date is not None else None
+        self.end_date = datetime.fromisoformat(end_date) if end_date is not None else None
+        self.user_ids = user_ids
+        self.batch_size = batch_size
+        self.workers = workers
+        # get date for the file names
+        self.timestamp = datetime.today().strftime('%Y-%m-%d')
+        os.makedirs(output_dir, exist_ok=True)
+
+    def open_writer(self, name, columns):
+        path = os.path.join(self.output_dir, f"{self.timestamp}_{name}.{self.export_format}")
+        if self.export_format == "parquet":
+            return ParquetWriter(path, columns)
+        return JSONLWriter(path, columns)
+
+    def get_date_range(self, to_value=lambda date: date):
+        """
+        Returns the MongoDB range filter for the dates (None if there is no date filter)
+        """
+        date_range = {}
+        if self.start_date is not None:
+            date_range["$gte"] = to_value(self.start_date)
+        if self.end_date is not None:
+            date_range["$lt"] = to_value(self.end_date)
+        return date_range if len(date_range) > 0 else None
+
+    def is_in_date_range(self, timestamp):
+        """
+        Returns True if an ISO timestamp string is in the date range
+        """
+        if self.start_date is None and self.end_date is None:
+            return True
+        # compare the dates without time zones (the UI sends UTC timestamps ending with "Z")
+        date = datetime.fromisoformat(timestamp.replace("Z", "")).replace(tzinfo=None)
+        return (self.start_date is None or date >= self.start_date) and \
+            (self.end_date is None or date < self.end_date)
+
+    def export_prompts(self):
+        """
+        Writes every prompt (with the blobs rehydrated) and returns the number of prompts
+        """
+        query = {}
+        # time_created is an ISO string, so the dates are compared as strings
+        date_range = self.get_date_range(lambda date: date.isoformat())
+        if date_range is not None:
+            query["time_created"] = date_range
+
+        writer = self.open_writer("prompts", PROMPT_COLUMNS)
+        try:
+            for prompt in self.db.get_prompts(query, batch_size=self.batch_size):
+                writer.write(prompt)
+        finally:
+            writer.close()
+        return writer.count
+
+    def iter_events(self):
+        """
+        Generator with one record per event: {"user_id", "project_id", "timeStamp", "event"}
+        Events from the older user_events documents come first, then the events collection in the order received
+        Both are filtered on the event's timeStamp (the time the UI recorded it, not the time the server got it)
+        """
+        query = {}
+        if self.user_ids is not None:
+            query["user_id"] = {"$in": self.user_ids}
+
+        for user_event in self.db.db.user_events.find(query, {"_id": 0}).batch_size(self.batch_size):
+            for event in user_event.get("events", []):
+                if self.is_in_date_range(event["timeStamp"]):
+                    yield {"user_id": user_event["user_id"], "project_id": user_event["project_id"],
+                           "timeStamp": event["timeStamp"], "event": event}
+
+        events_query = {f"meta.{field}": value for field, value in query.items()}
+        cursor = self.db.db.events.find(events_query, {"_id": 0}) \
+            .sort("received_at", ASCENDING).batch_size(self.batch_size)
+        for event_doc in cursor:
+            # same filter as the user_events documents (received_at can be later than the timeStamp)
+            if not self.is_in_date_range(event_doc["event"]["timeStamp"]):
+                continue
+            yield {"user_id": event_doc["meta"]["user_id"], "project_id": event_doc["meta"]["project_id"],
+                   "timeStamp": event_doc["event"]["timeStamp"], "event": event_doc["event"]}
+
+    def export_user_events(self):
+        """
+        Writes every user event and returns the number of events
+        """
+        writer = self.open_writer("user_events", EVENT_COLUMNS)
+        try:
+            for record in self.iter_events():
+                writer.write(record)
+        finally:
+            writer.close()
+        return writer.count
+
+    def export_user_projects(self, user_id):
+        """
+        Writes the projects of a user (with the cells of each section) and returns the number of projects
+        """
+        projects = self.db.get_user_projects(user_id)
+        if projects is None:
+            return 0
+
+        writer = self.open_writer(f"projects_{user_id}", PROJECT_COLUMNS)
+        try:
+            for project in projects:
+                # only one project (with its cells) is in memory at a time
+                project_doc = self.db.save_project_to_file(project["project_id"])
+                if project_doc is not None:
+                    writer.write(project_doc)
+        finally:
+            writer.close()
+        return writer.count
+
+    def export_projects(self):
+        """
+        Writes the projects of every user (or of user_ids) to one file per user
+        Returns a dictionary mapping from user_id to the number of projects
+        """
+        user_ids = self.user_ids if self.user_ids is not None else self.db.get_users_with_projects()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            counts = executor.map(self.export_user_projects, user_ids)
+            return dict(zip(user_ids, counts))
+
+    def export_all(self):
+        """
+        Exports the prompts, user events and projects and returns the number of records in each
+        """
+        return {
+            "prompts": self.export_prompts(),
+            "user_events": self.export_user_events(),
+            "projects": self.export_projects()
+        }
+
+
+if __name__ == '__main__':
+    # export the research data from the command line
+    from pymongo.mongo_client import MongoClient
+    from pymongo.server_api import ServerApi
+    from db import MongoDB
+    from passwords import mongodb_uri
+
+    parser = argparse.ArgumentParser(description="Export the prompts, user events and projects")
+    parser.add_argument("output_dir")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="jsonl")
+    parser.add_argument("--start-date", help="first day to export (YYYY-MM-DD)")
+    parser.add_argument("--end-date", help="day after the last day to export (YYYY-MM-DD)")
+    parser.add_argument("--user-ids", nargs="+", help="only export the events and projects of these users")
+    parser.add_argument("--datasets", nargs="+", choices=["prompts", "user_events", "projects"],
+                        default=["prompts", "user_events", "projects"])
+    parser.add_argument("--workers", type=int, default=EXPORT_WORKERS)
+    args = parser.parse_args()
+
+    exporter = DataExporter(MongoDB(MongoClient(mongodb_uri, server_api=ServerApi('1'))), args.output_dir,
+                            export_format=args.format, start_date=args.start_date, end_date=args.end_date,
+                            user_ids=args.user_ids, workers=args.workers)
+    for dataset in args.datasets:
+        print("Exported %s: %s" % (dataset, getattr(exporter, f"export_{dataset}")()))
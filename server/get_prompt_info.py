@@ -1,7 +1,15 @@
 # Import libraries
 
+import argparse
+import csv
+import hashlib
 import json
-import pandas as pd
+import os
+
+PROMPT_SPEC_FORMAT_VERSION = 1  # version of the structure of the prompt spec file (bump it when it changes)
+# columns of prompts.csv that are compiled into the prompt spec
+REQUIRED_COLUMNS = ["signature_name", "is_optimized", "signature_description",
+                    "input_descriptions", "output_descriptions", "optimized_module"]
 
 SPREADSHEET_URL = "https://docs.google.com/spreadsheets/d/1z9LPg7-njYQ12EK4qI2ASSjS0s2rCCnsv6Jm8Nc9Ip8/export?format=csv&gid=847691564"
 
@@ -64,6 +72,9 @@ def save_prompts_to_csv():
     """
     Save the prompts to a CSV file in the data subfolder
     """
+    # pandas is only needed to download the spreadsheet (not to run the server)
+    import pandas as pd
+
     # read in the spreadsheet
     df_prompts = pd.read_csv(SPREADSHEET_URL)
     df_prompts.to_csv("data/prompts.csv", index=False)
@@ -75,64 +86,173 @@ def fill_in_constants(input_str):
     return input_str
 
 
-def load_prompts(file):
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def get_source_hashes(prompts_file, compiled_modules_path):
     """
-    Load the prompts from a CSV file or URL
+    Get the sha256 of every input of the prompt spec: the prompts CSV, the constants and every compiled module
     """
-    return pd.read_csv(file)
+    source_hashes = {}
+    with open(prompts_file, "rb") as f:
+        source_hashes["prompts"] = hash_bytes(f.read())
+    source_hashes["constants"] = hash_bytes(json.dumps(CONSTANTS, sort_keys=True).encode("utf-8"))
+    for filename in sorted(os.listdir(compiled_modules_path)):
+        with open(os.path.join(compiled_modules_path, filename), "rb") as f:
+            source_hashes[f"compiled_modules/{filename}"] = hash_bytes(f.read())
+    return source_hashes
 
 
-def get_prompt_info(signature_name, df_prompts):
+def get_prompts_version(prompts_file, compiled_modules_path):
     """
-    Get the prompt info for a given signature name
-    Returns dictionary with the following keys:
-    - is_optimized: whether the prompt is optimized using DSPy
-    - signature_description: string
-    - input_descriptions: json
-    - output_descriptions: json
-    - optimized_module: string (filename)
+    Get a version string for the prompts
+    The version is a hash of the prompts CSV, the constants and every compiled module,
+    so it changes whenever a signature description or a few-shot demo changes
     """
-    # make sure the signature name is in the dataframe
-    if signature_name not in df_prompts["signature_name"].values:
-        print(f"Signature name {signature_name} not found in the spreadsheet")
-        return None
+    return get_version_from_hashes(get_source_hashes(prompts_file, compiled_modules_path))
 
-    # get row with the signature name
-    row = df_prompts[df_prompts["signature_name"] == signature_name]
 
-    # make sure there is only one row
-    assert len(row) == 1, f"More than one row found for signature name {
-        signature_name}"
+def get_version_from_hashes(source_hashes):
+    return hash_bytes(json.dumps(source_hashes, sort_keys=True).encode("utf-8"))[:16]
 
-    # get is_optimized (if the value in the is_optimized column is "Yes", then the prompt is optimized)
-    is_optimized = row["is_optimized"].values[0] == "Yes"
 
-    # get signature description
-    signature_description = row["signature_description"].values[0]
+def get_signatures_hash(signatures):
+    return hash_bytes(json.dumps(signatures, sort_keys=True).encode("utf-8"))
 
-    # get input descriptions and convert to json
-    input_descriptions = json.loads(row["input_descriptions"].values[0])
-    #  iterate through the input descriptions and fill in the constants
-    for key in input_descriptions:
-        input_descriptions[key] = fill_in_constants(input_descriptions[key])
 
-    # get output descriptions
-    output_descriptions = json.loads(row["output_descriptions"].values[0])
-    #  iterate through the output descriptions and fill in the constants
-    for key in output_descriptions:
-        output_descriptions[key] = fill_in_constants(output_descriptions[key])
+def compile_prompt_info(row, compiled_modules_path):
+    """
+    Compile one row of the prompts CSV into the prompt info of the signature (see get_prompt_info)
+    Raises ValueError if the row is invalid
+    """
+    signature_name = row["signature_name"]
+    try:
+        input_descriptions = json.loads(row["input_descriptions"])
+        output_descriptions = json.loads(row["output_descriptions"])
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid input or output descriptions for signature {signature_name}: {e}") from e
+    if not isinstance(input_descriptions, dict) or not isinstance(output_descriptions, dict):
+        raise ValueError(f"Input and output descriptions for signature {signature_name} should be JSON objects")
 
-    # get optimized module
-    optimized_module = row["optimized_module"].values[0]
+    # if the value in the is_optimized column is "Yes", then the prompt is optimized
+    is_optimized = row["is_optimized"] == "Yes"
+    optimized_module = row["optimized_module"] if row["optimized_module"] != "" else None
+    if is_optimized and (optimized_module is None or
+                         not os.path.isfile(os.path.join(compiled_modules_path, optimized_module))):
+        raise ValueError(f"Compiled module {optimized_module} for signature {signature_name} not found")
 
     return {
         "is_optimized": is_optimized,
-        "signature_description": signature_description,
-        "input_descriptions": input_descriptions,
-        "output_descriptions": output_descriptions,
+        "signature_description": row["signature_description"],
+        # fill in the constants in the input and output descriptions
+        "input_descriptions": {key: fill_in_constants(value) for key, value in input_descriptions.items()},
+        "output_descriptions": {key: fill_in_constants(value) for key, value in output_descriptions.items()},
         "optimized_module": optimized_module
     }
 
 
+def build_prompt_spec(prompts_file, compiled_modules_path):
+    """
+    Compile the prompts CSV and the constants into the prompt spec (a dictionary with the following keys):
+    - format_version: PROMPT_SPEC_FORMAT_VERSION
+    - prompts_version: version string for the cache keys (see get_prompts_version)
+    - source_hashes: sha256 of every input (to detect a spec that is out of date)
+    - signatures: dictionary mapping from signature name to prompt info (see get_prompt_info)
+    - signatures_hash: sha256 of signatures (to detect a corrupted spec)
+    Raises ValueError if the CSV is invalid
+    """
+    with open(prompts_file, newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        missing_columns = [column for column in REQUIRED_COLUMNS if column not in reader.fieldnames]
+        if len(missing_columns) > 0:
+            raise ValueError(f"Columns {missing_columns} not found in {prompts_file}")
+
+        signatures = {}
+        for row in reader:
+            # skip the rows for tasks that don't have a signature yet
+            if row["signature_name"] == "":
+                continue
+            if row["signature_name"] in signatures:
+                raise ValueError(f"More than one row found for signature name {row['signature_name']}")
+            signatures[row["signature_name"]] = compile_prompt_info(row, compiled_modules_path)
+
+    source_hashes = get_source_hashes(prompts_file, compiled_modules_path)
+    return {
+        "format_version": PROMPT_SPEC_FORMAT_VERSION,
+        "prompts_version": get_version_from_hashes(source_hashes),
+        "source_hashes": source_hashes,
+        "signatures": signatures,
+        "signatures_hash": get_signatures_hash(signatures)
+    }
+
+
+def save_prompt_spec(prompts_file, compiled_modules_path, spec_file):
+    """
+    Build the prompt spec and save it to a JSON file (run this after changing prompts.csv or a compiled module)
+    """
+    prompt_spec = build_prompt_spec(prompts_file, compiled_modules_path)
+    with open(spec_file, "w", encoding="utf-8") as f:
+        json.dump(prompt_spec, f, indent=4, sort_keys=True)
+        f.write("\n")
+    return prompt_spec
+
+
+def load_prompt_spec(spec_file, prompts_file=None, compiled_modules_path=None):
+    """
+    Load the prompt spec from a JSON file (see build_prompt_spec)
+    Raises ValueError if the file is corrupted or has another format version.
+    If prompts_file and compiled_modules_path are set and the spec is missing or out of date
+    (e.g. prompts.csv was edited without rebuilding it), the spec is rebuilt in memory instead
+    """
+    can_rebuild = prompts_file is not None and compiled_modules_path is not None
+    if not os.path.isfile(spec_file) and can_rebuild:
+        print(f"Prompt spec {spec_file} not found, building it from {prompts_file}")
+        return build_prompt_spec(prompts_file, compiled_modules_path)
+
+    with open(spec_file, encoding="utf-8") as f:
+        prompt_spec = json.load(f)
+    if prompt_spec.get("format_version") != PROMPT_SPEC_FORMAT_VERSION:
+        raise ValueError(f"Prompt spec {spec_file} has format version {prompt_spec.get('format_version')}, "
+                         f"expected {PROMPT_SPEC_FORMAT_VERSION}")
+    if get_signatures_hash(prompt_spec["signatures"]) != prompt_spec["signatures_hash"]:
+        raise ValueError(f"Prompt spec {spec_file} is corrupted (signatures hash doesn't match)")
+
+    if can_rebuild and get_source_hashes(prompts_file, compiled_modules_path) != prompt_spec["source_hashes"]:
+        print(f"Prompt spec {spec_file} is out of date, rebuilding it from {prompts_file} "
+              f"(run `python get_prompt_info.py build` to update it)")
+        return build_prompt_spec(prompts_file, compiled_modules_path)
+    return prompt_spec
+
+
+def get_prompt_info(signature_name, prompt_spec):
+    """
+    Get the prompt info for a given signature name from the prompt spec (see load_prompt_spec)
+    Returns dictionary with the following keys:
+    - is_optimized: whether the prompt is optimized using DSPy
+    - signature_description: string
+    - input_descriptions: json
+    - output_descriptions: json
+    - optimized_module: string (filename)
+    """
+    # make sure the signature name is in the prompt spec
+    if signature_name not in prompt_spec["signatures"]:
+        print(f"Signature name {signature_name} not found in the spreadsheet")
+        return None
+
+    # return a copy so the spec can't be changed by the caller
+    return json.loads(json.dumps(prompt_spec["signatures"][signature_name]))
+
+
 if __name__ == '__main__':
-    save_prompts_to_csv()
+    # download the prompts spreadsheet (default) or build the prompt spec from prompts/prompts.csv
+    parser = argparse.ArgumentParser(description="Download the prompts or build the prompt spec")
+    parser.add_argument("command", nargs="?", choices=["download", "build"], default="download")
+    args = parser.parse_args()
+
+    if args.command == "download":
+        save_prompts_to_csv()
+    else:
+        prompt_spec = save_prompt_spec("prompts/prompts.csv", "prompts/compiled_modules/", "prompts/prompt_spec.json")
+        print("Built prompt spec version %s with %s signatures" %
+              (prompt_spec["prompts_version"], len(prompt_spec["signatures"])))
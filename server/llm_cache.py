@@ -0,0 +1,253 @@
+################################### Import Libraries ###################################
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Default settings for the LLM response cache
+CACHE_MAX_ENTRIES = 2048  # max number of entries in the in-process LRU tier
+CACHE_TTL = 60 * 60 * 24 * 7  # time to live for cached responses in seconds (one week)
+DISK_CACHE_MAX_ENTRIES = 50000  # max number of entries in the on-disk tier
+REDIS_KEY_PREFIX = "llm_cache:"
+
+
+def make_cache_key(module_name, prompt_version, model, kwargs):
+    """
+    Create a content-addressed key for a module invocation.
+    The key is the sha256 of the canonical JSON of (module name, prompt version, model, kwargs),
+    so the same inputs always map to the same key regardless of dictionary order.
+    """
+    payload = {
+        "module_name": module_name,
+        "prompt_version": prompt_version,
+        "model": model,
+        "kwargs": kwargs
+    }
+    canonical = json.dumps(payload, sort_keys=True,
+                           separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class LRUCacheTier:
+    """
+    In-process cache tier with least-recently-used eviction and a TTL on every entry
+    """
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            expires_at, value = self.entries[key]
+            # drop the entry if it has expired
+            if expires_at < time.time():
+                del self.entries[key]
+                return None
+            # mark the entry as most recently used
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, value)
+            self.entries.move_to_end(key)
+            # evict the least recently used entries
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class RedisCacheTier:
+    """
+    Shared cache tier stored in Redis so that every Flask and Celery worker can reuse responses.
+    Values are stored as JSON with a TTL, and Redis evicts keys when it runs out of memory
+    (the instance should use an allkeys-lru or volatile-lru maxmemory policy).
+    """
+
+    def __init__(self, redis_url, ttl=CACHE_TTL, prefix=REDIS_KEY_PREFIX):
+        import redis
+
+        self.redis = redis.Redis.from_url(redis_url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.redis.get(self.prefix + key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set(self, key, value):
+        self.redis.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+    def delete(self, key):
+        self.redis.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self.redis.scan_iter(match=self.prefix + "*"):
+            self.redis.delete(key)
+
+
+class DiskCacheTier:
+    """
+    Shared cache tier stored in a local SQLite file, for deployments where all workers
+    run on the same machine and Redis is not available.
+    Entries expire after the TTL and the oldest entries are evicted once max_entries is reached.
+    """
+
+    def __init__(self, path, max_entries=DISK_CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.local = threading.local()
+        # create the table if it doesn't exist
+        with self.get_connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value TEXT, expires_at REAL, last_used REAL)")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)")
+
+    def get_connection(self):
+        # sqlite connections can't be shared across threads or forked processes
+        connection = getattr(self.local, "connection", None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30)
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def get(self, key):
+        now = time.time()
+        with self.get_connection() as connection:
+            row = connection.execute(
+                "SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+                return None
+            connection.execute(
+                "UPDATE cache SET last_used = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        now = time.time()
+        with self.get_connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now + self.ttl, now))
+            # drop expired entries and then the least recently used ones above max_entries
+            connection.execute("DELETE FROM cache WHERE expires_at < ?", (now,))
+            connection.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,))
+
+    def delete(self, key):
+        with self.get_connection() as connection:
+            connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self):
+        with self.get_connection() as connection:
+            connection.execute("DELETE FROM cache")
+
+
+class LLMCache:
+    """
+    Two-tier cache for LLM module outputs.
+    Lookups go to the in-process LRU tier first and then to the (optional) shared tier.
+    Shared tier hits are copied into the LRU tier so repeat lookups stay in memory.
+    """
+
+    def __init__(self, local_tier=None, shared_tier=None):
+        self.local_tier = local_tier if local_tier is not None else LRUCacheTier()
+        self.shared_tier = shared_tier
+        self.lock = threading.Lock()
+        self.counters = {"local_hits": 0, "shared_hits": 0,
+                         "misses": 0, "sets": 0, "errors": 0}
+
+    def increment(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def get(self, key):
+        """
+        Returns the cached value for the key or None if there is no entry
+        """
+        value = self.local_tier.get(key)
+        if value is not None:
+            self.increment("local_hits")
+            return value
+
+        if self.shared_tier is not None:
+            # a broken shared tier should never fail the request
+            try:
+                value = self.shared_tier.get(key)
+            except Exception:
+                self.increment("errors")
+                value = None
+            if value is not None:
+                self.increment("shared_hits")
+                self.local_tier.set(key, value)
+                return value
+
+        self.increment("misses")
+        return None
+
+    def set(self, key, value):
+        """
+        Stores the value in every tier
+        """
+        self.increment("sets")
+        self.local_tier.set(key, value)
+        if self.shared_tier is not None:
+            try:
+                self.shared_tier.set(key, value)
+            except Exception:
+                self.increment("errors")
+
+    def delete(self, key):
+        """
+        Removes the key from every tier (e.g. when the cached output turned out to be invalid)
+        """
+        self.local_tier.delete(key)
+        if self.shared_tier is not None:
+            try:
+                self.shared_tier.delete(key)
+            except Exception:
+                self.increment("errors")
+
+    def clear(self):
+        self.local_tier.clear()
+        if self.shared_tier is not None:
+            self.shared_tier.clear()
+
+    def get_stats(self):
+        """
+        Returns the hit/miss counters and the hit rate
+        """
+        with self.lock:
+            stats = dict(self.counters)
+        hits = stats["local_hits"] + stats["shared_hits"]
+        lookups = hits + stats["misses"]
+        stats["hit_rate"] = hits / lookups if lookups > 0 else 0
+        stats["local_entries"] = len(self.local_tier)
+        return stats
@@ -0,0 +1,173 @@
+################################### Import Libraries ###################################
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from llm_metrics import record_queue_wait
+
+DEFAULT_MODEL_CONCURRENCY = 8  # concurrency cap for models without an explicit cap
+MAX_QUEUE_DEPTH = 256  # max number of calls waiting for a model before callers are blocked
+QUEUE_TIMEOUT = 60  # seconds a caller waits for a queue slot before the call is rejected
+
+
+class LLMQueueFullError(Exception):
+    """
+    Raised when a model's queue stays full for longer than the queue timeout
+    """
+    pass
+
+
+class LLMExecutor:
+    """
+    Shared executor for LLM calls with one bounded thread pool per model.
+
+    - each model gets at most model_concurrency[model] calls in flight
+    - at most max_queue_depth calls can wait for a model; further callers block
+      (back-pressure) and get an LLMQueueFullError after queue_timeout seconds
+    - queue depth, running calls and queue wait times are tracked per model
+    """
+
+    def __init__(self, model_concurrency, max_queue_depth=MAX_QUEUE_DEPTH, queue_timeout=QUEUE_TIMEOUT):
+        self.model_concurrency = dict(model_concurrency)
+        self.max_queue_depth = max_queue_depth
+        self.queue_timeout = queue_timeout
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.pools = {}
+        self.queue_slots = {}
+        self.stats = {}
+        self.pid = os.getpid()
+
+    def get_pool(self, model):
+        """
+        Get (or lazily create) the thread pool for a model
+        Pools are re-created after a fork since threads don't survive it
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pools = {}
+                self.queue_slots = {}
+                self.pid = os.getpid()
+            if model not in self.pools:
+                max_workers = self.model_concurrency.get(
+                    model, DEFAULT_MODEL_CONCURRENCY)
+                self.pools[model] = ThreadPoolExecutor(max_workers=max_workers,
+                                                       thread_name_prefix=f"llm-{model}",
+                                                       initializer=self.mark_worker_thread,
+                                                       initargs=(model,))
+                self.queue_slots[model] = threading.BoundedSemaphore(
+                    max_workers + self.max_queue_depth)
+                if model not in self.stats:
+                    self.stats[model] = {"max_concurrency": max_workers, "queued": 0, "running": 0,
+                                         "completed": 0, "failed": 0, "rejected": 0,
+                                         "total_queue_wait": 0.0, "max_queue_wait": 0.0}
+            return self.pools[model], self.queue_slots[model]
+
+    def mark_worker_thread(self, model):
+        self.local.model = model
+
+    def in_worker_thread(self, model):
+        """
+        Check if the current thread is one of the workers for a model
+        """
+        return getattr(self.local, "model", None) == model
+
+    def update_stats(self, model, **deltas):
+        with self.lock:
+            for key, delta in deltas.items():
+                self.stats[model][key] += delta
+
+    def submit(self, model, fn, *args, **kwargs):
+        """
+        Submit fn(*args, **kwargs) to the pool for the model and return a Future
+        Blocks while the model's queue is full
+        """
+        pool, queue_slots = self.get_pool(model)
+        if not queue_slots.acquire(timeout=self.queue_timeout):
+            self.update_stats(model, rejected=1)
+            raise LLMQueueFullError(f"Queue for {model} is full")
+
+        submitted_at = time.monotonic()
+        self.update_stats(model, queued=1)
+        # run fn in the caller's context, so its LLM requests count towards the caller's module invocation
+        context = contextvars.copy_context()
+
+        def call(queue_wait):
+            record_queue_wait(queue_wait)
+            return fn(*args, **kwargs)
+
+        def run():
+            queue_wait = time.monotonic() - submitted_at
+            with self.lock:
+                stats = self.stats[model]
+                stats["queued"] -= 1
+                stats["running"] += 1
+                stats["total_queue_wait"] += queue_wait
+                stats["max_queue_wait"] = max(stats["max_queue_wait"], queue_wait)
+            try:
+                result = context.run(call, queue_wait)
+                self.update_stats(model, completed=1)
+                return result
+            except Exception:
+                self.update_stats(model, failed=1)
+                raise
+            finally:
+                self.update_stats(model, running=-1)
+                queue_slots.release()
+
+        try:
+            return pool.submit(run)
+        except Exception:
+            # the pool is shutting down
+            self.update_stats(model, queued=-1)
+            queue_slots.release()
+            raise
+
+    def run(self, model, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs) in the pool for the model and wait for the result
+        If the caller is already a worker for the model, fn runs in the current thread
+        """
+        if self.in_worker_thread(model):
+            return fn(*args, **kwargs)
+        return self.submit(model, fn, *args, **kwargs).result()
+
+    def get_stats(self):
+        """
+        Returns the queue depth, running calls and queue wait times for each model
+        """
+        with self.lock:
+            stats = {model: dict(model_stats)
+                     for model, model_stats in self.stats.items()}
+        for model_stats in stats.values():
+            started = model_stats["completed"] + \
+                model_stats["failed"] + model_stats["running"]
+            model_stats["avg_queue_wait"] = model_stats["total_queue_wait"] / \
+                started if started > 0 else 0
+        return stats
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            pools = list(self.pools.values())
+            self.pools = {}
+            self.queue_slots = {}
+        for pool in pools:
+            pool.shutdown(wait=wait)
+
+
+class ModelExecutor:
+    """
+    View of an LLMExecutor bound to one model (passed to composite DSPy modules)
+    """
+
+    def __init__(self, executor, model):
+        self.executor = executor
+        self.model = model
+
+    def submit(self, fn, *args, **kwargs):
+        return self.executor.submit(self.model, fn, *args, **kwargs)
+
+    def run(self, fn, *args, **kwargs):
+        return self.executor.run(self.model, fn, *args, **kwargs)
@@ -0,0 +1,365 @@
+################################### Import Libraries ###################################
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# USD per 1M tokens for estimating the cost of the LLM calls
+# (the tokens come from the usage of real requests, RateLimitedOpenAI doesn't use dspy's request cache)
+# NOTE: update these when OpenAI changes its prices (models without a price are counted as free)
+MODEL_PRICES = {
+    "gpt-3.5-turbo": {"prompt": 0.5, "completion": 1.5},
+    "gpt-4o-2024-05-13": {"prompt": 5.0, "completion": 15.0}
+}
+# buckets (in seconds) of the wall time and queue wait histograms
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+LOG_LLM_CALLS = True  # log one structured (JSON) line per module invocation
+
+# the module invocation that the LLM requests in the current context belong to
+# (a context variable, so it follows the invocation into the executor threads and asyncio tasks)
+current_call = contextvars.ContextVar("current_llm_call", default=None)
+# queue wait of a submitted function that tracks its own invocation (see record_queue_wait)
+pending_queue_wait = contextvars.ContextVar("pending_llm_queue_wait", default=0.0)
+
+prometheus_metrics = None
+prometheus_lock = threading.Lock()
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    """
+    Estimated cost in USD of a number of prompt and completion tokens on a model
+    """
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        return 0.0
+    return (prompt_tokens * prices["prompt"] + completion_tokens * prices["completion"]) / 1000000
+
+
+def record_usage(model, prompt_tokens, completion_tokens, rate_limit_wait=0):
+    """
+    Add one LLM request to the module invocation of the current context (if any)
+    """
+    call = current_call.get()
+    if call is not None:
+        call.add_usage(model, prompt_tokens, completion_tokens, rate_limit_wait)
+
+
+def record_rate_limit_retry():
+    """
+    Add a retry after a rate limit error to the module invocation of the current context (if any)
+    """
+    call = current_call.get()
+    if call is not None:
+        call.add(rate_limit_retries=1)
+
+
+def record_queue_wait(queue_wait):
+    """
+    Add the time a call waited in the executor's queue to the module invocation of the current context.
+    If there is none, the submitted function tracks its own invocation (e.g. invoke_module submitted by
+    invoke_module_multiple_times), so the wait is kept for the next invocation tracked in this context.
+    """
+    call = current_call.get()
+    if call is not None:
+        call.add(queue_wait=queue_wait)
+    else:
+        pending_queue_wait.set(queue_wait)
+
+
+class LLMCall:
+    """
+    Measurements of one module invocation: the requests to each model, retries and queue wait.
+    Several threads can add to it (e.g. the assess modules of a composite module run concurrently),
+    so the queue wait of a composite module is the total over its requests.
+    """
+
+    def __init__(self, module, model, queue_wait=0.0):
+        self.module = module
+        self.model = model
+        self.cache_hit = False
+        self.lock = threading.Lock()
+        self.counters = {"queue_wait": queue_wait, "rate_limit_wait": 0.0, "rate_limit_retries": 0}
+        # model -> number of requests, prompt tokens and completion tokens
+        self.usage = {}
+        self.start_time = time.perf_counter()
+
+    def add(self, **amounts):
+        with self.lock:
+            for counter, amount in amounts.items():
+                self.counters[counter] += amount
+
+    def add_usage(self, model, prompt_tokens, completion_tokens, rate_limit_wait=0):
+        with self.lock:
+            usage = self.usage.setdefault(model, {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0})
+            usage["requests"] += 1
+            usage["prompt_tokens"] += prompt_tokens
+            usage["completion_tokens"] += completion_tokens
+            self.counters["rate_limit_wait"] += rate_limit_wait
+
+    def to_record(self, wall_time, error=None):
+        """
+        Returns the measurements as a dictionary (the structured log line of the invocation)
+        """
+        with self.lock:
+            usage = {model: dict(model_usage) for model, model_usage in self.usage.items()}
+            counters = dict(self.counters)
+        for model, model_usage in usage.items():
+            model_usage["cost_usd"] = estimate_cost(model, model_usage["prompt_tokens"],
+                                                    model_usage["completion_tokens"])
+        return {
+            "event": "llm_call",
+            "module": self.module,
+            "model": self.model,
+            "cache_hit": self.cache_hit,
+            "error": error,
+            "wall_time": round(wall_time, 4),
+            "queue_wait": round(counters["queue_wait"], 4),
+            "rate_limit_wait": round(counters["rate_limit_wait"], 4),
+            "rate_limit_retries": counters["rate_limit_retries"],
+            "requests": sum(model_usage["requests"] for model_usage in usage.values()),
+            "prompt_tokens": sum(model_usage["prompt_tokens"] for model_usage in usage.values()),
+            "completion_tokens": sum(model_usage["completion_tokens"] for model_usage in usage.values()),
+            "cost_usd": round(sum(model_usage["cost_usd"] for model_usage in usage.values()), 6),
+            "usage": usage
+        }
+
+
+class StatsCollector:
+    """
+    Prometheus collector that exports the numbers in get_stats() of a component as gauges when scraped,
+    e.g. the queue depths of the LLM executor (name_queued{model="..."}).
+    get_stats returns a dictionary of numbers, or a dictionary mapping from a label value to one (with label set)
+    """
+
+    def __init__(self, name, get_stats, label=None):
+        self.name = name
+        self.get_stats = get_stats
+        self.label = label
+
+    def collect(self):
+        from prometheus_client.core import GaugeMetricFamily
+
+        stats = self.get_stats()
+        label_stats = stats.items() if self.label is not None else [(None, stats)]
+        gauges = {}
+        for label_value, values in label_stats:
+            for key, value in values.items():
+                # skip flags and strings
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                if key not in gauges:
+                    gauges[key] = GaugeMetricFamily(f"{self.name}_{key}", f"{key} from {self.name} stats",
+                                                    labels=[self.label] if self.label is not None else None)
+                if self.label is not None:
+                    gauges[key].add_metric([label_value], value)
+                else:
+                    gauges[key].add_metric([], value)
+        return list(gauges.values())
+
+
+class PrometheusMetrics:
+    """
+    Prometheus metrics of the module invocations, labelled by module and model
+    """
+
+    def __init__(self, prometheus_client):
+        self.prometheus_client = prometheus_client
+        # StatsCollectors of components of this process (see add_stats)
+        self.stats_collectors = []
+        Counter, Histogram = prometheus_client.Counter, prometheus_client.Histogram
+        self.calls = Counter("llm_calls", "Module invocations",
+                             ["module", "model", "cache", "status"])
+        self.duration = Histogram("llm_call_duration_seconds", "Wall time of module invocations",
+                                  ["module", "model", "cache"], buckets=LATENCY_BUCKETS)
+        self.queue_wait = Histogram("llm_queue_wait_seconds", "Time module invocations waited for a model slot",
+                                    ["module", "model"], buckets=LATENCY_BUCKETS)
+        self.rate_limit_wait = Counter("llm_rate_limit_wait_seconds", "Time waited for the RPM and TPM budgets",
+                                       ["module", "model"])
+        self.rate_limit_retries = Counter("llm_rate_limit_retries", "Requests retried after a rate limit error",
+                                          ["module", "model"])
+        # the model of the requests (a CHECK_QUESTION invocation sends requests to GPT-3.5 and GPT-4)
+        self.requests = Counter("llm_requests", "Requests sent to the LLMs", ["module", "model"])
+        self.tokens = Counter("llm_tokens", "Prompt and completion tokens", ["module", "model", "kind"])
+        self.cost = Counter("llm_cost_usd", "Estimated cost of the requests in USD", ["module", "model"])
+        self.json_retries = Counter("llm_json_retries", "Invocations repeated because the output wasn't valid JSON",
+                                    ["module", "model"])
+        self.json_failures = Counter("llm_json_failures", "Invocations with no valid JSON output after all tries",
+                                     ["module", "model"])
+
+    def record_call(self, record):
+        module, model = record["module"], record["model"]
+        cache = "hit" if record["cache_hit"] else "miss"
+        self.calls.labels(module, model, cache, "error" if record["error"] else "ok").inc()
+        self.duration.labels(module, model, cache).observe(record["wall_time"])
+        if record["cache_hit"]:
+            return
+        self.queue_wait.labels(module, model).observe(record["queue_wait"])
+        self.rate_limit_wait.labels(module, model).inc(record["rate_limit_wait"])
+        self.rate_limit_retries.labels(module, model).inc(record["rate_limit_retries"])
+        for request_model, usage in record["usage"].items():
+            self.requests.labels(module, request_model).inc(usage["requests"])
+            self.tokens.labels(module, request_model, "prompt").inc(usage["prompt_tokens"])
+            self.tokens.labels(module, request_model, "completion").inc(usage["completion_tokens"])
+            self.cost.labels(module, request_model).inc(usage["cost_usd"])
+
+    def add_stats(self, name, get_stats, label=None):
+        """
+        Export the numbers in get_stats() as gauges (see StatsCollector)
+        """
+        collector = StatsCollector(name, get_stats, label)
+        self.stats_collectors.append(collector)
+        if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+            self.prometheus_client.REGISTRY.register(collector)
+
+    def render(self):
+        """
+        Returns the exposition of the metrics and its content type.
+        With PROMETHEUS_MULTIPROC_DIR set, the metrics of every process on the host (e.g. the Celery workers)
+        are collected from that directory. The gauges from add_stats are always the ones of the process
+        that serves the request.
+        """
+        prometheus_client = self.prometheus_client
+        if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+            from prometheus_client import multiprocess
+            registry = prometheus_client.CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+            for collector in self.stats_collectors:
+                registry.register(collector)
+        else:
+            registry = prometheus_client.REGISTRY
+        return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+
+
+def get_prometheus_metrics():
+    """
+    Returns the process's PrometheusMetrics (created once, since metrics can only be registered once),
+    or None if prometheus_client isn't installed
+    """
+    global prometheus_metrics
+    with prometheus_lock:
+        if prometheus_metrics is None:
+            try:
+                import prometheus_client
+            except ImportError:
+                return None
+            prometheus_metrics = PrometheusMetrics(prometheus_client)
+        return prometheus_metrics
+
+
+class LLMMetrics:
+    """
+    Records wall time, queue wait, tokens, retries, cache hits and estimated cost of every module invocation.
+
+    DSPyAccessor wraps each invocation in track_call(); the LLM requests, rate limit retries and executor
+    queue waits in the invocation's context are added to it with record_usage, record_rate_limit_retry and
+    record_queue_wait. Each invocation is logged as a JSON line, added to per-module counters (get_stats)
+    and exported as Prometheus metrics if prometheus_client is installed.
+    """
+
+    def __init__(self, logger=None, log_calls=LOG_LLM_CALLS, use_prometheus=True):
+        self.logger = logger
+        self.log_calls = log_calls
+        self.prometheus = get_prometheus_metrics() if use_prometheus else None
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def log(self, record):
+        if not self.log_calls:
+            return
+        if self.logger is not None:
+            self.logger.info("%s", json.dumps(record, sort_keys=True))
+        else:
+            print(json.dumps(record, sort_keys=True))
+
+    @contextmanager
+    def track_call(self, module, model):
+        """
+        Context manager that measures one module invocation and yields its LLMCall
+        """
+        queue_wait = pending_queue_wait.get()
+        pending_queue_wait.set(0.0)
+        call = LLMCall(module, model, queue_wait=queue_wait)
+        # the wall time includes the queue wait whether the invocation waited inside or outside track_call
+        call.start_time -= queue_wait
+        token = current_call.set(call)
+        error = None
+        try:
+            yield call
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            current_call.reset(token)
+            self.record_call(call.to_record(time.perf_counter() - call.start_time, error))
+
+    def get_module_stats(self, module, model):
+        # call with self.lock held
+        key = (module, model)
+        if key not in self.stats:
+            self.stats[key] = {"calls": 0, "cache_hits": 0, "errors": 0, "total_time": 0.0, "max_time": 0.0,
+                               "total_queue_wait": 0.0, "requests": 0, "prompt_tokens": 0,
+                               "completion_tokens": 0, "cost_usd": 0.0, "rate_limit_retries": 0,
+                               "json_retries": 0, "json_failures": 0}
+        return self.stats[key]
+
+    def record_call(self, record):
+        with self.lock:
+            stats = self.get_module_stats(record["module"], record["model"])
+            stats["calls"] += 1
+            stats["cache_hits"] += int(record["cache_hit"])
+            stats["errors"] += int(record["error"] is not None)
+            stats["total_time"] += record["wall_time"]
+            stats["max_time"] = max(stats["max_time"], record["wall_time"])
+            stats["total_queue_wait"] += record["queue_wait"]
+            stats["rate_limit_retries"] += record["rate_limit_retries"]
+            for counter in ["requests", "prompt_tokens", "completion_tokens", "cost_usd"]:
+                stats[counter] += record[counter]
+        if self.prometheus is not None:
+            self.prometheus.record_call(record)
+        self.log(record)
+
+    def record_json_output(self, module, model, num_tries, valid):
+        """
+        Record the number of tries invoke_module_json_output needed and if it got a valid output
+        """
+        num_retries = num_tries - 1
+        with self.lock:
+            stats = self.get_module_stats(module, model)
+            stats["json_retries"] += num_retries
+            stats["json_failures"] += int(not valid)
+        if self.prometheus is not None:
+            self.prometheus.json_retries.labels(module, model).inc(num_retries)
+            if not valid:
+                self.prometheus.json_failures.labels(module, model).inc()
+        if num_retries > 0 or not valid:
+            self.log({"event": "llm_json_output", "module": module, "model": model,
+                      "tries": num_tries, "valid": valid})
+
+    def get_stats(self):
+        """
+        Returns the counters of each module and model ("module/model"), slowest modules first
+        """
+        with self.lock:
+            stats = {f"{module}/{model}": dict(module_stats) for (module, model), module_stats in self.stats.items()}
+        for module_stats in stats.values():
+            module_stats["avg_time"] = module_stats["total_time"] / module_stats["calls"] \
+                if module_stats["calls"] > 0 else 0
+        return dict(sorted(stats.items(), key=lambda item: item[1]["total_time"], reverse=True))
+
+    def add_stats(self, name, get_stats, label=None):
+        """
+        Export the numbers in get_stats() of another component (e.g. the LLM executor) on /metrics as gauges
+        named name_<key>, labelled with label if get_stats returns a dictionary per label value
+        """
+        if self.prometheus is not None:
+            self.prometheus.add_stats(name, get_stats, label)
+
+    def render_prometheus(self):
+        """
+        Returns the Prometheus exposition of the metrics and its content type (None without prometheus_client)
+        """
+        if self.prometheus is None:
+            return None
+        return self.prometheus.render()
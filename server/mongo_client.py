@@ -0,0 +1,159 @@
+################################### Import Libraries ###################################
+import os
+import threading
+import time
+
+from pymongo import monitoring
+from pymongo.mongo_client import MongoClient
+from pymongo.server_api import ServerApi
+
+# Default settings for the MongoDB connection pool of each process (override them with FLASK_MONGO__<setting> environment variables)
+MONGO_CLIENT_SETTINGS = {
+    "maxPoolSize": 20,  # max connections per process (Flask threads and Celery threads share them)
+    "minPoolSize": 0,  # connections kept open when idle
+    "maxIdleTimeMS": 60 * 1000,  # close connections that are idle for longer than this
+    "waitQueueTimeoutMS": 5 * 1000,  # fail instead of waiting longer than this for a free connection
+    "connectTimeoutMS": 10 * 1000,
+    "serverSelectionTimeoutMS": 10 * 1000,
+    "readPreference": "primary"
+}
+SLOW_CHECKOUT_THRESHOLD = 0.5  # seconds waiting for a connection before the checkout is logged
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """
+    Connection pool listener that measures how long each checkout waited for a connection.
+    The checkout start time is kept per thread, since a checkout starts and ends in the same thread.
+    """
+
+    def __init__(self, logger=None, slow_threshold=SLOW_CHECKOUT_THRESHOLD):
+        self.logger = logger
+        self.slow_threshold = slow_threshold
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {"checkouts": 0, "checkout_failures": 0, "slow_checkouts": 0,
+                             "connections_created": 0, "connections_closed": 0, "pools_cleared": 0,
+                             "total_wait": 0, "max_wait": 0}
+
+    def increment(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def get_wait(self):
+        start = getattr(self.local, "checkout_start", None)
+        self.local.checkout_start = None
+        return time.monotonic() - start if start is not None else 0
+
+    def connection_check_out_started(self, event):
+        self.local.checkout_start = time.monotonic()
+
+    def connection_checked_out(self, event):
+        wait = self.get_wait()
+        with self.lock:
+            self.counters["checkouts"] += 1
+            self.counters["total_wait"] += wait
+            self.counters["max_wait"] = max(self.counters["max_wait"], wait)
+            if wait >= self.slow_threshold:
+                self.counters["slow_checkouts"] += 1
+        if wait >= self.slow_threshold and self.logger is not None:
+            self.logger.warning("Waited %.2f seconds for a MongoDB connection to %s", wait, event.address)
+
+    def connection_check_out_failed(self, event):
+        wait = self.get_wait()
+        self.increment("checkout_failures")
+        if self.logger is not None:
+            self.logger.error("MongoDB connection checkout failed after %.2f seconds: %s", wait, event.reason)
+
+    def connection_created(self, event):
+        self.increment("connections_created")
+
+    def connection_closed(self, event):
+        self.increment("connections_closed")
+
+    def pool_cleared(self, event):
+        self.increment("pools_cleared")
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats["mean_wait"] = stats["total_wait"] / stats["checkouts"] if stats["checkouts"] > 0 else 0
+        return stats
+
+
+class MongoClientFactory:
+    """
+    Creates one MongoClient per process, lazily on first use.
+
+    MongoClient isn't fork-safe, so a client created before a fork (e.g. in the Celery parent process)
+    is dropped in the child and the child creates its own on first use. Each process gets its own
+    connection pool with the settings in MONGO_CLIENT_SETTINGS (or the ones passed in).
+    """
+
+    def __init__(self, uri, logger=None, **settings):
+        self.uri = uri
+        self.settings = {**MONGO_CLIENT_SETTINGS, **settings}
+        self.logger = logger
+        self.listener = PoolStatsListener(logger=logger)
+        self.lock = threading.Lock()
+        self.client = None
+        self.pid = None
+        os.register_at_fork(after_in_child=self.after_fork)
+
+    def after_fork(self):
+        # don't close the parent's client here, its sockets are still used by the parent
+        self.client = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.listener.reset()
+
+    def get_client(self):
+        """
+        Returns the MongoClient of the current process (created on first use)
+        """
+        if self.client is not None and self.pid == os.getpid():
+            return self.client
+        with self.lock:
+            if self.client is None or self.pid != os.getpid():
+                self.client = MongoClient(self.uri, server_api=ServerApi('1'),
+                                          event_listeners=[self.listener], **self.settings)
+                self.pid = os.getpid()
+                if self.logger is not None:
+                    self.logger.info("Created MongoDB client for process %s (maxPoolSize %s)",
+                                     self.pid, self.settings["maxPoolSize"])
+        return self.client
+
+    def close(self):
+        with self.lock:
+            if self.client is not None and self.pid == os.getpid():
+                self.client.close()
+            self.client = None
+            self.pid = None
+
+    def get_stats(self):
+        """
+        Returns the pool settings and the checkout counters and wait times (in seconds) of the current process
+        """
+        stats = self.listener.get_stats()
+        stats["pid"] = os.getpid()
+        stats["max_pool_size"] = self.settings["maxPoolSize"]
+        stats["wait_queue_timeout_ms"] = self.settings["waitQueueTimeoutMS"]
+        return stats
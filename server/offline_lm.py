@@ -0,0 +1,306 @@
+################################### Import Libraries ###################################
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+
+from dspy_accessor import COMPOSITE_MODULES, MODULE_CLASSES, OUTPUT_FORMATS, SHARED_SUBMODULES, \
+    DSPyModule, ModuleRegistry
+from dspy_modules import CHECKS
+from llm_metrics import record_usage
+from rate_limiter import estimate_tokens
+
+# Default settings for the offline backend
+OFFLINE_LATENCY_MEAN = 1.5  # mean seconds per module call (log-normal distribution)
+OFFLINE_LATENCY_SIGMA = 0.5  # sigma of the log-normal latency distribution
+OFFLINE_ERROR_RATE = 0.0  # fraction of calls that raise an OfflineLMError (like an API error)
+OFFLINE_INVALID_OUTPUT_RATE = 0.0  # fraction of calls that return output that isn't valid JSON
+OFFLINE_MODEL = "offline"  # model name of the offline calls in the LLM metrics (no price, so no cost)
+# inputs that don't change the output of a module (ignored when matching recorded prompts)
+IGNORED_INPUTS = ["temp", "return_rationale", "n"]
+
+
+class OfflineLMError(Exception):
+    """
+    Simulated error of a module call (raised for OFFLINE_ERROR_RATE of the calls)
+    """
+
+
+def make_replay_key(module_name, inputs):
+    """
+    Key of a module call for replaying recorded prompts: the module name and the inputs that change the output
+    """
+    payload = {"module_name": module_name,
+               "inputs": {key: value for key, value in inputs.items() if key not in IGNORED_INPUTS}}
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def parse_json(value, default):
+    try:
+        return json.loads(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def split_topics(topics_str):
+    return [topic.strip() for topic in str(topics_str).split(";") if topic.strip() != ""]
+
+
+def make_question(main_text, rng, **fields):
+    """
+    Synthetic question with the fields of question_json_format (plus any extra fields)
+    """
+    question = {
+        "cell_type": "question",
+        "response_format": rng.choice(["open", "closed"]),
+        "time_estimate": rng.randint(1, 3),
+        "description": "",
+        "main_text": main_text,
+        "response_categories": []
+    }
+    if question["response_format"] == "closed":
+        question["response_categories"] = [{"id": i, "text": f"Option {i + 1}"} for i in range(3)]
+    question.update(fields)
+    return question
+
+
+def make_variants(question_str, rng, num_variants=3):
+    """
+    Synthetic rewordings of a question (JSON string) as a list of questions
+    """
+    question = parse_json(question_str, {})
+    if not isinstance(question, dict):
+        question = {}
+    main_text = question.get("main_text", "What do you think about this?")
+    return [make_question(f"{main_text} (version {i + 1})", rng,
+                          response_format=question.get("response_format", "open"),
+                          response_categories=question.get("response_categories", []))
+            for i in range(num_variants)]
+
+
+def synthesize_output(module_name, inputs, rng):
+    """
+    Synthetic output of a module with valid values for the module's output fields and OUTPUT_FORMATS
+    (built from the inputs where possible, e.g. classified topics are picked from all_topics)
+    """
+    if module_name == DSPyModule.CREATE_DRAFT:
+        sections = [{"id": i, "title": f"Section {i + 1}",
+                     "cells": [make_question(f"Question {j + 1} of section {i + 1}?", rng,
+                                             rationale="Synthetic question") for j in range(3)]}
+                    for i in range(3)]
+        return {"title": "Synthetic draft", "sections": json.dumps(sections)}
+    if module_name == DSPyModule.DETECT_TOPICS:
+        return {"topics": "\n".join(f"Topic {i + 1}" for i in range(rng.randint(3, 6)))}
+    if module_name == DSPyModule.CLASSIFY_TOPICS:
+        topics = split_topics(inputs.get("all_topics", ""))
+        classified_topics = lambda: "; ".join(rng.sample(topics, min(len(topics), rng.randint(1, 2))))
+        if inputs.get("n", 1) > 1:
+            return {"classified_topics": [classified_topics() for _ in range(inputs["n"])]}
+        return {"classified_topics": classified_topics()}
+    if module_name == DSPyModule.CLASSIFY_TOPICS_BATCH:
+        topics = split_topics(inputs.get("all_topics", ""))
+        questions = parse_json(inputs.get("questions"), [])
+        return {"classified_topics": json.dumps({
+            str(question.get("cell_id")): rng.sample(topics, min(len(topics), 1))
+            for question in questions if isinstance(question, dict)})}
+    if module_name == DSPyModule.CLASSIFY_QUESTION:
+        return {"question_type": rng.choice(["demographic", "attitudinal", "behavioral"]),
+                "rationale": "Synthetic rationale"}
+    if module_name == DSPyModule.CHECK_PROMPT:
+        return {"inform_score": str(rng.randint(1, 10)),
+                "suggestions": "Add more detail about the goals.; Describe who you want to engage.",
+                "rationale": "Synthetic rationale"}
+    if module_name in [DSPyModule.REWORD_QUESTION, DSPyModule.REWORD_QUESTION_FROM_REQUEST]:
+        return {"rewordings": json.dumps(make_variants(inputs.get("question"), rng))}
+    if module_name == DSPyModule.REWRITE_QUESTION:
+        return {"rewritten_questions": json.dumps(make_variants(inputs.get("question"), rng))}
+    if module_name == DSPyModule.SWITCH_RESPONSE_FORMAT:
+        question = make_variants(inputs.get("question"), rng, num_variants=1)[0]
+        question["response_format"] = "open" if question["response_format"] == "closed" else "closed"
+        question["response_categories"] = [] if question["response_format"] == "open" else \
+            [{"id": i, "text": f"Option {i + 1}"} for i in range(3)]
+        return {"new_question": json.dumps(question), "rationale": "Synthetic rationale"}
+    if module_name in [DSPyModule.ASSESS_READABILITY, DSPyModule.ASSESS_BIAS, DSPyModule.ASSESS_SPECIFICITY]:
+        check_name = module_name.name.replace("ASSESS_", "").lower()
+        return {"score": rng.choice(CHECKS[check_name]["all_scores"]),
+                "rationale": f"Synthetic {check_name} rationale"}
+    if module_name == DSPyModule.CLEAN_RATIONALE:
+        return {"new_rationale": f"The question may have {inputs.get('problem', 'a problem')}.",
+                "rationale": "Synthetic rationale"}
+    if module_name == DSPyModule.ADD_QUESTIONS_TO_TOPIC:
+        topic = inputs.get("topic", "the topic")
+        return {"additional_questions": json.dumps([
+            make_question(f"New question {i + 1} about {topic}?", rng, section_id=0, rationale="Synthetic rationale")
+            for i in range(2)])}
+    if module_name == DSPyModule.REMOVE_QUESTIONS_FROM_TOPIC:
+        existing_questions = [question for question in parse_json(inputs.get("existing_questions"), [])
+                              if isinstance(question, dict)]
+        num_to_remove = int(inputs.get("number_of_questions_to_remove", 1))
+        return {"questions_to_remove": json.dumps([
+            {**question, "rationale": "Synthetic rationale"} for question in existing_questions[:num_to_remove]])}
+    raise ValueError(f"No synthetic output for module {module_name}")
+
+
+class OfflineModule:
+    """
+    Stand-in for a DSPy module that gets its outputs from the offline backend
+    """
+
+    def __init__(self, module_name, backend):
+        self.module_name = module_name
+        self.backend = backend
+
+    def __call__(self, **kwargs):
+        return self.backend.run(self.module_name, kwargs)
+
+
+class OfflineBackend:
+    """
+    Offline stand-in for the LLMs for load testing without OpenAI (pass it to DSPyAccessor as offline_backend).
+
+    Each module call sleeps for a log-normal latency, and then fails for error_rate of the calls,
+    returns invalid JSON for invalid_output_rate of the calls (so the retry paths run), or returns an output.
+    Outputs are replayed from recorded prompts (see load_recorded_prompts) when a recorded prompt of
+    the module has the same inputs, or any recorded output of the module if replay_any is set,
+    and otherwise synthesized for the module's output format.
+    The composite modules run their own code on top of offline assess, clean rationale and rewrite modules.
+
+    Every random choice comes from a generator seeded with the seed, the inputs and the number of
+    calls with those inputs, so the same sequence of requests gets the same outputs and latencies.
+    """
+
+    def __init__(self, latency_mean=OFFLINE_LATENCY_MEAN, latency_sigma=OFFLINE_LATENCY_SIGMA,
+                 error_rate=OFFLINE_ERROR_RATE, invalid_output_rate=OFFLINE_INVALID_OUTPUT_RATE,
+                 module_latency=None, replay_any=True, seed=0):
+        self.latency_mean = latency_mean
+        self.latency_sigma = latency_sigma
+        # optional dictionary mapping from module name to mean latency (e.g. slower GPT-4 modules)
+        self.module_latency = module_latency if module_latency is not None else {}
+        self.error_rate = error_rate
+        self.invalid_output_rate = invalid_output_rate
+        self.replay_any = replay_any
+        self.seed = seed
+        # recorded outputs: replay key -> outputs, module name -> outputs, module name -> sets of input names
+        self.recorded = {}
+        self.recorded_by_module = {}
+        self.input_names = {}
+        self.call_counts = {}
+        self.lock = threading.Lock()
+        self.counters = {"calls": 0, "replayed": 0, "replayed_any": 0, "synthesized": 0,
+                         "errors": 0, "invalid_outputs": 0}
+
+    def increment(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def add_recorded_prompt(self, module_value, prompt_inputs, prompt_outputs):
+        """
+        Add a recorded prompt (module name string, inputs and outputs as in the prompts collection)
+        """
+        if not isinstance(prompt_inputs, dict) or not isinstance(prompt_outputs, dict):
+            return
+        try:
+            module_name = DSPyModule(module_value)
+        except ValueError:
+            return
+        with self.lock:
+            self.recorded.setdefault(make_replay_key(module_name.value, prompt_inputs), []).append(prompt_outputs)
+            self.recorded_by_module.setdefault(module_name, []).append(prompt_outputs)
+            input_names = tuple(sorted(key for key in prompt_inputs if key not in IGNORED_INPUTS))
+            self.input_names.setdefault(module_name, set()).add(input_names)
+
+    def load_recorded_prompts(self, db, query=None, limit=None):
+        """
+        Load recorded prompts from the prompts collection (query is an optional filter, e.g. on module_name)
+        Only outputs of the real models are loaded (get_prompts skips the ones tagged as offline)
+        Returns the number of prompts loaded
+        """
+        num_prompts = 0
+        for prompt in db.get_prompts(query):
+            self.add_recorded_prompt(prompt.get("module_name"), prompt.get("prompt_inputs"),
+                                     prompt.get("prompt_outputs"))
+            num_prompts += 1
+            if limit is not None and num_prompts >= limit:
+                break
+        return num_prompts
+
+    def get_rng(self, module_name, inputs):
+        key = make_replay_key(module_name.value, inputs)
+        with self.lock:
+            count = self.call_counts.get(key, 0)
+            self.call_counts[key] = count + 1
+        return random.Random(f"{self.seed}:{key}:{count}")
+
+    def get_recorded_output(self, module_name, inputs, rng):
+        """
+        Returns a recorded output for the inputs (or any recorded output of the module if replay_any is set)
+        """
+        for input_names in self.input_names.get(module_name, []):
+            if all(name in inputs for name in input_names):
+                outputs = self.recorded.get(make_replay_key(
+                    module_name.value, {name: inputs[name] for name in input_names}))
+                if outputs:
+                    self.increment("replayed")
+                    return rng.choice(outputs)
+        if self.replay_any and self.recorded_by_module.get(module_name):
+            self.increment("replayed_any")
+            return rng.choice(self.recorded_by_module[module_name])
+        return None
+
+    def get_output(self, module_name, inputs, rng):
+        output = self.get_recorded_output(module_name, inputs, rng)
+        if output is None:
+            self.increment("synthesized")
+            return synthesize_output(module_name, inputs, rng)
+
+        output = json.loads(json.dumps(output))
+        # modules that return n completions return a list of outputs
+        if module_name == DSPyModule.CLASSIFY_TOPICS:
+            first_output = output["classified_topics"][0] if isinstance(output.get("classified_topics"), list) \
+                else output.get("classified_topics", "")
+            if inputs.get("n", 1) > 1:
+                output["classified_topics"] = [first_output] * inputs["n"]
+            else:
+                output["classified_topics"] = first_output
+        return output
+
+    def run(self, module_name, inputs):
+        """
+        Simulate one call of a module (sleeps for the latency and may raise OfflineLMError)
+        """
+        self.increment("calls")
+        rng = self.get_rng(module_name, inputs)
+        latency_mean = self.module_latency.get(module_name, self.latency_mean)
+        if latency_mean > 0:
+            # log-normal with the given mean: mu = log(mean) - sigma^2 / 2
+            time.sleep(rng.lognormvariate(math.log(latency_mean) - self.latency_sigma ** 2 / 2, self.latency_sigma))
+
+        if rng.random() < self.error_rate:
+            self.increment("errors")
+            raise OfflineLMError(f"Simulated error in {module_name.value}")
+
+        output = self.get_output(module_name, inputs, rng)
+        if OUTPUT_FORMATS[module_name] in ["list", "json"] and rng.random() < self.invalid_output_rate:
+            self.increment("invalid_outputs")
+            output = {key: "Sorry, I can't help with that." if isinstance(value, str) else value
+                      for key, value in output.items()}
+        # estimated tokens, so the load tests see the token metrics of each module
+        record_usage(OFFLINE_MODEL, estimate_tokens(json.dumps(inputs, default=str)),
+                     estimate_tokens(json.dumps(output, default=str)))
+        return output
+
+    def make_registry(self):
+        """
+        Returns a ModuleRegistry where every module except the composite modules is an OfflineModule
+        """
+        module_classes = {module_name: module_class if module_name in COMPOSITE_MODULES
+                          else (lambda module_name=module_name: OfflineModule(module_name, self))
+                          for module_name, module_class in MODULE_CLASSES.items()}
+        return ModuleRegistry(module_classes, SHARED_SUBMODULES)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.counters)
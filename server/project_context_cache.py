@@ -0,0 +1,163 @@
+################################### Import Libraries ###################################
+import json
+import threading
+
+from llm_cache import LRUCacheTier
+
+CONTEXT_CACHE_MAX_ENTRIES = 1000  # max number of projects in the in-process LRU tier
+CONTEXT_CACHE_TTL = 60 * 60  # seconds to keep a project context (a safety net, changes invalidate it right away)
+CONTEXT_KEY_PREFIX = "project_context:"  # Redis key with the cached context of a project
+VERSION_KEY_PREFIX = "project_context_version:"  # Redis key with the context version of a project
+CONTEXT_FIELD = "context_response"  # field of the projects collection the cache depends on
+
+
+def get_draft_type(context):
+    """
+    Returns the draft type of a context (lowercase, with underscores between words, e.g. "conversation_guide")
+    or None if the context doesn't have one yet
+    """
+    draft_type = context.get("4", {}).get("response")
+    if not isinstance(draft_type, str):
+        return None
+    # if the draft_type has multiple words, combine with underscore
+    return "_".join(draft_type.lower().split())
+
+
+class ProjectContextCache:
+    """
+    Cache for the context of a project and the values derived from it (the formatted context and the draft type).
+
+    Entries are tagged with the project's context version. Without Redis the version is always 0 and
+    the cache only lives in this process. With Redis the version is a counter that every process reads
+    before using its in-process entry, and invalidate() increments it so stale entries in other workers
+    (Flask and Celery) are ignored. A Redis error skips the cache (never serves a possibly stale context).
+
+    Register invalidate_on_change with db.add_project_listener so every change to context_response
+    (through edit_project_fields, apply_project_delta or delete_project) invalidates the entry.
+    """
+
+    def __init__(self, db, format_context, redis_url=None, max_entries=CONTEXT_CACHE_MAX_ENTRIES,
+                 ttl=CONTEXT_CACHE_TTL):
+        self.db = db
+        self.format_context = format_context
+        self.ttl = ttl
+        self.local_tier = LRUCacheTier(max_entries=max_entries, ttl=ttl)
+        self.redis = None
+        if redis_url is not None:
+            import redis
+
+            self.redis = redis.Redis.from_url(redis_url)
+        self.lock = threading.Lock()
+        self.counters = {"local_hits": 0, "shared_hits": 0,
+                         "misses": 0, "invalidations": 0, "errors": 0}
+
+    def increment(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def get_version(self, project_id):
+        """
+        Returns the current context version of a project (None if it can't be read)
+        """
+        if self.redis is None:
+            return 0
+        try:
+            version = self.redis.get(VERSION_KEY_PREFIX + project_id)
+        except Exception:
+            self.increment("errors")
+            return None
+        return int(version) if version is not None else 0
+
+    def get_shared_entry(self, project_id):
+        try:
+            entry = self.redis.get(CONTEXT_KEY_PREFIX + project_id)
+        except Exception:
+            self.increment("errors")
+            return None
+        return json.loads(entry) if entry is not None else None
+
+    def set_shared_entry(self, project_id, entry):
+        try:
+            self.redis.set(CONTEXT_KEY_PREFIX + project_id, json.dumps(entry), ex=self.ttl)
+        except Exception:
+            self.increment("errors")
+
+    def get(self, project_id):
+        """
+        Returns {"context", "formatted_context", "draft_type"} for a project or None if the project doesn't exist
+        """
+        version = self.get_version(project_id)
+        if version is not None:
+            entry = self.local_tier.get(project_id)
+            if entry is not None and entry["version"] == version:
+                self.increment("local_hits")
+                return entry
+
+            if self.redis is not None:
+                entry = self.get_shared_entry(project_id)
+                if entry is not None and entry["version"] == version:
+                    self.increment("shared_hits")
+                    self.local_tier.set(project_id, entry)
+                    return entry
+
+        self.increment("misses")
+        context = self.db.get_field_in_project(project_id, CONTEXT_FIELD)
+        if context is None:
+            return None
+        entry = {
+            "version": version,
+            "context": context,
+            "formatted_context": self.format_context(context),
+            "draft_type": get_draft_type(context)
+        }
+        # an entry read while the version was unknown is only returned, never cached
+        if version is not None:
+            self.local_tier.set(project_id, entry)
+            if self.redis is not None:
+                self.set_shared_entry(project_id, entry)
+        return entry
+
+    def invalidate(self, project_id):
+        """
+        Drops the cached context of a project in every process (call it after the new context is saved)
+        """
+        self.increment("invalidations")
+        self.local_tier.delete(project_id)
+        if self.redis is not None:
+            try:
+                pipeline = self.redis.pipeline()
+                pipeline.incr(VERSION_KEY_PREFIX + project_id)
+                pipeline.delete(CONTEXT_KEY_PREFIX + project_id)
+                pipeline.execute()
+            except Exception:
+                self.increment("errors")
+
+    def forget(self, project_id):
+        """
+        Removes every cache key of a deleted project (invalidate keeps the version key)
+        """
+        self.local_tier.delete(project_id)
+        if self.redis is not None:
+            try:
+                self.redis.delete(VERSION_KEY_PREFIX + project_id, CONTEXT_KEY_PREFIX + project_id)
+            except Exception:
+                self.increment("errors")
+
+    def invalidate_on_change(self, project_id, fields):
+        """
+        Project listener for db.add_project_listener (fields is None when the whole project changed)
+        """
+        if fields is None or any(field.split(".")[0] == CONTEXT_FIELD for field in fields):
+            self.invalidate(project_id)
+
+    def get_stats(self):
+        """
+        Returns the hit/miss counters and the hit rate
+        """
+        with self.lock:
+            stats = dict(self.counters)
+        hits = stats["local_hits"] + stats["shared_hits"]
+        lookups = hits + stats["misses"]
+        stats["hit_rate"] = hits / lookups if lookups > 0 else 0
+        stats["local_entries"] = len(self.local_tier)
+        return stats
@@ -0,0 +1,157 @@
+################################### Import Libraries ###################################
+import atexit
+import copy
+import os
+import queue
+import threading
+import time
+
+MAX_QUEUE_SIZE = 10000  # max number of prompts waiting to be written (new prompts are dropped after that)
+BATCH_SIZE = 100  # max number of prompts written with one insert_many
+FLUSH_INTERVAL = 2  # max seconds a prompt waits in the queue before it's written
+SHUTDOWN_TIMEOUT = 10  # max seconds to wait for the queue to drain on shutdown
+
+
+class PromptLogWriter:
+    """
+    Write-behind queue for the prompts collection.
+
+    add_prompt() only puts the prompt in a queue, and a background thread writes the queued prompts
+    with insert_many once BATCH_SIZE prompts are waiting or FLUSH_INTERVAL seconds have passed.
+    The thread is started lazily in each process (so it works in forked Celery workers)
+    and the queue is drained when the process exits. Celery's pool processes skip atexit handlers,
+    so the server also calls close() from the worker shutdown signals and flush() after each task.
+    """
+
+    def __init__(self, db, logger=None, max_queue_size=MAX_QUEUE_SIZE, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL, offline=False):
+        self.db = db
+        # tag the prompts as outputs of the offline LLMs (so they are left out of the exports and replays)
+        self.offline = offline
+        self.logger = logger
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.counters = {"enqueued": 0, "written": 0,
+                         "dropped": 0, "failed": 0, "batches": 0}
+        self.pid = None
+        self.queue = None
+        self.thread = None
+        self.stop_event = None
+
+    def log_error(self, message, *args):
+        if self.logger is not None:
+            self.logger.error(message, *args)
+        else:
+            print(message % args)
+
+    def increment(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def ensure_started(self):
+        """
+        Start the background thread for the current process if it isn't running
+        """
+        with self.lock:
+            if self.pid == os.getpid() and self.thread is not None and self.thread.is_alive():
+                return
+            # threads and queues don't survive a fork, so each process gets its own
+            if self.pid != os.getpid():
+                self.queue = queue.Queue(maxsize=self.max_queue_size)
+                self.stop_event = threading.Event()
+                atexit.register(self.close)
+                self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.run, name="prompt-log-writer", daemon=True)
+            self.thread.start()
+
+    def add_prompt(self, project_id, module_name, prompt_inputs, prompt_outputs):
+        """
+        Queue a prompt to be inserted into the prompts collection (same arguments as db.add_prompt)
+        Returns False if the queue is full and the prompt was dropped
+        """
+        self.ensure_started()
+        # copy the inputs and outputs since callers can keep changing them after this returns
+        prompt_doc = self.db.make_prompt_doc(project_id, module_name,
+                                             copy.deepcopy(prompt_inputs),
+                                             copy.deepcopy(prompt_outputs),
+                                             offline=self.offline)
+        try:
+            self.queue.put_nowait(prompt_doc)
+        except queue.Full:
+            self.increment("dropped")
+            return False
+        self.increment("enqueued")
+        return True
+
+    def get_batch(self):
+        """
+        Wait for the next batch of prompts (returns an empty list if nothing was queued)
+        """
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def write_batch(self, batch):
+        if len(batch) == 0:
+            return
+        try:
+            self.db.add_prompts(batch)
+            self.increment("written", len(batch))
+            self.increment("batches")
+        except Exception as e:
+            self.increment("failed", len(batch))
+            self.log_error("Error when writing %s prompts: %s", len(batch), e)
+
+    def run(self):
+        """
+        Background thread that writes the queued prompts in batches
+        """
+        while not self.stop_event.is_set():
+            self.write_batch(self.get_batch())
+
+    def flush(self):
+        """
+        Write everything that is in the queue right now (in the calling thread)
+        """
+        if self.queue is None or self.pid != os.getpid():
+            return
+        while True:
+            batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if len(batch) == 0:
+                return
+            self.write_batch(batch)
+
+    def close(self, timeout=SHUTDOWN_TIMEOUT):
+        """
+        Stop the background thread and drain the queue
+        """
+        if self.pid != os.getpid():
+            return
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        self.flush()
+
+    def get_stats(self):
+        """
+        Returns the queue depth and the enqueued, written, dropped and failed counters
+        """
+        with self.lock:
+            stats = dict(self.counters)
+        stats["queue_depth"] = self.queue.qsize() if self.queue is not None else 0
+        return stats
@@ -0,0 +1,216 @@
+################################### Import Libraries ###################################
+import math
+import random
+import threading
+import time
+
+CHARS_PER_TOKEN = 4  # rough number of characters per token for English text
+MAX_RETRIES = 6  # max number of retries after a rate limit (or other retried) error
+BASE_BACKOFF = 1  # seconds to wait after the first rate limit error
+MAX_BACKOFF = 60  # max seconds to wait between retries
+REDIS_KEY_PREFIX = "rate_limit:"
+
+# Lua script that refills a bucket and takes tokens from it atomically in Redis
+# a negative amount refunds tokens (the balance never goes above capacity, like TokenBucket.refund)
+# returns the number of seconds until the bucket is back to zero (as a string to keep the decimals)
+RESERVE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local amount = tonumber(ARGV[3])
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, math.min(capacity, tokens + (now - updated) * rate) - amount)
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+if tokens >= 0 then
+    return '0'
+end
+return tostring(-tokens / rate)
+"""
+
+
+def estimate_tokens(text):
+    """
+    Estimate the number of tokens in a string
+    """
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+class TokenBucket:
+    """
+    In-process token bucket.
+    reserve() always takes the tokens (the balance can go negative) and returns how long the caller
+    has to wait for the balance to be paid back, so callers are scheduled in the order they arrive.
+    """
+
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.refill_per_second)
+            self.updated = now
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.refill_per_second
+
+    def refund(self, amount):
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RedisTokenBucket:
+    """
+    Token bucket stored in Redis so the budget is shared by every Flask and Celery worker
+    """
+
+    def __init__(self, redis_client, key, capacity, refill_per_second):
+        self.redis = redis_client
+        self.key = key
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.script = redis_client.register_script(RESERVE_SCRIPT)
+
+    def reserve(self, amount):
+        try:
+            delay = self.script(keys=[self.key],
+                                args=[self.capacity, self.refill_per_second, amount])
+        except Exception:
+            # if Redis is unavailable, don't block the call (OpenAI's 429s are still handled by the backoff)
+            return 0
+        return float(delay)
+
+    def refund(self, amount):
+        # the script clamps the balance to capacity after adding the refunded tokens
+        self.reserve(-amount)
+
+
+class RateLimiter:
+    """
+    Keeps each model under its requests per minute (RPM) and tokens per minute (TPM) budgets.
+    limits is a dictionary mapping from model name to {"rpm": number, "tpm": number}
+    Models without limits are not rate limited.
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "throttled": 0, "total_wait": 0.0}
+
+    def create_bucket(self, model, kind, limit):
+        return TokenBucket(limit, limit / 60)
+
+    def get_buckets(self, model):
+        with self.lock:
+            if model not in self.buckets:
+                if model not in self.limits:
+                    return None
+                self.buckets[model] = {kind: self.create_bucket(model, kind, limit)
+                                       for kind, limit in self.limits[model].items()}
+            return self.buckets[model]
+
+    def acquire(self, model, tokens):
+        """
+        Block until a request with the estimated number of tokens fits in the model's budgets
+        Returns the number of seconds spent waiting
+        """
+        buckets = self.get_buckets(model)
+        if buckets is None:
+            return 0
+
+        delay = 0
+        if "rpm" in buckets:
+            delay = max(delay, buckets["rpm"].reserve(1))
+        if "tpm" in buckets:
+            delay = max(delay, buckets["tpm"].reserve(tokens))
+
+        with self.lock:
+            self.stats["requests"] += 1
+            if delay > 0:
+                self.stats["throttled"] += 1
+                self.stats["total_wait"] += delay
+
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def refund(self, model, tokens):
+        """
+        Give back tokens that were reserved but not used (e.g. when the real usage was lower than the estimate)
+        """
+        buckets = self.get_buckets(model)
+        if buckets is not None and "tpm" in buckets and tokens > 0:
+            buckets["tpm"].refund(tokens)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+
+class RedisRateLimiter(RateLimiter):
+    """
+    RateLimiter with the buckets stored in Redis
+    """
+
+    def __init__(self, redis_url, limits, prefix=REDIS_KEY_PREFIX):
+        import redis
+
+        super().__init__(limits)
+        self.redis = redis.Redis.from_url(redis_url)
+        self.prefix = prefix
+
+    def create_bucket(self, model, kind, limit):
+        return RedisTokenBucket(self.redis, f"{self.prefix}{model}:{kind}", limit, limit / 60)
+
+
+def get_retry_after(error):
+    """
+    Get the number of seconds to wait from the Retry-After headers of a rate limit error (or None)
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers is None:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers.get("retry-after-ms")) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers.get("retry-after"))
+    except ValueError:
+        return None
+    return None
+
+
+def call_with_backoff(request, retry_errors, max_retries=MAX_RETRIES,
+                      base_backoff=BASE_BACKOFF, max_backoff=MAX_BACKOFF, on_retry=None):
+    """
+    Call request() and retry on retry_errors with exponential backoff (with jitter)
+    If the error has a Retry-After header, wait for that long instead
+    on_retry(error, delay) is called before each retry
+    """
+    num_retries = 0
+    while True:
+        try:
+            return request()
+        except retry_errors as error:
+            if num_retries >= max_retries:
+                raise
+            delay = get_retry_after(error)
+            if delay is None:
+                delay = min(max_backoff, base_backoff * 2 ** num_retries)
+                delay = delay * (0.5 + random.random() / 2)
+            num_retries += 1
+            if on_retry is not None:
+                on_retry(error, delay)
+            time.sleep(delay)
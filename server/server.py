@@ -1,26 +1,42 @@
+import asyncio
 import json
 import logging
 from math import ceil, floor
+import os
 import random
-import pandas as pd
 import time
-import threading
 
 from db import MongoDB
-from dspy_accessor import DSPyAccessor, DSPyModule
-from flask import Flask, jsonify, request
+from dspy_accessor import DSPyAccessor, DSPyModule, RATE_LIMITS
+from llm_cache import RedisCacheTier
+from mongo_client import MONGO_CLIENT_SETTINGS, MongoClientFactory
+from offline_lm import OfflineBackend
+from project_context_cache import ProjectContextCache
+from prompt_logger import PromptLogWriter
+from rate_limiter import RedisRateLimiter, estimate_tokens
+from task_progress import DONE_EVENT, TaskProgress
+from topic_prefilter import TopicPrefilter
+from flask import Flask, Response, g, has_app_context, jsonify, request, stream_with_context
 from flask_cors import cross_origin
 from flask_login import LoginManager, current_user, login_required, login_user
 from passwords import mongodb_uri, flask_secret_key, redis_broker_url
-from pymongo.mongo_client import MongoClient
-from pymongo.server_api import ServerApi
 from werkzeug.exceptions import InternalServerError, NotFound
 from celery import Celery, Task, shared_task
 from celery.result import AsyncResult
+from celery.signals import task_postrun, worker_init, worker_process_shutdown, worker_shutdown
 
 TEMPERATURE = 0.7
 WRITE_TO_DB = True
+USE_TRANSACTIONS = False # apply each save of a project in a transaction (needs a replica set)
 CHECK_PROMPT_THRESHOLD = 5
+BATCH_TOPIC_CLASSIFICATION = False # classify several questions per call in analyze_topics
+PREFILTER_TOPICS = False # classify questions that obviously match a topic without the LLM in analyze_topics
+# replay recorded or synthetic LLM outputs instead of calling OpenAI (for load tests, set OFFLINE_LM=1)
+OFFLINE_LM = os.environ.get("OFFLINE_LM") == "1"
+# MongoDB to use instead of the one in passwords.py (e.g. a local one for the benchmarks)
+MONGODB_URI = os.environ.get("MONGODB_URI", mongodb_uri)
+MONGO_ENV_PREFIX = "FLASK_MONGO__"  # prefix of the environment variables that override MONGO_CLIENT_SETTINGS
+OFFLINE_REPLAY_LIMIT = 10000 # max number of recorded prompts loaded for OFFLINE_LM
 
 app = Flask(__name__)
 
@@ -37,19 +53,74 @@ app.config['SECRET_KEY'] = flask_secret_key
 login_manager = LoginManager()
 login_manager.init_app(app)
 
-client = MongoClient(mongodb_uri, server_api=ServerApi('1'))
+# MongoDB connection pool settings (each Flask and Celery worker process gets its own client and pool)
+app.config.from_mapping(MONGO=dict(MONGO_CLIENT_SETTINGS))
+# override them from the environment, e.g. FLASK_MONGO__maxPoolSize=50 (values are parsed as JSON)
+# only these variables are read, so other FLASK_* variables can't override e.g. SECRET_KEY or DEBUG
+for env_key, env_value in os.environ.items():
+    if env_key.startswith(MONGO_ENV_PREFIX):
+        try:
+            env_value = json.loads(env_value)
+        except json.JSONDecodeError:
+            pass  # keep it as a string, e.g. FLASK_MONGO__readPreference=secondaryPreferred
+        app.config["MONGO"][env_key[len(MONGO_ENV_PREFIX):]] = env_value
+
+# the client is created lazily in each process, so Celery's forked workers don't share the parent's sockets
+mongo_clients = MongoClientFactory(MONGODB_URI, logger=app.logger, **app.config["MONGO"])
+db = MongoDB(client_factory=mongo_clients)
 
 # Send a ping to confirm a successful connection
 try:
-    client.admin.command('ping')
+    db.client.admin.command('ping')
     app.logger.info(
         "Pinged your deployment. You successfully connected to MongoDB!")
 except Exception as db_error:
     app.logger.error(db_error)
 
-db = MongoDB(client)
+# create any missing indexes (this is a no-op when they already exist)
+try:
+    _, index_failures = db.ensure_indexes()
+    for collection, keys, index_error in index_failures:
+        app.logger.error("Error when creating index %s on %s: %s", keys, collection, index_error)
+except Exception as db_error:
+    app.logger.error("Error when creating the indexes")
+    app.logger.error(db_error)
 
-dspya = DSPyAccessor(app)
+# write the prompts and responses to the prompts collection in the background
+prompt_log = PromptLogWriter(db, logger=app.logger, offline=OFFLINE_LM)
+
+# share cached LLM outputs and the OpenAI rate limit budgets across Flask and Celery workers through Redis
+# and persist the question assessments in MongoDB
+offline_backend = None
+if OFFLINE_LM:
+    offline_backend = OfflineBackend()
+    try:
+        app.logger.info("Loaded %s recorded prompts for the offline LLMs",
+                        offline_backend.load_recorded_prompts(db, limit=OFFLINE_REPLAY_LIMIT))
+    except Exception as db_error:
+        app.logger.error("Error when loading the recorded prompts, only synthetic outputs will be used")
+        app.logger.error(db_error)
+
+dspya = DSPyAccessor(app,
+                     shared_cache=RedisCacheTier(redis_broker_url),
+                     rate_limiter=RedisRateLimiter(redis_broker_url, RATE_LIMITS),
+                     db=db,
+                     offline_backend=offline_backend)
+# export the queued and running calls and the queue waits of each model on /metrics
+dspya.metrics.add_stats("llm_executor", dspya.executor.get_stats, label="model")
+# and the MongoDB connection pool checkouts and waits of the process
+dspya.metrics.add_stats("mongo_pool", lambda: {key: value for key, value in mongo_clients.get_stats().items()
+                                               if key != "pid"})
+
+# cache of each project's formatted context and draft_type (invalidated in every worker when the context changes)
+project_contexts = ProjectContextCache(db, dspya.format_context, redis_url=redis_broker_url)
+db.add_project_listener(project_contexts.invalidate_on_change)
+
+# local TF-IDF index used to skip the LLM for obvious topic classifications
+topic_prefilter = TopicPrefilter()
+
+# progress events of the Celery tasks (pushed to the UI with server-sent events)
+task_progress = TaskProgress(redis_broker_url)
 
 ################################### CELERY CODE ###################################
 
@@ -78,6 +149,24 @@ app.config.from_mapping(
 # Initialize Celery
 celery = celery_init_app(app)
 
+
+@worker_init.connect
+def warm_up_worker(**kwargs):
+    # the DSPy modules are created on first use, but the Celery parent process creates all of them
+    # before it forks so the worker processes don't each load them again
+    dspya.warm_up()
+
+@task_postrun.connect
+def flush_prompt_log(**kwargs):
+    # write the task's prompts before the worker picks up the next task
+    prompt_log.flush()
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def close_prompt_log(**kwargs):
+    # Celery's pool processes exit with os._exit, so the atexit handler of the prompt log never runs there
+    prompt_log.close()
+
 ################################### LOGIN MANAGER CODE ###################################
 
 # create a user class
@@ -106,6 +195,19 @@ def load_user(user_id):
 
 ################################### API ENDPOINTS ###################################
 
+def get_project_context(project_id):
+    """
+    Returns {"context", "formatted_context", "draft_type"} for a project
+    The result is kept for the rest of the request (or Celery task) and cached across requests in project_contexts
+    """
+    if not has_app_context():
+        return project_contexts.get(project_id)
+    if "project_contexts" not in g:
+        g.project_contexts = {}
+    if project_id not in g.project_contexts:
+        g.project_contexts[project_id] = project_contexts.get(project_id)
+    return g.project_contexts[project_id]
+
 ################################### TEST ENDPOINTS ###################################
 
 @shared_task(ignore_result=False)
@@ -156,6 +258,59 @@ def get_result(id, timestamp):
         app.logger.error(e)
         raise InternalServerError() from e
 
+@app.route('/api/stream_result/<id>', methods=["GET"])
+@cross_origin()
+def stream_result(id):
+    """
+    Front-end sends task id
+    Back-end streams the progress events of the task as server-sent events
+    The last event is a "done" event with the same fields as get_result
+    """
+    try:
+        app.logger.info("Streaming result for task %s", id)
+
+        def format_event(event, data):
+            return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+        def generate_events():
+            # the task might have finished before it published any progress (e.g. a task from before the deploy)
+            result = AsyncResult(id)
+            if result.ready():
+                yield format_event(DONE_EVENT, {
+                    "ready": True,
+                    "successful": result.successful(),
+                    "value": result.result if result.successful() else None,
+                })
+                return
+            for event in task_progress.listen(id):
+                if event is None:
+                    # keep-alive comment so proxies don't close the connection
+                    yield ": keep-alive\n\n"
+                else:
+                    yield format_event(event["event"], event["data"])
+
+        return Response(stream_with_context(generate_events()),
+                        mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    except Exception as e:
+        app.logger.error("Error when streaming result for task %s", id)
+        app.logger.error(e)
+        raise InternalServerError() from e
+
+@app.route('/metrics', methods=["GET"])
+def metrics():
+    """
+    Prometheus scrapes this endpoint
+    Back-end returns the LLM metrics (latency, queue wait, tokens, retries and cost by module and model)
+    Set PROMETHEUS_MULTIPROC_DIR for the Flask and Celery processes to include the Celery workers' calls
+    """
+    exposition = dspya.metrics.render_prometheus()
+    if exposition is None:
+        # prometheus_client isn't installed
+        raise NotFound()
+    body, content_type = exposition
+    return Response(body, content_type=content_type)
+
 ################################### HOMEPAGE ENDPOINTS ###################################
 
 # NOTE: not needed for now
@@ -383,7 +538,7 @@ def check_question_response():
     """
     Front-end sends project_id, context_question_id, response_text, ignored_warnings
     Send inputs to the right DSPy module and get the response
-    Save the inputs and outputs in the prompts collection via db.add_prompt()
+    Save the inputs and outputs in the prompts collection via prompt_log.add_prompt()
     Back-end returns list of warnings
     """
     try:
@@ -434,9 +589,9 @@ def check_question_response():
             
             # app.logger.info("Outputs from CHECK_PROMPT: %s", output)
 
-            # save the prompts and responses in the prompts collection via db.add_prompt()
+            # save the prompts and responses in the prompts collection via prompt_log.add_prompt()
             if WRITE_TO_DB:
-                db.add_prompt(project_id,
+                prompt_log.add_prompt(project_id,
                               DSPyModule.CHECK_PROMPT.value,
                               {"context_question": context_question,
                                "user_response": response_text,
@@ -495,61 +650,89 @@ def update_context():
         app.logger.error(e)
         raise InternalServerError() from e
 
-@shared_task(ignore_result=False)
-def generate_draft(project_id):
+@shared_task(bind=True, ignore_result=False)
+def generate_draft(self, project_id):
     """
     Generate draft for a project
+    Publishes the progress of the task (see stream_result)
+    """
+    try:
+        result = generate_draft_steps(self.request.id, project_id)
+    except Exception:
+        task_progress.publish(self.request.id, DONE_EVENT,
+                              {"ready": True, "successful": False, "value": None})
+        raise
+    task_progress.publish(self.request.id, DONE_EVENT,
+                          {"ready": True, "successful": True, "value": result})
+    return result
+
+def generate_draft_steps(task_id, project_id):
     """
-    # get the context from the project in the projects collection
-    context = db.get_field_in_project(project_id, "context_response")
+    Steps of generate_draft
+    """
+    task_progress.publish(task_id, "progress", {"step": "draft"})
+
+    # get the context, the formatted context and the draft_type (cached until the context changes)
+    project_context = get_project_context(project_id)
+    context = project_context["context"]
+    formatted_context = project_context["formatted_context"]
+    draft_type = project_context["draft_type"]
+
+    # CREATE_DRAFT and DETECT_TOPICS only depend on the context, so they run concurrently
+    async def create_draft():
+        output = await dspya.ainvoke_module_json_output(**{"output_name": "sections",
+                                                        "module_name": DSPyModule.CREATE_DRAFT,
+                                                        "is_gpt4": True,
+                                                        "context": formatted_context,
+                                                        "draft_type": draft_type,
+                                                        "temp": TEMPERATURE})
+
+        app.logger.info("Generated draft for project %s", project_id)
+
+        # save the prompts and responses in the prompts collection via prompt_log.add_prompt()
+        if WRITE_TO_DB:
+            prompt_log.add_prompt(project_id,
+                                  DSPyModule.CREATE_DRAFT.value,
+                                  {"context": context, "draft_type": draft_type},
+                                  output)
 
-    # convert context to one string
-    formatted_context = dspya.format_context(context)
+        # format output
+        data = dspya.format_project(output, draft_type)
 
-    # invoke the module and get the output
-    # get the draft_type from context
-    draft_type = context["4"]["response"].lower()
-    # if the draft_type has multiple words, combine with underscore
-    draft_type = "_".join(draft_type.split())
+        # publish the draft so the UI doesn't have to wait for the topics to show it
+        task_progress.publish(task_id, "partial", {"part": "draft", "value": data})
 
-    output = dspya.invoke_module_json_output(**{"output_name": "sections",
-                                                    "module_name": DSPyModule.CREATE_DRAFT,
-                                                    "is_gpt4": True,
-                                                    "context": formatted_context,
-                                                    "draft_type": draft_type,
-                                                    "temp": TEMPERATURE})
-    
-    app.logger.info("Generated draft for project %s", project_id)
-    
-    # save the prompts and responses in the prompts collection via db.add_prompt()
-    # save the prompts and responses in the prompts collection via db.add_prompt()
-    if WRITE_TO_DB:
-        db.add_prompt(project_id,
-                        DSPyModule.CREATE_DRAFT.value,
-                        {"context": context, "draft_type": draft_type},
-                        output)
+        return data
 
-    # format output
-    data = dspya.format_project(output, draft_type)
+    async def detect_topics():
+        # call DETECT_TOPICS module
+        output = await dspya.ainvoke_module(**{"module_name": DSPyModule.DETECT_TOPICS,
+                                            "is_gpt4": True,
+                                            "context": formatted_context,
+                                            "return_rationale": False,
+                                            "temp": TEMPERATURE})
 
-    # call DETECT_TOPICS module
-    output = dspya.invoke_module(**{"module_name": DSPyModule.DETECT_TOPICS,
-                                "is_gpt4": True,        
-                                "context": formatted_context,
-                                "return_rationale": False,
-                                "temp": TEMPERATURE})
-    
-    app.logger.info("Generated the following topics for project %s: %s", project_id, output["topics"])
-    
-    # save the prompts and responses in the prompts collection via db.add_prompt()
-    if WRITE_TO_DB:
-        db.add_prompt(project_id,
-                        DSPyModule.DETECT_TOPICS.value,
-                        {"context": context},
-                        output)
+        app.logger.info("Generated the following topics for project %s: %s", project_id, output["topics"])
 
-    # format topics into a list
-    topics = dspya.format_string_to_list(output["topics"], "topics")
+        # save the prompts and responses in the prompts collection via prompt_log.add_prompt()
+        if WRITE_TO_DB:
+            prompt_log.add_prompt(project_id,
+                                  DSPyModule.DETECT_TOPICS.value,
+                                  {"context": context},
+                                  output)
+
+        # format topics into a list
+        topics = dspya.format_string_to_list(output["topics"], "topics")
+
+        # publish the topics as soon as they're ready
+        task_progress.publish(task_id, "partial", {"part": "topics", "value": topics})
+
+        return topics
+
+    async def create_draft_and_detect_topics():
+        return await asyncio.gather(create_draft(), detect_topics())
+
+    data, topics = asyncio.run(create_draft_and_detect_topics())
 
     # process the topics into the analyze_topics_info structure
     analyze_topics_info_topics = {}
@@ -572,6 +755,8 @@ def generate_draft(project_id):
         "suggestions": {}
     }
 
+    task_progress.publish(task_id, "progress", {"step": "saving"})
+
     # save analyze_topics_info in the projects collection
     if WRITE_TO_DB:
         db.edit_project_fields(project_id, {"analyze_topics_info": analyze_topics_info})
@@ -587,7 +772,7 @@ def submit_context():
     """
     Front-end sends project_id and context
     Send inputs to the right DSPy modules and get the response
-    Save the inputs and outputs in the prompts collection via db.add_prompt()
+    Save the inputs and outputs in the prompts collection via prompt_log.add_prompt()
     Back-end returns AI-generated draft (projects and cells) and list of topics
     """
     try:
@@ -658,53 +843,29 @@ def update_all_questions():
         app.logger.info("Saving project details for %s", project_id)
 
         if WRITE_TO_DB:
-            # update the project title and sections
-            db.edit_project_fields(
-                project_id, {"project_title": project_title, "sections": sections})
-
-            app.logger.info("Project fields for %s updated", project_id)
-
-            # update the list of projects in user collection
-            user_id = current_user.get_id()
-            db.edit_project_title(user_id, project_id, project_title)
-
-            app.logger.info("Project title for %s updated", project_id)
-
-            # iterate through added cells and add them
-            for cell_id in added_cells:
-                db.add_cell(project_id, cell_id,
-                            cells[cell_id]["cell_details"],
-                            cells[cell_id]["section_index"],
-                            last_updated=cells[cell_id]["last_updated"],
-                            human_ai_status=cells[cell_id]["human_ai_status"],
-                            time_estimate=cells[cell_id]["time_estimate"])
-                
-                app.logger.info("Cell %s added", cell_id)
-
-            app.logger.info("Cells for %s added", project_id)
-
-            # iterate through edited cells and update them
-            for cell_id in edited_cells:
-                db.edit_cell_fields(cell_id, {
+            # update the project title and sections, the user's project title and all the cells at once
+            result = db.apply_project_delta(
+                project_id,
+                {"project_title": project_title, "sections": sections},
+                added_cells={cell_id: {
+                    "cell_details": cells[cell_id]["cell_details"],
+                    "section_index": cells[cell_id]["section_index"],
+                    "last_updated": cells[cell_id]["last_updated"],
+                    "human_ai_status": cells[cell_id]["human_ai_status"],
+                    "time_estimate": cells[cell_id]["time_estimate"]
+                } for cell_id in added_cells},
+                edited_cells={cell_id: {
                     "section_index": cells[cell_id]["section_index"],
                     "cell_details": cells[cell_id]["cell_details"],
                     "last_updated": cells[cell_id]["last_updated"],
                     "human_ai_status": cells[cell_id]["human_ai_status"],
                     "time_estimate": cells[cell_id]["time_estimate"]
-                })
+                } for cell_id in edited_cells},
+                deleted_cells=deleted_cells,
+                user_id=current_user.get_id(),
+                use_transaction=USE_TRANSACTIONS)
 
-                app.logger.info("Cell %s edited", cell_id)
-
-            app.logger.info("Cells for %s edited", project_id)
-
-            # update the cells
-            # iterate through deleted cells and delete them
-            for cell_id in deleted_cells:
-                db.delete_cell(cell_id)
-
-                app.logger.info("Cell %s deleted", cell_id)
-
-            app.logger.info("Cells for %s deleted", project_id)
+            app.logger.info("Cells for %s: %s", project_id, result)
 
             app.logger.info("Project %s updated", project_id)
 
@@ -723,7 +884,7 @@ def switch_response_format():
     """
     Front-end sends project_id and cell_id and cell_details
     Send inputs to the right DSPy module and get the response
-    Save the inputs and outputs in the prompts collection via db.add_prompt()
+    Save the inputs and outputs in the prompts collection via prompt_log.add_prompt()
     Back-end returns new_cell_details
 
     NOTE: Won't update cell_details field in the cells collection. 
@@ -744,11 +905,9 @@ def switch_response_format():
         cell_details_str = json.dumps(cell_details)
 
         # get the format from MongoDB
-        # get the context from the project in the projects collection
-        context = db.get_field_in_project(project_id, "context_response")
-        # get the draft_type from context
-        draft_type = context["4"]["response"].lower()
-        draft_type = "_".join(draft_type.split())
+        # get the context from the project in the projects collection (cached until the context changes)
+        project_context = get_project_context(project_id)
+        draft_type = project_context["draft_type"]
 
         # invoke the module and get the output
         output = dspya.invoke_module_json_output(**{"output_name": "new_question",
@@ -759,9 +918,9 @@ def switch_response_format():
 
         # app.logger.info(f"Rationale is {output["rationale"]}")
 
-        # save the prompts and responses in the prompts collection via db.add_prompt()
+        # save the prompts and responses in the prompts collection via prompt_log.add_prompt()
         if WRITE_TO_DB:
-            db.add_prompt(project_id,
+            prompt_log.add_prompt(project_id,
                           DSPyModule.SWITCH_RESPONSE_FORMAT.value,
                           {"question": cell_details_str},
                           output)
@@ -800,7 +959,7 @@ def reword_question():
     """
     Front-end sends project_id and cell_id and cell_details
     Send inputs to the right DSPy module and get the response
-    Save the inputs and outputs in the prompts collection via db.add_prompt()
+    Save the inputs and outputs in the prompts collection via prompt_log.add_prompt()
         Back-end returns three alternative wordings
     """
     try:
@@ -819,14 +978,10 @@ def reword_question():
         # app.logger.info(existing_questions_str)
 
         # get the format from MongoDB
-        # get the context from the project in the projects collection
-        context = db.get_field_in_project(project_id, "context_response")
-        # get the draft_type from context
-        draft_type = context["4"]["response"].lower()
-        draft_type = "_".join(draft_type.split())
-
-        # format context into one string
-        formatted_context = dspya.format_context(context)
+        # get the context from the project in the projects collection (cached until the context changes)
+        project_context = get_project_context(project_id)
+        draft_type = project_context["draft_type"]
+        formatted_context = project_context["formatted_context"]
 
         # OPTIONAL: always re-generate the rewordings by randomizing the temperature
         # rand_int = random.randint(1, 100)
@@ -842,9 +997,9 @@ def reword_question():
                                                     # "temp": TEMPERATURE+0.0001*rand_int
                                                     })
 
-        # save the prompts and responses in the prompts collection via db.add_prompt()
+        # save the prompts and responses in the prompts collection via prompt_log.add_prompt()
         if WRITE_TO_DB:
-            db.add_prompt(project_id,
+            prompt_log.add_prompt(project_id,
                           DSPyModule.REWORD_QUESTION.value,
                           {
                               "context": formatted_context,
@@ -877,7 +1032,7 @@ def generate_specific_rewording():
     """
     Front-end sends project_id and cell_id and cell_details and specific_request
     Send inputs to the right DSPy module and get the response
-    Save the inputs and outputs in the prompts collection via db.add_prompt()
+    Save the inputs and outputs in the prompts collection via prompt_log.add_prompt()
         Back-end returns three possible questions (only one is displayed at a time to the user)
     """
     try:
@@ -897,14 +1052,10 @@ def generate_specific_rewording():
         # app.logger.info(existing_questions_str)
 
         # get the format from MongoDB
-        # get the context from the project in the projects collection
-        context = db.get_field_in_project(project_id, "context_response")
-        # get the draft_type from context
-        draft_type = context["4"]["response"].lower()
-        draft_type = "_".join(draft_type.split())
-
-        # format context into one string
-        formatted_context = dspya.format_context(context)
+        # get the context from the project in the projects collection (cached until the context changes)
+        project_context = get_project_context(project_id)
+        draft_type = project_context["draft_type"]
+        formatted_context = project_context["formatted_context"]
 
         # always re-generate the rewordings by randomizing the temperature
         rand_int = random.randint(1, 100)
@@ -921,9 +1072,9 @@ def generate_specific_rewording():
 
         # app.logger.info(f"Rationale is {output["rationale"]}")
 
-        # save the prompts and responses in the prompts collection via db.add_prompt()
+        # save the prompts and responses in the prompts collection via prompt_log.add_prompt()
         if WRITE_TO_DB:
-            db.add_prompt(project_id,
+            prompt_log.add_prompt(project_id,
                           DSPyModule.REWORD_QUESTION_FROM_REQUEST.value,
                           {
                               "context": formatted_context,
@@ -963,7 +1114,7 @@ def check_question():
     Get cell_details from the cells collection via db.get_field_in_cell()
     If the cell_details are different from the last time, 
         Prepare relevant LLM prompts and run the LLM model and get the response
-        Save the prompts and responses in the prompts collection via db.add_prompt()
+        Save the prompts and responses in the prompts collection via prompt_log.add_prompt()
         Replace the cell_details, last_checked and checks fields in the cells collection via db.edit_cell_fields()
     If the cell_details are the same, 
         Get checks field in the cells collection via db.get_field_in_cell()
@@ -984,14 +1135,10 @@ def check_question():
         cell_details_str = json.dumps(cell_details)
 
         # get the format from MongoDB
-        # get the context from the project in the projects collection
-        context = db.get_field_in_project(project_id, "context_response")
-        # get the draft_type from context
-        draft_type = context["4"]["response"].lower()
-        draft_type = "_".join(draft_type.split())
-
-        # format context into one string
-        formatted_context = dspya.format_context(context)
+        # get the context from the project in the projects collection (cached until the context changes)
+        project_context = get_project_context(project_id)
+        draft_type = project_context["draft_type"]
+        formatted_context = project_context["formatted_context"]
 
         # NOTE: assume reading level is third grade for everything
         # rand_int = random.randint(1, 100)
@@ -1008,9 +1155,9 @@ def check_question():
 
         # app.logger.info(output["cleaned_scores"])
 
-        # save the prompts and responses in the prompts collection via db.add_prompt()
+        # save the prompts and responses in the prompts collection via prompt_log.add_prompt()
         if WRITE_TO_DB:
-            db.add_prompt(project_id,
+            prompt_log.add_prompt(project_id,
                           DSPyModule.CHECK_QUESTION.value,
                           {
                               "checks_to_ignore": checks_to_ignore,
@@ -1039,9 +1186,9 @@ def check_question():
                                     "temp": TEMPERATURE})
         # app.logger.info("Scores: %s", scores)
         
-        # save the prompts and responses in the prompts collection via db.add_prompt()
+        # save the prompts and responses in the prompts collection via prompt_log.add_prompt()
         if WRITE_TO_DB:
-            db.add_prompt(project_id,
+            prompt_log.add_prompt(project_id,
                           DSPyModule.ASSESS_QUESTIONS.value,
                           {
                               "questions": rewritten_questions,
@@ -1294,7 +1441,7 @@ def analyze_topics():
         # if the topics were edited, but no cells were edited, run classification on new topics
         elif len(added_topics) > 0 and len(edited_cells) == 0:
             # get all the cells for the project
-            cells = db.get_cells(project_id)
+            cells = db.get_cells(project_id, ["cell_id", "cell_details"])
             for cell in cells:
                 if cell["cell_details"]["cell_type"] != "question":
                     continue
@@ -1314,7 +1461,7 @@ def analyze_topics():
         # if both topics and cells were edited, run classification on all questions
         else:
             # get all the cells for the project
-            cells = db.get_cells(project_id)
+            cells = db.get_cells(project_id, ["cell_id", "cell_details"])
             for cell in cells:
                 if cell["cell_details"]["cell_type"] != "question":
                     continue
@@ -1355,9 +1502,9 @@ def analyze_topics():
             
             # app.logger.info("Cells to analyze: %s", cell_details)
 
-            # Call the topic classification module using threading
-            # create function to handle each classification
-            def classify_topics(cell):
+            # Call the topic classification module concurrently
+            # create coroutine to handle each classification
+            async def classify_topics(cell):
                 # format topics to string
                 topics_str = dspya.format_list_to_string(cell["all_topics"])
 
@@ -1371,7 +1518,7 @@ def analyze_topics():
                 cell_details_str = json.dumps(cell["cell_details"])
 
                 # invoke the module and get the output
-                output = dspya.invoke_module_multiple_times(**{"module_name": DSPyModule.CLASSIFY_TOPICS,
+                output = await dspya.ainvoke_module_multiple_times(**{"module_name": DSPyModule.CLASSIFY_TOPICS,
                                                 "output_name": "classified_topics",
                                                 "num_times": 2 if first_pass else 3,
                                                 "is_gpt4": True,                   
@@ -1383,15 +1530,19 @@ def analyze_topics():
             
                 # app.logger.info("Outputs from CLASSIFY_TOPICS: %s", output)
                 
-                # save the prompts and responses in the prompts collection via db.add_prompt()
+                # save the prompts and responses in the prompts collection via prompt_log.add_prompt()
                 if WRITE_TO_DB:
-                    db.add_prompt(project_id,
+                    prompt_log.add_prompt(project_id,
                                 DSPyModule.CLASSIFY_TOPICS.value,
                                 {"question": cell_details_str,
                                 "all_topics": topics_str,
                                 "pre_selected_topics": pre_selected_topics_str},
                                 output)
-                
+
+                add_cell_topics(cell, output)
+
+            # add the cell to the topics it was classified into
+            def add_cell_topics(cell, output):
                 # clean output
                 cell_topics = dspya.clean_outputs_from_topic_classification(output, cell["all_topics"], cell["pre_selected_topics"])
 
@@ -1411,16 +1562,83 @@ def analyze_topics():
                 for topic in cell_topics:
                     new_topics[topic]["cells"].append(cell["cell_id"])
 
-            # create a list to store the threads
-            threads = []
-            # execute each topic classification and store the thread in the list and then join them
-            for cell in cell_details:
-                thread = threading.Thread(target=classify_topics, args=(cell,))
-                thread.start()
-                threads.append(thread)
+            # the part of the batched module's input that is sent for each question
+            def make_batch_question(cell):
+                return {"cell_id": cell["cell_id"],
+                        "question": cell["cell_details"],
+                        "pre_selected_topics": cell["pre_selected_topics"]}
 
-            for thread in threads:
-                thread.join()
+            # classify a batch of cells (that share the same all_topics) in one call
+            # returns the cells that are missing from the outputs so they can be classified one by one
+            async def classify_topics_batch(batch):
+                # format topics to string
+                topics_str = dspya.format_list_to_string(batch[0]["all_topics"])
+
+                # convert the batch to a string
+                questions_str = json.dumps([make_batch_question(cell) for cell in batch])
+
+                app.logger.info("Classifying topics for a batch of %s questions", len(batch))
+
+                # invoke the module the same number of times as the per-question path (with slightly different temperatures)
+                num_times = 2 if first_pass else 3
+                outputs = await asyncio.gather(*[dspya.ainvoke_module_json_output(**{"output_name": "classified_topics",
+                                                "module_name": DSPyModule.CLASSIFY_TOPICS_BATCH,
+                                                "is_gpt4": True,
+                                                "questions": questions_str,
+                                                "all_topics": topics_str,
+                                                "temp": TEMPERATURE+0.0001*i}) for i in range(num_times)])
+                outputs = [output["classified_topics"] if output is not None else None for output in outputs]
+
+                # save the prompts and responses in the prompts collection via prompt_log.add_prompt()
+                if WRITE_TO_DB:
+                    prompt_log.add_prompt(project_id,
+                                DSPyModule.CLASSIFY_TOPICS_BATCH.value,
+                                {"questions": questions_str,
+                                "all_topics": topics_str},
+                                outputs)
+
+                missing_cells = []
+                for cell in batch:
+                    output = dspya.get_outputs_from_batch_topic_classification(outputs, cell["cell_id"])
+                    if output is None:
+                        missing_cells.append(cell)
+                    else:
+                        add_cell_topics(cell, output)
+                return missing_cells
+
+            cells_to_classify = cell_details
+            if PREFILTER_TOPICS:
+                # assign the topics for the questions that clearly match, only send the ambiguous ones to the LLM
+                prefiltered_topics, cells_to_classify = topic_prefilter.classify(project_id, cell_details)
+                for cell in cell_details:
+                    if cell["cell_id"] in prefiltered_topics:
+                        app.logger.info("Pre-classified topics for question %s: %s",
+                                        cell["cell_details"]["main_text"], prefiltered_topics[cell["cell_id"]])
+                        for topic in prefiltered_topics[cell["cell_id"]]:
+                            new_topics[topic]["cells"].append(cell["cell_id"])
+                app.logger.info("Pre-classified %s of %s questions", len(prefiltered_topics), len(cell_details))
+
+            if BATCH_TOPIC_CLASSIFICATION:
+                # group the cells by the topics they're classified against and split the groups by token budget
+                groups = {}
+                for cell in cells_to_classify:
+                    groups.setdefault(tuple(cell["all_topics"]), []).append(cell)
+                batches = []
+                for group in groups.values():
+                    # the topics are sent once per batch, only the questions grow with the batch size
+                    topics_tokens = estimate_tokens(dspya.format_list_to_string(group[0]["all_topics"]))
+                    batches.extend(dspya.chunk_by_token_budget(group, to_payload=make_batch_question,
+                                                               shared_tokens=topics_tokens))
+                missing_cells = asyncio.run(dspya.gather_with_limit(
+                    [classify_topics_batch(batch) for batch in batches]))
+                # fall back to the per-question module for the cells the batched module missed
+                cells_to_classify = [cell for cells in missing_cells for cell in cells]
+                if len(cells_to_classify) > 0:
+                    app.logger.info("Batched classification missed %s questions", len(cells_to_classify))
+
+            # run all the topic classifications concurrently (with a bounded number in flight)
+            if len(cells_to_classify) > 0:
+                asyncio.run(dspya.gather_with_limit([classify_topics(cell) for cell in cells_to_classify]))
 
         # app.logger.info("New topics: %s", new_topics)
 
@@ -1430,7 +1648,7 @@ def analyze_topics():
         # app.logger.info("Over-represented topics: %s", over_topics)
         # app.logger.info("Under-represented topics: %s", under_topics)
         
-        # use threading to generate suggestions for under_topics with 0 questions
+        # generate suggestions for under_topics with 0 questions
         def generate_suggestions(topic):
             if topic in under_topics:
                 # generate suggestion_rationale for all topics in under_topics
@@ -1451,16 +1669,9 @@ def analyze_topics():
 
                 # app.logger.info("Suggestion rationale for topic %s: %s", topic, new_topics[topic]["suggestion_rationale"])
         
-        # create a list to store the threads
-        threads = []
-        # execute each suggestion generation and store the thread in the list and then join them
+        # the suggestion rationales are just string formatting, so there's no need for threads
         for topic in new_topics:
-            thread = threading.Thread(target=generate_suggestions, args=(topic,))
-            thread.start()
-            threads.append(thread)
-
-        for thread in threads:
-            thread.join()
+            generate_suggestions(topic)
 
         # generate the summary paragraph
         num_topics = len(topics_lst)
@@ -1471,7 +1682,7 @@ def analyze_topics():
         summary_paragraph = generate_summary_paragraph(num_topics, over_topic_names, under_topic_names)
 
         # get the old suggestions from the projects collection
-        old_suggestions = db.get_field_in_project(project_id, "analyze_topics_info")["suggestions"]
+        old_suggestions = db.get_field_in_project(project_id, "analyze_topics_info.suggestions")
 
         # update the "topics" and "human_topics" fields in the projects collection via db.edit_project_fields()
         if WRITE_TO_DB:
@@ -1560,11 +1771,9 @@ def get_delete_suggestions():
 
         # app.logger.info("Formatted existing questions for project %s topic %s: %s", project_id, topic, existing_questions_str)
 
-        # get the context
-        context = db.get_field_in_project(project_id, "context_response")
-
-        # format into one string
-        formatted_context = dspya.format_context(context)
+        # get the context formatted into one string (cached until the context changes)
+        project_context = get_project_context(project_id)
+        formatted_context = project_context["formatted_context"]
 
         # app.logger.info("Formatted context for project %s", project_id)
         # app.logger.info(formatted_context)
@@ -1582,9 +1791,9 @@ def get_delete_suggestions():
         
         # app.logger.info("Outputs from REMOVE_QUESTIONS_FROM_TOPIC: %s", output)
 
-        # save the prompts and responses in the prompts collection via db.add_prompt()
+        # save the prompts and responses in the prompts collection via prompt_log.add_prompt()
         if WRITE_TO_DB:
-            db.add_prompt(project_id,
+            prompt_log.add_prompt(project_id,
                         DSPyModule.REMOVE_QUESTIONS_FROM_TOPIC.value,
                         {"context": formatted_context,
                         "topic": topic,
@@ -1639,14 +1848,10 @@ def get_add_suggestions():
 
         # app.logger.info("Formatted existing questions for project %s topic %s: %s", project_id, topic, existing_questions_str)
 
-        # get the context
-        context = db.get_field_in_project(project_id, "context_response")
-        # get the draft_type from context
-        draft_type = context["4"]["response"].lower()
-        draft_type = "_".join(draft_type.split())
-
-        # format into one string
-        formatted_context = dspya.format_context(context)
+        # get the context, the draft_type and the context formatted into one string (cached until the context changes)
+        project_context = get_project_context(project_id)
+        draft_type = project_context["draft_type"]
+        formatted_context = project_context["formatted_context"]
 
         # app.logger.info("Formatted context for project %s", project_id)
         # app.logger.info(formatted_context)
@@ -1670,9 +1875,9 @@ def get_add_suggestions():
         
         # app.logger.info("Outputs from ADD_QUESTIONS_TO_TOPIC: %s", output)
 
-        # save the prompts and responses in the prompts collection via db.add_prompt()
+        # save the prompts and responses in the prompts collection via prompt_log.add_prompt()
         if WRITE_TO_DB:
-            db.add_prompt(project_id,
+            prompt_log.add_prompt(project_id,
                         DSPyModule.ADD_QUESTIONS_TO_TOPIC.value,
                         {"context": formatted_context,
                         "topic": topic,
@@ -1713,7 +1918,7 @@ def get_add_suggestions():
 #     Get the project_title and sections fields in the projects collection via db.get_field_in_project()
 #     Translate the text
 #         Prepare relevant LLM prompts and run the LLM model and get the response
-#         Save the prompts and responses in the prompts collection via db.add_prompt()
+#         Save the prompts and responses in the prompts collection via prompt_log.add_prompt()
 #     Back-end returns translated project details (project_title and sections) and translated questions
 #     """
 #     return jsonify({'status': 'ok'})
@@ -0,0 +1,84 @@
+################################### Import Libraries ###################################
+import json
+import time
+
+CHANNEL_PREFIX = "task_progress:"  # Redis pub/sub channel for the progress events of a task
+LAST_EVENT_PREFIX = "task_progress_last:"  # Redis key with the last progress event of a task
+LAST_EVENT_TTL = 60 * 60  # seconds to keep the last event of a task (for clients that connect late)
+HEARTBEAT_INTERVAL = 15  # seconds between keep-alive messages while waiting for events
+STREAM_TIMEOUT = 180  # max seconds to keep a stream open
+DONE_EVENT = "done"  # event type of the last event of a task
+
+
+class TaskProgress:
+    """
+    Publishes the progress of Celery tasks through Redis pub/sub so the server can push it to the UI.
+
+    Every event is published on the task's channel and also stored as the task's last event,
+    so a client that subscribes after an event was published still gets the current state.
+    Events are dictionaries with an "event" type and a "data" payload, and the last event of a task is DONE_EVENT.
+    """
+
+    def __init__(self, redis_url):
+        import redis
+
+        self.redis = redis.Redis.from_url(redis_url)
+
+    def publish(self, task_id, event, data=None):
+        """
+        Publish a progress event for a task
+        Progress is best effort, so Redis errors never fail the task
+        """
+        message = json.dumps({"event": event, "data": data, "time": time.time()})
+        try:
+            pipeline = self.redis.pipeline()
+            pipeline.set(LAST_EVENT_PREFIX + task_id, message, ex=LAST_EVENT_TTL)
+            pipeline.publish(CHANNEL_PREFIX + task_id, message)
+            pipeline.execute()
+        except Exception:
+            pass
+
+    def delete(self, task_id):
+        """
+        Delete the last progress event of a task (it also expires after LAST_EVENT_TTL)
+        """
+        self.redis.delete(LAST_EVENT_PREFIX + task_id)
+
+    def get_last_event(self, task_id):
+        """
+        Returns the last progress event of a task or None
+        """
+        message = self.redis.get(LAST_EVENT_PREFIX + task_id)
+        if message is None:
+            return None
+        return json.loads(message)
+
+    def listen(self, task_id, timeout=STREAM_TIMEOUT, heartbeat_interval=HEARTBEAT_INTERVAL):
+        """
+        Generator with the progress events of a task, starting with the last event published before the call
+        Yields None every heartbeat_interval seconds without events (so the caller can send a keep-alive)
+        Stops after the DONE_EVENT or after timeout seconds
+        """
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        # subscribe before reading the last event so no event is missed in between
+        pubsub.subscribe(CHANNEL_PREFIX + task_id)
+        try:
+            last_event = self.get_last_event(task_id)
+            if last_event is not None:
+                yield last_event
+                if last_event["event"] == DONE_EVENT:
+                    return
+
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline:
+                message = pubsub.get_message(timeout=min(heartbeat_interval,
+                                                         max(0, deadline - time.monotonic())))
+                if message is None:
+                    yield None
+                    continue
+                event = json.loads(message["data"])
+                yield event
+                if event["event"] == DONE_EVENT:
+                    return
+        finally:
+            pubsub.close()
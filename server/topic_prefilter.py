@@ -0,0 +1,155 @@
+################################### Import Libraries ###################################
+import hashlib
+import math
+import re
+from collections import Counter
+
+from llm_cache import LRUCacheTier
+
+# Default settings for the topic pre-filter
+# NOTE: the thresholds were picked by hand on a few projects, tune them against the LLM classifications
+HIGH_CONFIDENCE_THRESHOLD = 0.3  # topics with a similarity at or above this are assigned directly
+LOW_CONFIDENCE_THRESHOLD = 0.1  # topics with a similarity at or below this are treated as not matching
+CHAR_NGRAM_SIZE = 3  # size of the character n-grams (so "safe" and "safety" share features)
+VECTOR_CACHE_MAX_ENTRIES = 20000  # max number of cached term count vectors across all projects
+
+STOP_WORDS = set("""
+a about above after again all am an and any are as at be because been before being below between both but by
+can could did do does doing during each few for from further had has have having he her here hers how i if in
+into is it its just me more most my no nor not of off on once only or other our out over own same she should so
+some such than that the their them then there these they this those through to too under until up very was we
+were what when where which while who whom why will with would you your yours x
+""".split())
+
+
+def tokenize(text):
+    """
+    Split a string into lowercase words without stop words
+    """
+    return [word for word in re.findall(r"[a-z0-9]+", text.lower())
+            if word not in STOP_WORDS]
+
+
+def get_features(text):
+    """
+    Get the features of a string: every word and the character n-grams of every word
+    """
+    features = []
+    for word in tokenize(text):
+        features.append(word)
+        padded_word = f"<{word}>"
+        features.extend(padded_word[i:i+CHAR_NGRAM_SIZE]
+                        for i in range(len(padded_word) - CHAR_NGRAM_SIZE + 1))
+    return features
+
+
+def get_question_text(cell_details):
+    """
+    Get the text of a question cell (main text and response categories)
+    """
+    text = cell_details.get("main_text", "")
+    for category in cell_details.get("response_categories", []):
+        if isinstance(category, dict):
+            text += " " + str(category.get("text", ""))
+    return text
+
+
+def cosine_similarity(vector_a, vector_b):
+    """
+    Cosine similarity of two sparse vectors (dictionaries mapping from feature to weight)
+    """
+    if len(vector_a) > len(vector_b):
+        vector_a, vector_b = vector_b, vector_a
+    dot = sum(weight * vector_b.get(feature, 0)
+              for feature, weight in vector_a.items())
+    norm_a = math.sqrt(sum(weight * weight for weight in vector_a.values()))
+    norm_b = math.sqrt(sum(weight * weight for weight in vector_b.values()))
+    if norm_a == 0 or norm_b == 0:
+        return 0
+    return dot / (norm_a * norm_b)
+
+
+class TopicPrefilter:
+    """
+    Local TF-IDF index of topic names and question texts used to skip the LLM for obvious classifications.
+
+    A question is classified locally when every topic is either a clear match (similarity >= high_threshold)
+    or a clear miss (similarity <= low_threshold), at least one topic matches and all of its pre-selected
+    topics match. Every other question is ambiguous and goes to the LLM.
+
+    Term counts are cached per project and text, and the IDF weights are recomputed from the
+    current questions and topics on every call (so adding a topic doesn't invalidate the cache).
+    """
+
+    def __init__(self, high_threshold=HIGH_CONFIDENCE_THRESHOLD, low_threshold=LOW_CONFIDENCE_THRESHOLD,
+                 cache=None):
+        self.high_threshold = high_threshold
+        self.low_threshold = low_threshold
+        self.cache = cache if cache is not None else LRUCacheTier(
+            max_entries=VECTOR_CACHE_MAX_ENTRIES)
+
+    def get_term_counts(self, project_id, text):
+        """
+        Get the (cached) feature counts of a string for a project
+        """
+        key = f"{project_id}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+        term_counts = self.cache.get(key)
+        if term_counts is None:
+            term_counts = dict(Counter(get_features(text)))
+            self.cache.set(key, term_counts)
+        return term_counts
+
+    def get_scores(self, project_id, cell_details):
+        """
+        cell_details : list of {"cell_id", "cell_details", "all_topics", "pre_selected_topics"}
+
+        return scores : dictionary mapping from cell_id to a dictionary mapping from topic to similarity
+        """
+        question_counts = {cell["cell_id"]: self.get_term_counts(project_id, get_question_text(cell["cell_details"]))
+                           for cell in cell_details}
+        all_topics = sorted(set(topic for cell in cell_details for topic in cell["all_topics"]))
+        topic_counts = {topic: self.get_term_counts(project_id, topic) for topic in all_topics}
+
+        # compute the IDF weights over all the questions and topics
+        documents = list(question_counts.values()) + list(topic_counts.values())
+        document_frequencies = Counter(feature for counts in documents for feature in counts)
+        num_documents = len(documents)
+
+        def get_vector(counts):
+            return {feature: count * (math.log((1 + num_documents) / (1 + document_frequencies[feature])) + 1)
+                    for feature, count in counts.items()}
+
+        topic_vectors = {topic: get_vector(counts) for topic, counts in topic_counts.items()}
+        scores = {}
+        for cell in cell_details:
+            question_vector = get_vector(question_counts[cell["cell_id"]])
+            scores[cell["cell_id"]] = {topic: cosine_similarity(question_vector, topic_vectors[topic])
+                                       for topic in cell["all_topics"]}
+        return scores
+
+    def classify(self, project_id, cell_details):
+        """
+        cell_details : list of {"cell_id", "cell_details", "all_topics", "pre_selected_topics"}
+
+        return classified_topics : dictionary mapping from cell_id to topics for the confident questions
+        return ambiguous_cells : list of the items in cell_details that should go to the LLM
+        """
+        if len(cell_details) == 0:
+            return {}, []
+
+        scores = self.get_scores(project_id, cell_details)
+        classified_topics = {}
+        ambiguous_cells = []
+        for cell in cell_details:
+            cell_scores = scores[cell["cell_id"]]
+            matches = [topic for topic, score in cell_scores.items()
+                       if score >= self.high_threshold]
+            is_confident = len(matches) > 0 and \
+                all(score >= self.high_threshold or score <= self.low_threshold
+                    for score in cell_scores.values()) and \
+                all(topic in matches for topic in cell["pre_selected_topics"])
+            if is_confident:
+                classified_topics[cell["cell_id"]] = matches
+            else:
+                ambiguous_cells.append(cell)
+        return classified_topics, ambiguous_cells
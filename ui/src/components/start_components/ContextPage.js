@@ -235,16 +235,60 @@ function ContextPage(props) {
   // state variable for task_id
   const [taskId, setTaskId] = useState("");
 
+  // state variable to stream the result with server-sent events (falls back to polling if the stream fails)
+  const [useStream, setUseStream] = useState(true);
+
+  // state variable for the current step of the task (from the stream)
+  const [progressStep, setProgressStep] = useState("");
+
+  // messages to show for each step of the task
+  const progressMessages = {
+    draft: "Generating the questions and topics...",
+    draft_ready: "Generated the questions. Detecting the topics...",
+    topics_ready: "Detected the topics. Generating the questions...",
+    saving: "Saving the project...",
+  };
+
   // // for testing only print taskId
   // useEffect(() => {
   //   console.log("taskId", taskId);
   // }, [taskId]);
 
-  // useEffect to call getResult every 5 seconds based on secondsPassed and taskId
+  // useEffect to stream the result of the task with server-sent events
+  useEffect(() => {
+    if (taskId === "" || !showCreateProject || !useStream) {
+      return;
+    }
+    const eventSource = new EventSource(`/api/stream_result/${taskId}`);
+    eventSource.addEventListener("progress", (event) => {
+      const data = JSON.parse(event.data);
+      setProgressStep(data.step);
+    });
+    // the draft and the topics are generated concurrently, show which one is done
+    eventSource.addEventListener("partial", (event) => {
+      const data = JSON.parse(event.data);
+      setProgressStep((prevStep) =>
+        prevStep === "draft" ? `${data.part}_ready` : prevStep
+      );
+    });
+    eventSource.addEventListener("done", (event) => {
+      eventSource.close();
+      handleResult(JSON.parse(event.data));
+    });
+    eventSource.onerror = () => {
+      // fall back to polling get_result
+      console.error("Error in streaming results. Polling instead.");
+      eventSource.close();
+      setUseStream(false);
+    };
+    return () => eventSource.close();
+  }, [taskId, showCreateProject, useStream]);
+
+  // useEffect to call getResult every 5 seconds based on secondsPassed and taskId (if the stream failed)
   useEffect(() => {
     if (taskId !== "" && showCreateProject) {
       if (secondsPassed <= 120) {
-        if (secondsPassed % 5 === 0) {
+        if (!useStream && secondsPassed % 5 === 0) {
           getResult(taskId);
         }
       } else {
@@ -255,6 +299,62 @@ function ContextPage(props) {
     }
   }, [taskId, secondsPassed]);
 
+  // function to handle the result of the task (from get_result or the "done" event of stream_result)
+  const handleResult = (data) => {
+    if (data.ready) {
+      if (data.successful) {
+        // console.log("Success:", data);
+        // reset the topic slice
+        dispatch(resetTopicSlice());
+        // update the projects field in userProjectsSlice
+        dispatch(
+          editProject({
+            project_id: project_id,
+            project_title: data.value.project_details.project.project_title,
+          })
+        );
+        // update projectDetailsSlice
+        dispatch(
+          setProjectDetails({
+            project_id: project_id,
+            project_title: data.value.project_details.project.project_title,
+            sections: data.value.project_details.project.sections,
+            cells: {},
+          })
+        );
+        // go through data.cells and call addCell for each cell
+        data.value.project_details.cells.forEach((cell) => {
+          // get a new cell_id
+          const newCellId = uuidv4();
+          dispatch(
+            addCell({
+              cell_id: newCellId,
+              cell: cell,
+              section_index: cell["section_index"],
+            })
+          );
+        });
+        // add the topics to the store
+        // iterate through each topic in data.topics
+        data.value.topics.forEach((topic) => {
+          dispatch(
+            addTopic({
+              topic_name: topic,
+            })
+          );
+        });
+        setShowCreateProject(false);
+        navigate(`/project/${project_id}`);
+      } else {
+        console.error("Generating initial questions failed");
+        setShowCreateProject(false);
+        setServerError(true);
+      }
+    } else {
+      console.log("Task not ready yet. Trying again in 5 seconds.");
+    }
+  };
+
   // function to call the get_result API endpoint every second until the result is available
   const getResult = (taskId) => {
     console.log("get result for task: ", taskId);
@@ -271,58 +371,7 @@ function ContextPage(props) {
       })
       .then((data) => {
         // console.log(data);
-        if (data.ready) {
-          if (data.successful) {
-            // console.log("Success:", data);
-            // reset the topic slice
-            dispatch(resetTopicSlice());
-            // update the projects field in userProjectsSlice
-            dispatch(
-              editProject({
-                project_id: project_id,
-                project_title: data.value.project_details.project.project_title,
-              })
-            );
-            // update projectDetailsSlice
-            dispatch(
-              setProjectDetails({
-                project_id: project_id,
-                project_title: data.value.project_details.project.project_title,
-                sections: data.value.project_details.project.sections,
-                cells: {},
-              })
-            );
-            // go through data.cells and call addCell for each cell
-            data.value.project_details.cells.forEach((cell) => {
-              // get a new cell_id
-              const newCellId = uuidv4();
-              dispatch(
-                addCell({
-                  cell_id: newCellId,
-                  cell: cell,
-                  section_index: cell["section_index"],
-                })
-              );
-            });
-            // add the topics to the store
-            // iterate through each topic in data.topics
-            data.value.topics.forEach((topic) => {
-              dispatch(
-                addTopic({
-                  topic_name: topic,
-                })
-              );
-            });
-            setShowCreateProject(false);
-            navigate(`/project/${project_id}`);
-          } else {
-            console.error("Generating initial questions failed");
-            setShowCreateProject(false);
-            setServerError(true);
-          }
-        } else {
-          console.log("Task not ready yet. Trying again in 5 seconds.");
-        }
+        handleResult(data);
       })
       .catch((_error) => {
         console.error("Error in getting results");
@@ -356,7 +405,9 @@ function ContextPage(props) {
       })
       .then((data) => {
         // console.log(data);
-        // set the task_id
+        // set the task_id and start streaming the result
+        setUseStream(true);
+        setProgressStep("");
         setTaskId(data.task_id);
       })
       .catch((_error) => {
@@ -427,6 +478,11 @@ function ContextPage(props) {
             Using AI to Generate an Initial Draft
           </Typography>
           <CircularProgress size={60} />
+          {progressStep in progressMessages && (
+            <Typography variant="body1">
+              {progressMessages[progressStep]}
+            </Typography>
+          )}
           {secondsPassed <= 60 ? (
             <Typography variant="body1">
               Estimated time remaining: {60 - secondsPassed} seconds